@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+"""
+Module containing the components shared by the benchmarks.
+"""
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+DNSFILTER_DIR = os.path.join(ROOT_DIR, "dnsfilter")
+
+# The dnsfilter modules import each other as top level modules
+if DNSFILTER_DIR not in sys.path:
+    sys.path.insert(0, DNSFILTER_DIR)
+
+# The result values where a larger value is better
+HIGHER_IS_BETTER = [ "qps" ]
+
+def percentile(values, p):
+    """
+    Get the p-th percentile of a sorted list of values (nearest rank).
+    """
+    if not values:
+        return None
+    i = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(i, len(values) - 1))]
+
+def summarize(latencies, elapsed, errors=0):
+    """
+    Summarize a list of latencies (in seconds) measured over elapsed
+    seconds. Latencies in the summary are in microseconds.
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def us(value):
+        if value is None:
+            return None
+        return round(value * 1000000, 1)
+
+    return {
+        "count": count,
+        "errors": errors,
+        "elapsed": round(elapsed, 3),
+        "qps": round(count / elapsed, 1) if elapsed else None,
+        "mean_us": us(sum(latencies) / count if count else None),
+        "p50_us": us(percentile(latencies, 50)),
+        "p99_us": us(percentile(latencies, 99)),
+        "p999_us": us(percentile(latencies, 99.9)),
+        "max_us": us(latencies[-1] if latencies else None)
+    }
+
+def get_environment():
+    """
+    Describe where the benchmark ran, so results from different machines
+    or revisions aren't compared by mistake.
+    """
+    try:
+        revision = subprocess.check_output([ "git", "rev-parse", "HEAD" ],
+            cwd=ROOT_DIR, stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": _cpu_count(),
+        "revision": revision
+    }
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+
+def write_results(path, benchmark, args, results):
+    """
+    Write benchmark results to a JSON file that compare.py can read.
+    """
+    doc = {
+        "benchmark": benchmark,
+        "time": datetime.datetime.utcnow().isoformat()+"Z",
+        "environment": get_environment(),
+        "args": vars(args),
+        "results": results
+    }
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def read_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def print_results(results):
+    """
+    Print a table of benchmark results.
+    """
+    print "%-32s %10s %10s %10s %10s %10s" % ("benchmark", "qps", "p50 us",
+        "p99 us", "p999 us", "errors")
+    for name in sorted(results):
+        result = results[name]
+        print "%-32s %10s %10s %10s %10s %10s" % (name, result["qps"],
+            result["p50_us"], result["p99_us"], result["p999_us"],
+            result["errors"])
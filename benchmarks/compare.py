@@ -0,0 +1,89 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import argparse
+import common
+import sys
+
+"""
+Compare two benchmark result files.
+
+Prints the change in throughput and latency of every benchmark found in
+both files, and exits with status 1 if any of them regressed by more than
+the threshold.
+"""
+
+_METRICS = [ "qps", "p50_us", "p99_us", "p999_us" ]
+
+def compare(base, new, threshold):
+    """
+    Compare the results of two runs. Returns the rows to print and whether
+    anything regressed.
+    """
+    rows = []
+    regressed = False
+    for name in sorted(set(base["results"]) & set(new["results"])):
+        for metric in _METRICS:
+            old_value = base["results"][name].get(metric)
+            new_value = new["results"][name].get(metric)
+            if not old_value or new_value is None:
+                continue
+
+            change = (new_value - old_value) * 100.0 / old_value
+            if metric in common.HIGHER_IS_BETTER:
+                worse = -change
+            else:
+                worse = change
+
+            flag = ""
+            if worse > threshold:
+                flag = "REGRESSED"
+                regressed = True
+            elif -worse > threshold:
+                flag = "improved"
+            rows.append((name, metric, old_value, new_value, change, flag))
+    return (rows, regressed)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare two benchmark result files")
+    parser.add_argument("base", type=str, help="The baseline results")
+    parser.add_argument("new", type=str, help="The results to compare")
+    parser.add_argument("--threshold", type=float, default=5,
+        help="Percentage change that counts as a regression")
+    args = parser.parse_args()
+
+    base = common.read_results(args.base)
+    new = common.read_results(args.new)
+    if base["benchmark"] != new["benchmark"]:
+        print "Can't compare %s results with %s results" % (
+            base["benchmark"], new["benchmark"])
+        return 2
+
+    for key in [ "revision", "python", "cpus" ]:
+        if base["environment"].get(key) != new["environment"].get(key):
+            print "Note: %s differs (%s vs %s)" % (key,
+                base["environment"].get(key), new["environment"].get(key))
+
+    (rows, regressed) = compare(base, new, args.threshold)
+    print "%-32s %-8s %12s %12s %9s" % ("benchmark", "metric", "base", "new",
+        "change")
+    for (name, metric, old_value, new_value, change, flag) in rows:
+        print "%-32s %-8s %12s %12s %+8.1f%% %s" % (name, metric, old_value,
+            new_value, change, flag)
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import argparse
+import common
+import errno
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+import timeit
+
+"""
+End-to-end load generator for the DNS server.
+
+Starts a stub upstream and a dnsfilter server on loopback, fires UDP and TCP
+queries at the server with a fixed number of queries in flight, and reports
+the throughput and latency percentiles. Nothing leaves the machine.
+"""
+
+_HEADER = struct.Struct("!HHHHHH")
+_QUESTION = struct.Struct("!HH")
+_LENGTH = struct.Struct("!H")
+
+# The response codes that mean the server could not answer
+_ERROR_RCODES = [ 1, 2, 4, 5 ]
+
+def encode_query(id, name, type=1):
+    """
+    Encode a recursive query for name.
+    """
+    labels = []
+    for label in name.split("."):
+        labels.append(struct.pack("B", len(label)) + label.encode("ascii"))
+    return _HEADER.pack(id, 0x0100, 1, 0, 0, 0) + b"".join(labels) + \
+        b"\0" + _QUESTION.pack(type, 1)
+
+def decode_response(data):
+    """
+    Get the id and response code of a response.
+    """
+    (id, flags) = struct.unpack_from("!HH", data)
+    return (id, flags & 0xf)
+
+class Names(object):
+    """
+    The names to query, either cycling through a fixed set or a new name
+    for every query.
+    """
+
+    def __init__(self, count, unique=False):
+        self.count = count
+        self.unique = unique
+        self.next = 0
+
+    def get(self):
+        i = self.next
+        self.next += 1
+        if not self.unique:
+            i = i % self.count
+        return "host%d.bench.test" % i
+
+class Load(object):
+    """
+    The latencies and errors seen while generating load.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.started = None
+        self.ended = None
+
+    def summarize(self):
+        return common.summarize(self.latencies, self.ended - self.started,
+            self.errors)
+
+def run_udp(addr, names, concurrency, duration, timeout):
+    """
+    Keep concurrency UDP queries in flight for duration seconds.
+    """
+    timer = timeit.default_timer
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.connect(addr)
+    sock.setblocking(False)
+
+    load = Load()
+    pending = {}
+    next_id = 0
+    load.started = timer()
+    end = load.started + duration
+
+    while True:
+        now = timer()
+        if now >= end:
+            break
+
+        while len(pending) < concurrency:
+            next_id = (next_id + 1) & 0xffff
+            if next_id in pending:
+                break
+            try:
+                sock.send(encode_query(next_id, names.get()))
+            except socket.error as e:
+                if e.errno not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                    raise
+                break
+            pending[next_id] = timer()
+
+        select.select([ sock ], [], [], 0.01)
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.error as e:
+                if e.errno not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                    raise
+                break
+            (id, rcode) = decode_response(data)
+            sent = pending.pop(id, None)
+            if sent is None:
+                continue
+            if rcode in _ERROR_RCODES:
+                load.errors += 1
+            else:
+                load.latencies.append(timer() - sent)
+
+        # Give up on lost queries
+        now = timer()
+        for (id, sent) in list(pending.items()):
+            if now - sent > timeout:
+                del pending[id]
+                load.errors += 1
+
+    load.ended = timer()
+    sock.close()
+    return load
+
+class _Connection(object):
+
+    def __init__(self, addr):
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b""
+        self.sent = None
+
+    def send(self, id, name):
+        query = encode_query(id, name)
+        self.sock.sendall(_LENGTH.pack(len(query)) + query)
+        self.sent = timeit.default_timer()
+
+    def read(self):
+        """
+        Read from the socket, returning a response if one is complete.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            raise Exception("Connection closed by the server")
+        self.buffer += data
+        if len(self.buffer) < _LENGTH.size:
+            return None
+        length = _LENGTH.unpack_from(self.buffer)[0]
+        if len(self.buffer) < _LENGTH.size + length:
+            return None
+        response = self.buffer[_LENGTH.size:_LENGTH.size + length]
+        self.buffer = self.buffer[_LENGTH.size + length:]
+        return response
+
+def run_tcp(addr, names, concurrency, duration, timeout):
+    """
+    Keep one query in flight on each of concurrency TCP connections for
+    duration seconds.
+    """
+    timer = timeit.default_timer
+    connections = {}
+    for i in range(concurrency):
+        connection = _Connection(addr)
+        connections[connection.sock.fileno()] = connection
+
+    load = Load()
+    next_id = 0
+    load.started = timer()
+    end = load.started + duration
+
+    for connection in connections.values():
+        next_id = (next_id + 1) & 0xffff
+        connection.send(next_id, names.get())
+
+    while timer() < end:
+        (readable, _, _) = select.select(list(connections.keys()), [], [],
+            0.01)
+        for fd in readable:
+            connection = connections[fd]
+            response = connection.read()
+            if response is None:
+                continue
+
+            (id, rcode) = decode_response(response)
+            if rcode in _ERROR_RCODES:
+                load.errors += 1
+            else:
+                load.latencies.append(timer() - connection.sent)
+
+            next_id = (next_id + 1) & 0xffff
+            connection.send(next_id, names.get())
+
+        # Replace connections whose query was lost
+        now = timer()
+        for (fd, connection) in list(connections.items()):
+            if now - connection.sent > timeout:
+                load.errors += 1
+                connection.sock.close()
+                del connections[fd]
+                connection = _Connection(addr)
+                connections[connection.sock.fileno()] = connection
+                next_id = (next_id + 1) & 0xffff
+                connection.send(next_id, names.get())
+
+    load.ended = timer()
+    for connection in connections.values():
+        connection.sock.close()
+    return load
+
+def _get_free_port(addr):
+    """
+    Find a port that is free for both UDP and TCP.
+    """
+    while True:
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.bind((addr, 0))
+        port = udp_sock.getsockname()[1]
+        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            tcp_sock.bind((addr, port))
+            return port
+        except socket.error:
+            continue
+        finally:
+            udp_sock.close()
+            tcp_sock.close()
+
+def start_upstream(args, drop=0):
+    """
+    Start a stub upstream, returning the process and its port.
+    """
+    process = subprocess.Popen([ sys.executable,
+        os.path.join(common.BENCHMARKS_DIR, "stub_upstream.py"),
+        "--addr", args.addr, "--delay", str(args.upstream_delay / 1000.0),
+        "--drop", str(drop) ], stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if not line:
+        raise Exception("Stub upstream failed to start")
+    return (process, int(line))
+
+def start_server(args, upstream_ports):
+    """
+    Start the DNS server, returning the process and its port once it
+    answers queries.
+    """
+    port = _get_free_port(args.addr)
+    command = [ sys.executable,
+        os.path.join(common.DNSFILTER_DIR, "server.py"),
+        "--addr", args.addr, "--port", str(port),
+        "--storage-url", args.storage_url,
+        "--workers", str(args.workers), "--quiet" ]
+    for upstream_port in upstream_ports:
+        command += [ "--upstream", "%s:%d" % (args.addr, upstream_port) ]
+    command += args.server_arg
+    process = subprocess.Popen(command)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    deadline = time.time() + args.start_timeout
+    try:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise Exception("Server exited with %d" % process.returncode)
+            try:
+                sock.sendto(encode_query(1, "ready.bench.test"),
+                    (args.addr, port))
+                sock.recv(4096)
+                return (process, port)
+            except socket.error:
+                continue
+    finally:
+        sock.close()
+
+    process.terminate()
+    raise Exception("Server did not answer within %d seconds" %
+        args.start_timeout)
+
+def _stop(process):
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+
+def run(args):
+    processes = []
+    try:
+        upstream_ports = []
+        if args.degraded_upstream_drop:
+            (upstream, upstream_port) = start_upstream(args,
+                args.degraded_upstream_drop)
+            processes.append(upstream)
+            upstream_ports.append(upstream_port)
+        (upstream, upstream_port) = start_upstream(args)
+        processes.append(upstream)
+        upstream_ports.append(upstream_port)
+        (server, port) = start_server(args, upstream_ports)
+        processes.append(server)
+
+        addr = (args.addr, port)
+        results = {}
+        for protocol in [ "udp", "tcp" ]:
+            if args.protocol not in [ protocol, "both" ]:
+                continue
+            run_load = run_udp if protocol == "udp" else run_tcp
+
+            names = Names(args.names, args.unique)
+            if args.warmup:
+                run_load(addr, names, args.concurrency, args.warmup,
+                    args.timeout)
+            load = run_load(addr, names, args.concurrency, args.duration,
+                args.timeout)
+            results[protocol] = load.summarize()
+        return results
+    finally:
+        for process in reversed(processes):
+            _stop(process)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the end-to-end DNS server benchmark")
+    parser.add_argument("--addr", type=str, default="127.0.0.1",
+        help="Loopback address to run the servers on")
+    parser.add_argument("--protocol", type=str, default="both",
+        choices=[ "udp", "tcp", "both" ], help="Protocols to benchmark")
+    parser.add_argument("--duration", type=float, default=10,
+        help="Seconds to generate load for, per protocol")
+    parser.add_argument("--warmup", type=float, default=2,
+        help="Seconds of load to generate before measuring")
+    parser.add_argument("--concurrency", type=int, default=32,
+        help="Number of queries in flight (TCP connections for tcp)")
+    parser.add_argument("--names", type=int, default=1000,
+        help="Number of distinct names to query")
+    parser.add_argument("--unique", action="store_true", default=False,
+        help="Query a new name every time, so no answer is cached")
+    parser.add_argument("--timeout", type=float, default=2,
+        help="Seconds before an unanswered query counts as an error")
+    parser.add_argument("--upstream-delay", type=float, default=0,
+        help="Milliseconds the stub upstream waits before answering")
+    parser.add_argument("--degraded-upstream-drop", type=float, default=0,
+        help="Also start a stub upstream that ignores this fraction of the "
+             "queries, listed first (0 disables it)")
+    parser.add_argument("--storage-url", type=str,
+        default="memory:e2e-benchmark", help="Storage url for the server")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of server worker processes")
+    parser.add_argument("--server-arg", type=str, action="append",
+        default=[], help="Extra argument for the server, may be repeated "
+             "(e.g. --server-arg=--block-mode=nodata)")
+    parser.add_argument("--start-timeout", type=int, default=30,
+        help="Seconds to wait for the server to start")
+    parser.add_argument("--output", type=str, default=None,
+        help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    common.print_results(results)
+    if args.output:
+        common.write_results(args.output, "e2e", args, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import argparse
+import common
+import random
+import timeit
+
+import filters
+import storage
+from twisted.names import dns
+
+"""
+Microbenchmarks of the filters on the query path.
+
+The filters run against an in-process memory: store, so no database or
+network is needed. Every operation is timed on its own, so the latency
+percentiles include the timer overhead (well under a microsecond).
+"""
+
+_STORAGE_URL = "memory:micro-benchmark"
+
+_FILTERED_DEVICE = "10.0.0.1"
+_UNFILTERED_DEVICE = "10.0.0.2"
+
+def _seed_store(site_count):
+    """
+    Fill the store with site_count trusted sites and a filtered and an
+    unfiltered device. Returns the list of trusted sites.
+    """
+    sites = [ "site%d.example%d.com" % (i, i % 100) for i in range(site_count) ]
+    store = storage.create_store(_STORAGE_URL, storage.TRUSTED_SITES_STORE)
+    store.create_all([ (site, {}) for site in sites ])
+
+    store = storage.create_store(_STORAGE_URL, storage.KNOWN_DEVICES_STORE)
+    store.create_all([
+        (_FILTERED_DEVICE, { "device_addr": _FILTERED_DEVICE,
+            "is_filtered": True }),
+        (_UNFILTERED_DEVICE, { "device_addr": _UNFILTERED_DEVICE,
+            "is_filtered": False })
+    ])
+    return sites
+
+def _make_queries(sites, device, count, allowed_ratio):
+    """
+    Build a shuffled list of queries, allowed_ratio of which are for
+    subdomains of trusted sites.
+    """
+    queries = []
+    for i in range(count):
+        if random.random() < allowed_ratio:
+            name = "www."+random.choice(sites)
+        else:
+            name = "www.blocked%d.example.net" % i
+        query = dns.Query(name, dns.A)
+        query.device_addr = device
+        queries.append(query)
+    return queries
+
+def _run(filter, queries, duration):
+    """
+    Run the filter over the queries, round robin, for duration seconds.
+    """
+    timer = timeit.default_timer
+    latencies = []
+    do_filter = filter.do_filter
+
+    # Warm up
+    for query in queries[:1000]:
+        do_filter(query)
+
+    started = timer()
+    end = started + duration
+    now = started
+    while now < end:
+        for query in queries:
+            before = timer()
+            do_filter(query)
+            now = timer()
+            latencies.append(now - before)
+        now = timer()
+    return common.summarize(latencies, now - started)
+
+def run(args):
+    random.seed(args.seed)
+    sites = _seed_store(args.sites)
+
+    whitelist_filter = filters.WhitelistedSiteFilter(_STORAGE_URL,
+        refresh_interval=0)
+    chain = filters.FilterChain([ whitelist_filter ])
+    acl_filter = filters.DeviceACLFilter([ whitelist_filter ], _STORAGE_URL,
+        refresh_interval=0)
+
+    filtered = _make_queries(sites, _FILTERED_DEVICE, args.queries,
+        args.allowed_ratio)
+    unfiltered = _make_queries(sites, _UNFILTERED_DEVICE, args.queries,
+        args.allowed_ratio)
+
+    benchmarks = [
+        ("whitelisted_site_filter", whitelist_filter, filtered),
+        ("filter_chain", chain, filtered),
+        ("device_acl_filter.filtered", acl_filter, filtered),
+        ("device_acl_filter.unfiltered", acl_filter, unfiltered)
+    ]
+
+    results = {}
+    for (name, filter, queries) in benchmarks:
+        if args.only and args.only not in name:
+            continue
+        results[name] = _run(filter, queries, args.duration)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the filter microbenchmarks")
+    parser.add_argument("--sites", type=int, default=10000,
+        help="Number of trusted sites in the whitelist")
+    parser.add_argument("--queries", type=int, default=10000,
+        help="Number of distinct queries to run")
+    parser.add_argument("--allowed-ratio", type=float, default=0.5,
+        help="Fraction of the queries that are for trusted sites")
+    parser.add_argument("--duration", type=float, default=2,
+        help="Seconds to run each benchmark for")
+    parser.add_argument("--seed", type=int, default=1,
+        help="Random seed used to build the queries")
+    parser.add_argument("--only", type=str, default=None,
+        help="Only run the benchmarks whose name contains this")
+    parser.add_argument("--output", type=str, default=None,
+        help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    common.print_results(results)
+    if args.output:
+        common.write_results(args.output, "micro", args, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import argparse
+import random
+import sys
+from twisted.internet import defer, reactor, task
+from twisted.names import common, dns, server
+
+"""
+A stub upstream DNS server for the end-to-end benchmarks.
+
+It answers every A query with the same address and every other query with
+an empty answer, optionally after a fixed delay, and prints the port it is
+listening on once it is ready. It can also ignore a share of the queries,
+to act as a degraded upstream.
+"""
+
+class StubResolver(common.ResolverBase):
+    """
+    A resolver that answers every query itself.
+    """
+
+    def __init__(self, addr="127.0.0.1", ttl=300, delay=0, drop=0):
+        common.ResolverBase.__init__(self)
+        self.addr = addr
+        self.ttl = ttl
+        self.delay = delay
+        self.drop = drop
+
+    def _answer(self, name, type):
+        answers = []
+        if type == dns.A:
+            answers.append(dns.RRHeader(name, dns.A, dns.IN, self.ttl,
+                dns.Record_A(self.addr, self.ttl)))
+        return (answers, [], [])
+
+    def _lookup(self, name, cls, type, timeout):
+        if self.drop and random.random() < self.drop:
+            # Never answer
+            return defer.Deferred()
+        if self.delay:
+            return task.deferLater(reactor, self.delay, self._answer, name,
+                type)
+        return defer.succeed(self._answer(name, type))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stub DNS server")
+    parser.add_argument("--addr", type=str, default="127.0.0.1",
+        help="IP address to listen on")
+    parser.add_argument("--port", type=int, default=0,
+        help="Port to listen on (0 picks a free port)")
+    parser.add_argument("--ttl", type=int, default=300,
+        help="TTL of the answers")
+    parser.add_argument("--delay", type=float, default=0,
+        help="Seconds to wait before answering")
+    parser.add_argument("--drop", type=float, default=0,
+        help="Fraction of the queries to never answer")
+    args = parser.parse_args()
+
+    factory = server.DNSServerFactory(
+        clients=[ StubResolver(ttl=args.ttl, delay=args.delay,
+            drop=args.drop) ])
+    protocol = dns.DNSDatagramProtocol(controller=factory)
+
+    udp_port = reactor.listenUDP(args.port, protocol, args.addr)
+    port = udp_port.getHost().port
+    reactor.listenTCP(port, factory, 50, args.addr)
+
+    sys.stdout.write("%d\n" % port)
+    sys.stdout.flush()
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
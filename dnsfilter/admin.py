@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import logging
+import metrics
+from twisted.web import http, resource, server
+
+"""
+Module containing the admin interface served by the DNS server.
+"""
+
+_LOG = logging.getLogger("dnsfilter.admin")
+
+class AdminResource(resource.Resource):
+    """
+    The root of the admin interface. If a reload function is given it is
+    served as POST /reload.
+    """
+
+    def __init__(self, reload=None):
+        resource.Resource.__init__(self)
+        self.putChild(b"metrics", MetricsResource())
+        if reload:
+            self.putChild(b"reload", ReloadResource(reload))
+
+class MetricsResource(resource.Resource):
+    """
+    Serves the metrics in the Prometheus text format.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=metrics.REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        return self.registry.render().encode("utf-8")
+
+class ReloadResource(resource.Resource):
+    """
+    Reloads the server's configuration. The response is sent once the reload
+    has finished.
+    """
+
+    isLeaf = True
+
+    def __init__(self, reload):
+        resource.Resource.__init__(self)
+        self.reload = reload
+
+    def render_POST(self, request):
+        # The reload carries on if the client goes away, but the response
+        # isn't sent
+        finished = request.notifyFinish()
+        finished.addErrback(lambda failure: None)
+
+        d = self.reload()
+        d.addCallbacks(self._reloaded, self._failed,
+            callbackArgs=(request, finished),
+            errbackArgs=(request, finished))
+        return server.NOT_DONE_YET
+
+    def _reloaded(self, result, request, finished):
+        if not finished.called:
+            request.write(b"DONE\n")
+            request.finish()
+
+    def _failed(self, failure, request, finished):
+        if not finished.called:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.write(("FAILED: "+failure.getErrorMessage()+"\n").encode(
+                "utf-8"))
+            request.finish()
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import collections
+import logging
+import time
+
+"""
+Module containing the cache components.
+"""
+
+_LOG = logging.getLogger("dnsfilter.caches")
+
+class LRUCache(object):
+    """
+    A bounded cache that evicts the least recently used entries, and
+    expires entries ttl seconds after they were set.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Get the value for key, or default if it isn't cached.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[1] < time.time():
+            self.misses += 1
+            return default
+
+        # Re-insert to mark the entry as most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        """
+        Cache value for key.
+        """
+        entries = self.entries
+        entries.pop(key, None)
+        while len(entries) >= self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+        entries[key] = (value, time.time() + self.ttl)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+class VerdictCache(object):
+    """
+    A cache of filter verdicts keyed on device address and query name.
+
+    Invalidation is O(1): each invalidation takes the next number of a
+    sequence, and entries stamped before the last invalidation of their
+    device or of the whole cache are treated as misses and left for the LRU
+    to evict. A device's invalidation is forgotten once it is older than the
+    ttl, as every entry stamped before it has expired by then, so only the
+    devices invalidated in the last ttl seconds are remembered.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.cache = LRUCache(max_size, ttl)
+        self.sequence = 0
+        self.generation = 0
+
+        # The (sequence, time) of the last invalidation of each device,
+        # oldest first
+        self.device_generations = collections.OrderedDict()
+
+    def stamp(self, device):
+        """
+        Get the current generation stamp for a device. Take the stamp before
+        computing a verdict and pass it to set().
+        """
+        return self.sequence
+
+    def _is_current(self, device, stamp):
+        if stamp < self.generation:
+            return False
+        invalidated = self.device_generations.get(device)
+        return invalidated is None or stamp >= invalidated[0]
+
+    def get(self, device, name):
+        """
+        Get the cached verdict for a device and name, or None.
+        """
+        entry = self.cache.get((device, name))
+        if entry is None:
+            return None
+
+        (allowed, stamp) = entry
+        if not self._is_current(device, stamp):
+            self.cache.hits -= 1
+            self.cache.misses += 1
+            return None
+        return allowed
+
+    def set(self, device, name, allowed, stamp):
+        if self._is_current(device, stamp):
+            self.cache.set((device, name), (allowed, stamp))
+
+    def invalidate(self, device=None):
+        """
+        Invalidate the verdicts for a device, or every verdict if device is
+        None.
+        """
+        self.sequence += 1
+        if device is None:
+            _LOG.debug("Invalidating all verdicts")
+            self.generation = self.sequence
+            self.device_generations.clear()
+            return
+
+        _LOG.debug("Invalidating verdicts for %s", device)
+        now = time.time()
+        generations = self.device_generations
+        generations.pop(device, None)
+        generations[device] = (self.sequence, now)
+
+        # Forget the invalidations older than every cached entry
+        while True:
+            oldest = next(iter(generations))
+            if generations[oldest][1] + self.cache.ttl >= now:
+                break
+            del generations[oldest]
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+class AnswerCache(object):
+    """
+    A bounded cache of DNS answers that evicts the least recently used
+    entries.
+
+    Each entry expires with the TTL it was set with, and is then kept stale
+    for up to max_stale seconds more, so it can still be served if the
+    answer can't be refreshed.
+    """
+
+    def __init__(self, max_size=10000, max_stale=0):
+        self.max_size = max_size
+        self.max_stale = max_stale
+        self.entries = collections.OrderedDict()
+
+        # Counters
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now=None):
+        """
+        Get the (result, ttl, expires) entry for key, which may have
+        expired, or None if there is no entry or it is too stale to serve.
+        """
+        if now is None:
+            now = time.time()
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[2] + self.max_stale < now:
+            return None
+
+        # Re-insert to mark the entry as most recently used
+        self.entries[key] = entry
+        return entry
+
+    def set(self, key, result, ttl, now=None):
+        """
+        Cache the result for key for ttl seconds.
+        """
+        if now is None:
+            now = time.time()
+        entries = self.entries
+        entries.pop(key, None)
+        while len(entries) >= self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+        entries[key] = (result, ttl, now + ttl)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
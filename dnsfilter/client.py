@@ -16,10 +16,18 @@
 import argparse
 import datetime
 import filters
+import json
 import logging
+import os
+import querylog
+import rollups
+import select
+import shlex
 import storage
+import sys
 import whitelists
 import utils
+from bson import json_util
 
 """
 Module containing the client-side utilities for dnsfilter servers.
@@ -27,144 +35,415 @@ Module containing the client-side utilities for dnsfilter servers.
 
 _LOG = logging.getLogger("dnsfilter.clients")
 
+# The most consecutive batch lines of one command merged into a single call
+BATCH_SIZE = 1000
+
+# The commands whose args are independent items, so consecutive batch lines
+# can be merged into one bulk call
+_BULK_CMDS = [ "add-trusted-sites", "delete-trusted-sites", "add-devices",
+    "delete-devices" ]
+
 def _init(args):
     utils.init_logging(None, args.debug, args.quiet, args.logfile)
 
-def _add_trusted_sites(sites, url):
-    # Get a whitelist object
-    whitelist = whitelists.load(url)
+class Session(object):
+    """
+    The stores and whitelist used by the client commands for a storage url,
+    opened once and shared by every command run with the session. Results
+    are reported as log messages, or written to stdout as they happen when
+    stream is set (as JSON objects if json is set).
+    """
+
+    def __init__(self, url, stream=False):
+        self.url = url
+        self.stream = stream
+        self.json = False
+        self.stores = {}
+        self.whitelist = None
+
+    def get_store(self, name):
+        if name not in self.stores:
+            self.stores[name] = storage.create_store(self.url, name)
+        return self.stores[name]
+
+    def get_whitelist(self):
+        if self.whitelist is None:
+            self.whitelist = whitelists.load(self.url)
+        return self.whitelist
+
+    def write(self, text, **record):
+        """
+        Write a result line, as the text or as a JSON object of the record.
+        """
+        if self.json:
+            print json.dumps(record, default=json_util.default)
+        else:
+            print text
+
+    def report(self, cmd, item, result, message, level=logging.INFO):
+        """
+        Report the result of a command for one item.
+        """
+        if self.stream:
+            self.write(result+" "+item, cmd=cmd, item=item, result=result)
+        else:
+            _LOG.log(level, message, item)
+
+def _add_trusted_sites(sites, session):
+    whitelist = session.get_whitelist()
+    existing = whitelist.contains_all(sites)
+
+    added = _unique(site for site in sites if site not in existing)
+    whitelist.add_all(added)
 
     for site in sites:
-        if whitelist.contains(site):
-            _LOG.info("Site %s already in whitelist", site)
+        if site in existing:
+            session.report("add-trusted-sites", site, "exists",
+                "Site %s already in whitelist")
         else:
-            whitelist.add(site)
-            _LOG.info("Added site %s", site)
+            session.report("add-trusted-sites", site, "added",
+                "Added site %s")
+            existing.add(site)
+
+def _delete_trusted_sites(sites, session):
+    whitelist = session.get_whitelist()
+    existing = whitelist.contains_all(sites)
 
-def _delete_trusted_sites(sites, url):
-    # Get a whitelist object
-    whitelist = whitelists.load(url)
+    whitelist.delete_all(_unique(site for site in sites if site in existing))
 
     for site in sites:
-        if whitelist.contains(site):
-            whitelist.delete(site)
-            _LOG.info("Deleted site %s", site)
+        if site in existing:
+            session.report("delete-trusted-sites", site, "deleted",
+                "Deleted site %s")
+            existing.discard(site)
         else:
-            _LOG.info("Site %s is not in whitelist", site)
+            session.report("delete-trusted-sites", site, "missing",
+                "Site %s is not in whitelist")
 
-def _get_trusted_sites(sites, url):
-    # Get a whitelist object
-    whitelist = whitelists.load(url)
+def _get_trusted_sites(sites, session):
+    whitelist = session.get_whitelist()
 
     trusted_sites = []
     
     if not sites:
         trusted_sites = whitelist.get_all()
     else:
-        for site in sites:
-            if whitelist.contains(site):
-                trusted_sites.append(site)
+        existing = whitelist.contains_all(sites)
+        trusted_sites = [ site for site in sites if site in existing ]
     
     for site in trusted_sites:
-        print site
+        session.write(site, site=site)
 
-def _add_devices(devices, url):
-    store = storage.create_store(url, storage.KNOWN_DEVICES_STORE)
+def _compile_trusted_sites(args, session):
+    path = args[0]
+    if len(args) > 1:
+        url = args[1]
+        whitelist = whitelists.load(url)
+    else:
+        url = session.url
+        whitelist = session.get_whitelist()
+
+    whitelists.compile_snapshot(whitelist, path)
+    _LOG.info("Compiled trusted sites from %s into %s", url, path)
+
+def _add_devices(devices, session):
+    store = session.get_store(storage.KNOWN_DEVICES_STORE)
+    existing = set(store.read_all(devices).keys())
+
+    now = datetime.datetime.utcnow()
+    user = utils.get_current_user()
+    store.create_all([ (device, {
+            "display_name": device+" (unidentified device)",
+            "device_addr": device,
+            "date_added": now,
+            "is_filtered": False,
+            "added_by": user
+        }) for device in _unique(devices) if device not in existing ])
 
     for device in devices:
-        if store.find({"name": device}):
-            _LOG.warning("device %s already in filtered devices list", device)
+        if device in existing:
+            session.report("add-devices", device, "exists",
+                "device %s already in filtered devices list",
+                level=logging.WARNING)
         else:
-            device_info = {
-                "display_name": device+" (unidentified device)",
-                "device_addr": device,
-                "date_added": datetime.datetime.utcnow(), 
-                "is_filtered": False,
-                "added_by": utils.get_current_user()
-            }
-            store.create(device, device_info)
-            _LOG.info("Added %s to filtered devices list", device)
-
-def _delete_devices(devices, url):
-    store = storage.create_store(url, storage.KNOWN_DEVICES_STORE)
+            session.report("add-devices", device, "added",
+                "Added %s to filtered devices list")
+            existing.add(device)
+
+def _delete_devices(devices, session):
+    store = session.get_store(storage.KNOWN_DEVICES_STORE)
+    existing = set(store.read_all(devices).keys())
+
+    store.delete_all(list(existing))
 
     for device in devices:
-        if store.find({"name": device}):
-            store.delete(device)
-            _LOG.info("Deleted %s from filtered devices list", device)
+        if device in existing:
+            session.report("delete-devices", device, "deleted",
+                "Deleted %s from filtered devices list")
+            existing.discard(device)
         else:
-            _LOG.warning("device %s not in filtered devices list", device)
+            session.report("delete-devices", device, "missing",
+                "device %s not in filtered devices list",
+                level=logging.WARNING)
 
-def _get_devices(devices, url):
-    store = storage.create_store(url, storage.KNOWN_DEVICES_STORE)
+def _get_devices(devices, session):
+    store = session.get_store(storage.KNOWN_DEVICES_STORE)
 
     results = []
     if not devices:
         results = store.find()
     else:
-        for device in devices:
-            result = store.read(device)
-            _LOG.debug("Found device %s : %s", device, result)
-            if result:
-                results.append(result)
+        found = store.read_all(devices)
+        _LOG.debug("Found devices %s", found)
+        results = [ found[device] for device in devices if device in found ]
 
     for result in results:
-        print result["name"]+" filtered="+str(result["is_filtered"])
+        session.write(result["name"]+" filtered="+str(result["is_filtered"]),
+            device=result["name"], is_filtered=result["is_filtered"])
 
-def _set_device_name(args, url):
+def _set_device_name(args, session):
     device = args[0]
     name = args[1]
-    store = storage.create_store(url, storage.KNOWN_DEVICES_STORE)
+    store = session.get_store(storage.KNOWN_DEVICES_STORE)
 
     result = store.read(device)
     if not result:
-        _LOG.warning("Device %s is not found", device)
+        session.report("set-device-name", device, "missing",
+            "Device %s is not found", level=logging.WARNING)
     else:
         result.set("display_name", name)
         store.update(device, result.properties)
+        session.report("set-device-name", device, "updated",
+            "Renamed device %s")
 
-def _show_logs(args, url):
-    if args:
-        device = args[0]
-    else:
-        device = None
+def _unique(items):
+    """
+    Get the items without duplicates, in their original order.
+    """
+    seen = set()
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
 
-    store = storage.create_store(url, storage.REQUEST_LOG_STORE)
+def _get_report_options(args, options):
+    """
+    Parse key=value report args into the options. An arg without a key is
+    the device.
+    """
+    for arg in args:
+        if "=" in arg:
+            (key, value) = arg.split("=", 1)
+        else:
+            (key, value) = ("device", arg)
 
-    if not device:
-        results = store.find()
-    else:
-        results = store.find({ "device": device })
+        if key in [ "since", "until" ]:
+            options[key] = querylog.parse_time(value)
+        elif key in [ "limit", "interval" ]:
+            options[key] = int(value)
+        elif key == "group_by":
+            options[key] = value.split(",")
+        elif key in options:
+            options[key] = value
+        else:
+            raise Exception("Unknown report argument : "+arg)
+    return options
+
+def _show_logs(args, session):
+    """
+    Show the recorded lookups, or a report of them. The args are an optional
+    device followed by any of since=TIME, until=TIME, device=DEVICE,
+    limit=N, view=VIEW and interval=SECONDS (for the rate view).
+    """
+    options = _get_report_options(args, { "view": querylog.RAW_VIEW,
+        "device": None, "limit": 0, "interval": 60 })
+
+    store = session.get_store(storage.REQUEST_LOG_STORE)
+
+    for row in querylog.get_report(store, **options):
+        session.write(querylog.format_row(row), **row)
+
+def _show_rollups(args, session):
+    """
+    Show the lookup counts from the rollups. The args are an optional device
+    followed by any of since=TIME, until=TIME, device=DEVICE,
+    verdict=allowed|blocked, group_by=FIELD[,FIELD...], limit=N and
+    interval=SECONDS (to count over time).
+    """
+    options = _get_report_options(args, { "group_by": [ "domain" ],
+        "device": None, "verdict": None, "limit": 0, "interval": None })
+
+    store = session.get_store(storage.REQUEST_ROLLUP_STORE)
+
+    for row in rollups.get_rollups(store, **options):
+        session.write(querylog.format_row(row), **row)
+
+def _read_query_log(paths, session):
+    for path in paths:
+        for record in querylog.read_log(path):
+            print json.dumps(record)
 
 _CMDS = {
     "add-trusted-sites": _add_trusted_sites,
     "delete-trusted-sites": _delete_trusted_sites,
     "get-trusted-sites": _get_trusted_sites,
+    "compile-trusted-sites": _compile_trusted_sites,
 
     "add-devices": _add_devices,
     "delete-devices": _delete_devices,
     "get-devices": _get_devices,
     "set-device-name": _set_device_name,
 
-    "show-logs": _show_logs
+    "show-logs": _show_logs,
+    "show-rollups": _show_rollups,
+    "read-query-log": _read_query_log
 }
 
+def _parse_batch_line(line):
+    """
+    Parse a batch line into a (cmd, args, is_json) tuple, or None for blank
+    and comment lines. Lines are either NDJSON objects with cmd and args
+    keys, or a command followed by its args as they'd be typed in a shell.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+
+    if line.startswith("{"):
+        cmd = json.loads(line)
+        args = cmd.get("args", [])
+        if isinstance(args, basestring):
+            args = [ args ]
+        return (cmd.get("cmd"), [ str(arg) for arg in args ], True)
+
+    words = shlex.split(line)
+    return (words[0], words[1:], False)
+
+def _read_batch_lines(f):
+    """
+    Iterate over the lines of a batch file, yielding None whenever all the
+    input that is ready has been read, before waiting for more.
+    """
+    fd = f.fileno()
+    buf = ""
+    while True:
+        if not select.select([ fd ], [], [], 0)[0]:
+            yield None
+        data = os.read(fd, 65536)
+        if not data:
+            break
+
+        lines = (buf+data).split("\n")
+        buf = lines.pop()
+        for line in lines:
+            yield line
+
+    if buf:
+        yield buf
+
+def _get_batch_cmds(lines):
+    """
+    Parse the batch lines into (cmd, args, is_json) tuples, merging the args
+    of consecutive lines for the same bulk command. A None in the lines
+    means no more input is ready, so a merged command is yielded rather
+    than held while waiting for the next line, and results stream while the
+    input is still open. Invalid lines are yielded with a cmd of None and
+    the error as the args.
+    """
+    pending = None
+    for line in lines:
+        if line is None:
+            if pending:
+                yield pending
+                pending = None
+            continue
+
+        try:
+            cmd = _parse_batch_line(line)
+        except ValueError as e:
+            if pending:
+                yield pending
+                pending = None
+            yield (None, [ "Invalid batch line : "+str(e) ],
+                line.lstrip().startswith("{"))
+            continue
+        if cmd is None:
+            continue
+
+        if pending and pending[0] == cmd[0] and pending[2] == cmd[2] and \
+                cmd[0] in _BULK_CMDS and len(pending[1]) < BATCH_SIZE:
+            pending[1].extend(cmd[1])
+            continue
+
+        if pending:
+            yield pending
+        pending = cmd
+        if cmd[0] not in _BULK_CMDS:
+            yield pending
+            pending = None
+
+    if pending:
+        yield pending
+
+def run_batch(path, session):
+    """
+    Run the commands read from path (or stdin for -) with one session,
+    writing each result as it happens. Returns the number of commands that
+    failed.
+    """
+    session.stream = True
+    failed = 0
+    lines = sys.stdin if path == "-" else open(path)
+
+    try:
+        for (cmd, args, is_json) in _get_batch_cmds(_read_batch_lines(lines)):
+            session.json = is_json
+            try:
+                if cmd is None:
+                    raise Exception(args[0])
+                if cmd not in _CMDS:
+                    raise Exception("Unknown cmd "+str(cmd))
+                _CMDS[cmd](args, session)
+            except Exception as e:
+                failed += 1
+                _LOG.debug("Batch command %s failed", cmd, exc_info=True)
+                session.write("error "+str(cmd)+" "+str(e), cmd=cmd,
+                    error=str(e))
+            sys.stdout.flush()
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    return failed
+
 def run_cmd(args):
+    session = Session(args.url)
+    if args.batch:
+        return 1 if run_batch(args.batch, session) else None
+
     if args.cmd in _CMDS:
-        _CMDS[args.cmd](args.args, args.url)
+        _CMDS[args.cmd](args.args, session)
     else:
         _LOG.warning("Unknown cmd %s.", args.cmd)
 
-# Read options from CLI
-parser = utils.init_argparser("Run the dns-filter config client",
-    is_server=False)
-parser.add_argument('--cmd', nargs='?', type=str, default="get-trusted-sites",
-    help="The client command to use")
-parser.add_argument('--args', nargs='+', type=str, default=[], 
-    help="The arguments to pass to command")
-
-args = parser.parse_args()
+def get_parser():
+    """
+    Get the argument parser for the client options.
+    """
+    parser = utils.init_argparser("Run the dns-filter config client",
+        is_server=False)
+    parser.add_argument('--cmd', nargs='?', type=str,
+        default="get-trusted-sites", help="The client command to use")
+    parser.add_argument('--args', nargs='+', type=str, default=[], 
+        help="The arguments to pass to command")
+    parser.add_argument('--batch', type=str, default=None,
+        help="Run the commands read from a file (or - for stdin), one per "
+        "line as shell-style words or NDJSON, over one storage connection")
+    return parser
 
 if __name__ == '__main__':
+    args = get_parser().parse_args()
     _init(args)
     raise SystemExit(run_cmd(args))
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import logging
+import threading
+import time
+
+"""
+Module containing the known devices components.
+"""
+
+_LOG = logging.getLogger("dnsfilter.devices")
+
+class DeviceTable(object):
+    """
+    A resident copy of a known devices store.
+
+    Lookups are served from memory. The table is reloaded by refresh() when
+    the store's version changes, and every full_refresh_interval seconds
+    whatever the version, to pick up changes the version doesn't track (such
+    as documents edited directly in MongoDB). New devices are registered in
+    memory straight away and written to the store in batches by flush().
+    """
+
+    def __init__(self, store, miss_ttl=60, batch_size=100,
+            full_refresh_interval=3600):
+        self.store = store
+        self.miss_ttl = miss_ttl
+        self.batch_size = batch_size
+        self.full_refresh_interval = full_refresh_interval
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.version = None
+        self.loaded = 0
+
+        # Devices waiting to be written to the store
+        self.pending = []
+
+        # Devices registered by this table, and when to stop remembering
+        # them if they haven't shown up in the store
+        self.misses = {}
+
+        self.refresh()
+
+    def get(self, addr):
+        """
+        Get the properties of the device with the provided address, or None
+        if the device is unknown.
+        """
+        return self.devices.get(addr)
+
+    def register(self, addr, device_info):
+        """
+        Add a new device to the table and queue it to be written to the
+        store.
+        """
+        with self.lock:
+            self.devices[addr] = device_info
+            self.misses[addr] = time.time() + self.miss_ttl
+            self.pending.append((addr, device_info))
+        return device_info
+
+    def refresh(self):
+        """
+        Reload the table if the store has changed, or is due a full
+        refresh. Returns the addresses of the devices that were added,
+        changed or removed.
+        """
+        version = self.store.get_version()
+        if version is not None and version == self.version and \
+                time.time() < self.loaded + self.full_refresh_interval:
+            return []
+
+        devices = {}
+        for device in self.store.find():
+            devices[device.name] = device.properties
+
+        with self.lock:
+            # Keep recently registered devices the store doesn't know about
+            # yet, so they aren't registered a second time
+            now = time.time()
+            for (addr, expires) in list(self.misses.items()):
+                if addr in devices or expires < now:
+                    del self.misses[addr]
+                elif addr in self.devices:
+                    devices[addr] = self.devices[addr]
+
+            old_devices = self.devices
+            self.devices = devices
+            self.version = version
+            self.loaded = now
+
+        changed = []
+        for addr in set(old_devices) | set(devices):
+            if old_devices.get(addr) != devices.get(addr):
+                changed.append(addr)
+
+        _LOG.debug("Loaded %d devices, %d changed (version=%s)", len(devices),
+            len(changed), version)
+        return changed
+
+    def flush(self):
+        """
+        Write the newly registered devices to the store in batches.
+        """
+        while self.pending:
+            with self.lock:
+                batch = self.pending[:self.batch_size]
+                self.pending = self.pending[len(batch):]
+
+            _LOG.debug("Writing %d new devices", len(batch))
+            try:
+                self.store.create_all(batch)
+            except Exception:
+                _LOG.exception("Failed to write %d new devices", len(batch))
+                with self.lock:
+                    self.pending = batch + self.pending
+                return
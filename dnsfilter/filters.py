@@ -14,8 +14,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 import datetime
+import devices
 import logging
+import metrics
+import querylog
+import rollups
 import storage
+from twisted.internet import defer, task
 import whitelists
 
 """
@@ -24,47 +29,181 @@ Module containing the filters implementations for the dnsfilter.
 
 _LOG = logging.getLogger("dnsfilter.filters")
 
+def _run_in_background(fn, desc, callback=None):
+    """
+    Run a blocking function in the storage thread pool, logging any failure.
+    The callback is run on the reactor thread with the function's result.
+    """
+    d = storage.defer_to_thread(fn)
+    if callback:
+        d.addCallback(callback)
+    d.addErrback(_log_failure, desc)
+    return d
+
+def _log_failure(failure, desc):
+    _LOG.error("Failed to %s: %s", desc, failure.getErrorMessage())
+
 class Filter(object):
     """
     Base filter interface.
 
     A filter is an object that consumes a query, filters it, and produces
-    another query.
+    another query. A filter may also return a Deferred that fires with the
+    filtered query.
     """
 
     def do_filter(self, query):
          pass
 
+    def start(self):
+        """
+        Start any background work the filter needs (e.g. cache refreshes).
+        """
+        pass
+
+    def stop(self):
+        """
+        Stop any background work started by start(). May return a Deferred
+        that fires when outstanding work is finished.
+        """
+        pass
+
+    def add_listener(self, listener):
+        """
+        Register a callable to be told when the filter's verdicts may have
+        changed. It is called with the address of the device whose verdicts
+        changed, or None if any verdict may have changed.
+        """
+        pass
+
 class FilterChain(Filter):
     """
     An ordered collections of filters.
+
+    The time spent in each filter is recorded in the filter metrics, by
+    filter class and verdict.
     """
 
     def __init__(self, filters):
         self.filters = filters
+        self.timers = []
+        for filter in filters:
+            filter_name = type(filter).__name__
+            self.timers.append((
+                metrics.FILTER_SECONDS.labels(filter_name, "allowed"),
+                metrics.FILTER_SECONDS.labels(filter_name, "blocked")))
 
-    def do_filter(self, query):
-        filtering_query = query
+    def start(self):
+        for filter in self.filters:
+            filter.start()
+
+    def add_listener(self, listener):
         for filter in self.filters:
+            filter.add_listener(listener)
+
+    def stop(self):
+        stopped = []
+        for filter in self.filters:
+            stopped.append(defer.maybeDeferred(filter.stop))
+        return defer.DeferredList(stopped)
+
+    def do_filter(self, query):
+        return self._filter_from(0, query, query)
+
+    def _filter_from(self, index, query, filtering_query):
+        """
+        Run the filters from index onwards. Filters that return a query are
+        chained synchronously; if one returns a Deferred the rest of the
+        chain runs when it fires.
+        """
+        for i in range(index, len(self.filters)):
+            filter = self.filters[i]
+            started = metrics.timer()
             filtering_query = filter.do_filter(query)
 
+            if isinstance(filtering_query, defer.Deferred):
+                return filtering_query.addCallback(self._filter_next, i,
+                    query, started)
+
+            self._observe(i, filtering_query, started)
             if not filtering_query:
                 _LOG.debug("Filter chain broken. Filter %s rejected %s",
                     filter, query)
                 return None
         return filtering_query
 
+    def _observe(self, index, filtering_query, started):
+        (allowed, blocked) = self.timers[index]
+        if filtering_query:
+            allowed.observe_since(started)
+        else:
+            blocked.observe_since(started)
+
+    def _filter_next(self, filtering_query, index, query, started):
+        self._observe(index, filtering_query, started)
+        if not filtering_query:
+            _LOG.debug("Filter chain broken. Filter %s rejected %s",
+                self.filters[index], query)
+            return None
+        return self._filter_from(index + 1, query, filtering_query)
+
 class DeviceACLFilter(FilterChain):
     """
     A filter that allows only named hosts to be filter, all other devices 
     are allowed without filtering
+
+    Devices are looked up in a resident DeviceTable, and new devices are
+    written to the store in the background.
     """
 
-    def __init__(self, filters, storage_url, recorder=None):
+    def __init__(self, filters, storage_url, recorder=None,
+            refresh_interval=30, flush_interval=1, full_refresh_interval=3600):
         FilterChain.__init__(self, filters)
         self.store = storage.create_store(storage_url,
             storage.KNOWN_DEVICES_STORE)
+        self.devices = devices.DeviceTable(self.store,
+            full_refresh_interval=full_refresh_interval)
         self.recorder = recorder
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        self.listeners = []
+        self._refresher = None
+        self._flusher = None
+
+    def add_listener(self, listener):
+        FilterChain.add_listener(self, listener)
+        self.listeners.append(listener)
+
+    def start(self):
+        FilterChain.start(self)
+        if self.refresh_interval and not self._refresher:
+            self._refresher = task.LoopingCall(self._refresh)
+            self._refresher.start(self.refresh_interval, now=False)
+        if not self._flusher:
+            self._flusher = task.LoopingCall(self._flush)
+            self._flusher.start(self.flush_interval, now=False)
+
+    def stop(self):
+        stopped = FilterChain.stop(self)
+        if self._refresher:
+            self._refresher.stop()
+            self._refresher = None
+        if self._flusher:
+            self._flusher.stop()
+            self._flusher = None
+        return defer.DeferredList([ stopped, self._flush() ])
+
+    def _refresh(self):
+        return _run_in_background(self.devices.refresh, "refresh devices",
+            self._devices_changed)
+
+    def _devices_changed(self, changed):
+        for addr in changed:
+            for listener in self.listeners:
+                listener(addr)
+
+    def _flush(self):
+        return _run_in_background(self.devices.flush, "write new devices")
 
     def _add_new_device(self, addr):
         device_info = {
@@ -74,8 +213,7 @@ class DeviceACLFilter(FilterChain):
             "date_added": datetime.datetime.utcnow(),
             "added_by": "dnsfilter_auto"
         }
-        self.store.create(addr, device_info)
-        return device_info
+        return self.devices.register(addr, device_info)
 
     def _is_filtered(self, device_info):
         if "is_filtered" in device_info: 
@@ -87,7 +225,7 @@ class DeviceACLFilter(FilterChain):
         filtering_query = query
 
         device_addr = query.device_addr
-        device_info = self.store.read(device_addr)
+        device_info = self.devices.get(device_addr)
 
         if not device_info:
             device_info = self._add_new_device(device_addr)
@@ -102,23 +240,50 @@ class DeviceACLFilter(FilterChain):
 class WhitelistedSiteFilter(Filter):
     """
     A filter that only allows whitelisted sites to be queried.
+
+    Lookups are served from an in-memory index of the whitelist, which is
+    refreshed every refresh_interval seconds if the whitelist has changed,
+    and reloaded in full every full_refresh_interval seconds.
     """
 
-    def __init__(self, storage_url):
+    def __init__(self, storage_url, refresh_interval=30,
+            full_refresh_interval=3600):
         self.storage_url = storage_url
-        self.whitelist = whitelists.load(storage_url)
+        self.whitelist = whitelists.index(whitelists.load(storage_url),
+            full_refresh_interval)
+        self.refresh_interval = refresh_interval
+        self.listeners = []
+        self._refresher = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        self.whitelist.add_listener(self._whitelist_changed)
+        if self.refresh_interval and not self._refresher:
+            self._refresher = task.LoopingCall(self._refresh)
+            self._refresher.start(self.refresh_interval, now=False)
+
+    def stop(self):
+        self.whitelist.close()
+        if self._refresher:
+            self._refresher.stop()
+            self._refresher = None
+
+    def _refresh(self):
+        return _run_in_background(self.whitelist.refresh, "refresh whitelist",
+            self._whitelist_changed)
+
+    def _whitelist_changed(self, changed=True):
+        if changed:
+            for listener in self.listeners:
+                listener(None)
 
     def _isSiteWhitelisted(self, query):
         """
         Check if the site in the query is whitelisted
         """
-        segments = query.name.name.count('.')
-        for i in range(0, segments):
-            site = query.name.name.split('.', i)[-1]
-            if self.whitelist.contains(site):
-                return True
-
-        return False
+        return self.whitelist.matches(query.name.name)
 
     def do_filter(self, query):
         """
@@ -139,34 +304,166 @@ class FileLoggerFilter(Filter):
     A filter that will record all hostnames it receives to a file.
 
     This is useful when trying to work out which hosts are needed for a
-    site.
+    site. Records are buffered and written by a QueryLogWriter, which also
+    rotates the file.
     """
 
-    def __init__(self, record_file):
-        self.record_file = open(record_file, "write")
+    def __init__(self, record_file, format=querylog.TEXT_FORMAT,
+            max_bytes=0, rotate_interval=0, backups=0):
+        self.writer = querylog.QueryLogWriter(record_file, format,
+            max_bytes=max_bytes, rotate_interval=rotate_interval,
+            backups=backups)
+        self.owns_writer = True
+
+    def start(self):
+        self.writer.start()
+
+    def stop(self):
+        if self.owns_writer:
+            return self.writer.stop()
+
+    def take_over(self, other):
+        """
+        Take over the writer of another started logger of the same file, so
+        only one writer appends to and rotates it. This logger's settings
+        are applied to the writer, and stopping the other logger leaves the
+        writer running.
+        """
+        self.writer.stop()
+        writer = other.writer
+        writer.format = self.writer.format
+        writer.max_bytes = self.writer.max_bytes
+        writer.rotate_interval = self.writer.rotate_interval
+        writer.backups = self.writer.backups
+        self.writer = writer
+        other.owns_writer = False
 
     def do_filter(self, query):
         _LOG.debug("Logging query for %s", query)
-        self.record_file.write("["+str(datetime.datetime.today())+"] ")
-        self.record_file.write(str(query))
-        self.record_file.write("\n")
-        self.record_file.flush()
+        self.writer.write(query.device_addr, query.name.name, query.type,
+            getattr(query, "allowed", None), query)
         return query
 
 class StoreLoggerFilter(Filter):
     """
     A filter that will record all hostnames it receives into a store.
+
+    Records are queued and written in batches by a BatchWriter, without
+    waiting for the writes to be acknowledged. Records older than retention
+    seconds are expired by the store, if it is set.
     """
 
-    def __init__(self, storage_url):
+    def __init__(self, storage_url, max_size=100000, batch_size=1000,
+            flush_interval=1, overflow=storage.BatchWriter.DROP_OLDEST,
+            retention=0):
         self.store = storage.create_store(storage_url,
-            storage.REQUEST_LOG_STORE)
+            storage.REQUEST_LOG_STORE, acknowledged=False)
+        self.store.set_retention(retention)
+        self.writer = storage.BatchWriter(self.store, max_size, batch_size,
+            flush_interval, overflow)
+
+        writer = self.writer
+        metrics.REGISTRY.callback("dnsfilter_records_written_total",
+            "counter", "Query records written to the store",
+            lambda: writer.written)
+        metrics.REGISTRY.callback("dnsfilter_records_dropped_total",
+            "counter", "Query records dropped because the queue was full",
+            lambda: writer.dropped)
+        metrics.REGISTRY.callback("dnsfilter_records_failed_total",
+            "counter", "Query records that failed to be written",
+            lambda: writer.failed)
+        metrics.REGISTRY.callback("dnsfilter_records_queued", "gauge",
+            "Query records waiting to be written", lambda: len(writer.queue))
+
+    def start(self):
+        self.writer.start()
+
+    def stop(self):
+        return self.writer.stop()
 
     def do_filter(self, query):
         _LOG.debug("Logging query for %s", query)
         record = {
             "query": str(query),
+            "domain": query.name.name,
             "time": datetime.datetime.utcnow(),
-            "device": query.device_addr 
+            "device": query.device_addr,
+            "allowed": getattr(query, "allowed", None)
         }
-        store.create(record["time"], record)
+        self.writer.add(record["time"], record)
+        return query
+
+class RollupRecorderFilter(Filter):
+    """
+    A filter that counts the queries it receives into per minute rollups of
+    device, registered domain and verdict.
+
+    The counters are kept in memory and added to the rollup store every
+    flush_interval seconds, so the number of writes grows with the number
+    of distinct rollups rather than with the number of queries. Rollups
+    older than retention seconds are expired by the store, if it is set.
+    """
+
+    def __init__(self, storage_url, flush_interval=10, retention=0):
+        store = storage.create_store(storage_url,
+            storage.REQUEST_ROLLUP_STORE)
+        store.set_retention(retention)
+        self.store = storage.AsyncStore(store)
+        self.counter = rollups.RollupCounter()
+        self.flush_interval = flush_interval
+        self._flusher = None
+
+        # Counters
+        self.counted = 0
+        self.written = 0
+        self.failed = 0
+
+        metrics.REGISTRY.callback("dnsfilter_rollup_queries_total",
+            "counter", "Queries counted into rollups", lambda: self.counted)
+        metrics.REGISTRY.callback("dnsfilter_rollups_written_total",
+            "counter", "Rollup increments written to the store",
+            lambda: self.written)
+        metrics.REGISTRY.callback("dnsfilter_rollups_failed_total",
+            "counter", "Rollup increments that failed to be written",
+            lambda: self.failed)
+        metrics.REGISTRY.callback("dnsfilter_rollups_pending", "gauge",
+            "Rollups waiting to be written", lambda: len(self.counter))
+
+    def start(self):
+        if not self._flusher:
+            self._flusher = task.LoopingCall(self.flush)
+            self._flusher.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self._flusher:
+            self._flusher.stop()
+            self._flusher = None
+        return self.flush()
+
+    def flush(self):
+        """
+        Write the counted rollups. Returns a Deferred that fires when they
+        have been written.
+        """
+        increments = self.counter.take()
+        if not increments:
+            return defer.succeed(None)
+
+        d = self.store.increment_all(increments)
+        d.addCallbacks(self._flushed, self._flush_failed,
+            callbackArgs=(increments,), errbackArgs=(increments,))
+        return d
+
+    def _flushed(self, result, increments):
+        self.written += len(increments)
+
+    def _flush_failed(self, failure, increments):
+        self.failed += len(increments)
+        _LOG.error("Failed to write %d rollups to %s: %s", len(increments),
+            self.store, failure.getErrorMessage())
+
+    def do_filter(self, query):
+        self.counted += 1
+        self.counter.add(query.device_addr, query.name.name,
+            getattr(query, "allowed", None))
+        return query
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import logging
+import re
+import socket
+import sys
+import utils
+import whitelists
+
+"""
+Module containing the streaming importer of domain lists into whitelists.
+"""
+
+_LOG = logging.getLogger("dnsfilter.importers")
+
+AUTO_FORMAT = "auto"
+HOSTS_FORMAT = "hosts"
+LIST_FORMAT = "list"
+ADBLOCK_FORMAT = "adblock"
+FORMATS = [ AUTO_FORMAT, HOSTS_FORMAT, LIST_FORMAT, ADBLOCK_FORMAT ]
+
+# The number of names normalized, deduplicated and written together
+CHUNK_SIZE = 10000
+
+_DOMAIN_RE = re.compile(r"^([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?\.)*"
+    r"[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?$")
+
+# Names in hosts files that are about the local machine, not sites
+_HOSTS_IGNORED = set([ "localhost", "localhost.localdomain", "local",
+    "broadcasthost", "ip6-localhost", "ip6-loopback", "ip6-localnet",
+    "ip6-mcastprefix", "ip6-allnodes", "ip6-allrouters", "ip6-allhosts" ])
+
+def _is_addr(value):
+    # Skip the parsing for the names, which are most of the words
+    if not value[0].isdigit() and ":" not in value:
+        return False
+    for family in [ socket.AF_INET, socket.AF_INET6 ]:
+        try:
+            socket.inet_pton(family, value)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+def _parse_hosts(line):
+    """
+    Get the names of a hosts file line, such as "0.0.0.0 example.com".
+    """
+    words = line.split("#", 1)[0].split()
+    if len(words) < 2 or not _is_addr(words[0]):
+        return None
+    return [ word for word in words[1:]
+        if whitelists.normalize(word) not in _HOSTS_IGNORED and
+        not _is_addr(word) ]
+
+def _parse_list(line):
+    """
+    Get the name of a plain list line, with one name per line.
+    """
+    words = line.split("#", 1)[0].split()
+    if len(words) != 1:
+        return None
+    return words
+
+def _parse_adblock(line):
+    """
+    Get the name of an adblock-style rule that matches a whole domain, such
+    as "||example.com^" or the exception "@@||example.com^". Rules with
+    paths, wildcards or options can't be expressed as a whitelist entry.
+    """
+    line = line.strip()
+    if line.startswith("@@"):
+        line = line[2:]
+    if not line.startswith("||"):
+        return None
+
+    name = line[2:]
+    if name.endswith("^|"):
+        name = name[:-2]
+    elif name.endswith("^"):
+        name = name[:-1]
+    else:
+        return None
+
+    if any(c in name for c in "*/^|$"):
+        return None
+    return [ name ]
+
+def _parse_auto(line):
+    """
+    Get the names of a line in any of the formats.
+    """
+    words = line.split()
+    if words[0].startswith("||") or words[0].startswith("@@"):
+        return _parse_adblock(line)
+    if _is_addr(words[0]):
+        return _parse_hosts(line)
+    return _parse_list(line)
+
+_PARSERS = {
+    AUTO_FORMAT: _parse_auto,
+    HOSTS_FORMAT: _parse_hosts,
+    LIST_FORMAT: _parse_list,
+    ADBLOCK_FORMAT: _parse_adblock
+}
+
+def _is_comment(line):
+    return not line or line[0] in "#!["
+
+def iter_names(lines, format=AUTO_FORMAT, stats=None):
+    """
+    Iterate over the normalized names in the lines of a domain list. Blank
+    and comment lines are skipped, and lines without a valid name are
+    counted as invalid in the stats dict, if one is provided.
+    """
+    if format not in _PARSERS:
+        raise Exception("Unknown list format : "+str(format))
+    parse = _PARSERS[format]
+    if stats is None:
+        stats = {}
+
+    for line in lines:
+        line = line.strip()
+        if _is_comment(line):
+            continue
+
+        stats["lines"] = stats.get("lines", 0) + 1
+        names = parse(line)
+        if names is None:
+            stats["invalid"] = stats.get("invalid", 0) + 1
+            continue
+
+        for name in names:
+            name = whitelists.normalize(name)
+            if len(name) > 253 or not _DOMAIN_RE.match(name):
+                stats["invalid"] = stats.get("invalid", 0) + 1
+                continue
+            yield name
+
+def _iter_chunks(names, chunk_size):
+    """
+    Group the names into lists of up to chunk_size unique names.
+    """
+    chunk = []
+    seen = set()
+    for name in names:
+        if name in seen:
+            continue
+        seen.add(name)
+        chunk.append(name)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+            seen = set()
+    if chunk:
+        yield chunk
+
+def import_names(whitelist, names, replace=False, chunk_size=CHUNK_SIZE,
+        force=False, stats=None):
+    """
+    Add the names to the whitelist in bulk, skipping the ones it already
+    contains. With replace, the entries that aren't in names are deleted
+    afterwards, so only the differences are written. Returns the number of
+    names added, unchanged, deleted and kept as a dict, updating stats if
+    one is provided.
+
+    Every lookup of a name that isn't whitelisted is blocked, so replace
+    only deletes if some names were imported and stats counts no invalid
+    lines, unless force is set. Otherwise the stale entries are kept.
+
+    Only one chunk of names is held in memory at a time, except with
+    replace, which holds the current entries of the whitelist to diff
+    against.
+    """
+    if stats is None:
+        stats = {}
+    stats.update({ "added": 0, "unchanged": 0, "deleted": 0, "kept": 0 })
+
+    current = None
+    stale = None
+    if replace:
+        # Map the normalized names to the entries as stored, which are what
+        # has to be deleted
+        current = {}
+        for entry in whitelist.get_all():
+            current.setdefault(whitelists.normalize(entry), []).append(entry)
+        stale = set(current.keys())
+
+    for chunk in _iter_chunks(names, chunk_size):
+        if replace:
+            existing = set( name for name in chunk if name in current )
+            stale.difference_update(existing)
+        else:
+            existing = whitelist.contains_all(chunk)
+
+        added = [ name for name in chunk if name not in existing ]
+        if added:
+            whitelist.add_all(added)
+            if replace:
+                for name in added:
+                    current[name] = [ name ]
+        stats["added"] += len(added)
+        stats["unchanged"] += len(chunk) - len(added)
+        _LOG.debug("Imported %d names, %d new", len(chunk), len(added))
+
+    if not replace or not stale:
+        return stats
+
+    entries = sorted( entry for name in stale for entry in current[name] )
+    imported = stats["added"] + stats["unchanged"]
+    if not force and (not imported or stats.get("invalid")):
+        _LOG.warning("Not deleting %d stale entries, as %d names were "
+            "imported and %d lines were invalid (force to delete them)",
+            len(entries), imported, stats.get("invalid", 0))
+        stats["kept"] = len(entries)
+        return stats
+
+    for i in range(0, len(entries), chunk_size):
+        whitelist.delete_all(entries[i:i + chunk_size])
+    stats["deleted"] = len(entries)
+    return stats
+
+def import_lists(whitelist, paths, format=AUTO_FORMAT, replace=False,
+        chunk_size=CHUNK_SIZE, force=False):
+    """
+    Import the domain lists in the files at paths (- for stdin) into the
+    whitelist. Returns a dict of the import stats.
+    """
+    stats = { "lines": 0, "invalid": 0 }
+
+    def iter_lines():
+        for path in paths:
+            if path == "-":
+                for line in sys.stdin:
+                    yield line
+                continue
+            with open(path) as f:
+                for line in f:
+                    yield line
+
+    return import_names(whitelist, iter_names(iter_lines(), format, stats),
+        replace, chunk_size, force, stats)
+
+if __name__ == '__main__':
+    parser = utils.init_argparser("Import domain lists into the dns-filter "
+        "trusted sites", is_server=False)
+    parser.add_argument('--format', type=str, default=AUTO_FORMAT,
+        choices=FORMATS, help="The format of the lists: hosts files, plain "
+        "lists of names, adblock-style rules or auto to detect it per line")
+    parser.add_argument('--replace', action="store_true", default=False,
+        help="Delete the trusted sites that aren't in the lists")
+    parser.add_argument('--force', action="store_true", default=False,
+        help="With --replace, delete the trusted sites that aren't in the "
+        "lists even if no names were imported or some lines were invalid")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help="The number of names written in each bulk write")
+    parser.add_argument('paths', nargs='+', type=str,
+        help="The lists to import, or - for stdin")
+    args = parser.parse_args()
+
+    utils.init_logging(None, args.debug, args.quiet, args.logfile)
+    stats = import_lists(whitelists.load(args.url), args.paths, args.format,
+        args.replace, args.chunk_size, args.force)
+    _LOG.info("Imported %d lines (%d invalid) into %s: %d added, "
+        "%d unchanged, %d deleted, %d kept", stats["lines"],
+        stats["invalid"], args.url, stats["added"], stats["unchanged"],
+        stats["deleted"], stats["kept"])
+
+    # Fail if the stale entries were kept, so scripts notice
+    raise SystemExit(1 if stats["kept"] else None)
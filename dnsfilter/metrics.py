@@ -0,0 +1,228 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import bisect
+import logging
+import timeit
+
+"""
+Module containing the metrics components.
+
+Metrics are cheap enough to leave on for every query: counters are plain
+ints, histograms count into buckets preallocated when they are created, and
+labelled children are looked up once when the instrumented object is built
+rather than on every update. Updates aren't locked; an update from a
+storage thread can very rarely be lost, which is fine for monitoring.
+"""
+
+_LOG = logging.getLogger("dnsfilter.metrics")
+
+timer = timeit.default_timer
+
+# Latency buckets, in seconds, from 10us to 10s
+LATENCY_BUCKETS = [ 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for (name, value) in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+            .replace("\n", "\\n")
+        pairs.append(name+"=\""+value+"\"")
+    return "{"+",".join(pairs)+"}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter(object):
+    """
+    A value that only goes up.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, label_names, label_values):
+        yield (name, _format_labels(label_names, label_values), self.value)
+
+class Histogram(object):
+    """
+    Counts of observed values in a fixed set of buckets.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [ 0 ] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def observe_since(self, started):
+        """
+        Observe the time since started, a value of timer().
+        """
+        self.observe(timer() - started)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name, label_names, label_values):
+        label_names = list(label_names) + [ "le" ]
+        total = 0
+        for (bound, count) in zip(self.buckets + [ float("inf") ],
+                self.counts):
+            total += count
+            yield (name+"_bucket", _format_labels(label_names,
+                list(label_values) + [ _format_value(float(bound)) ]), total)
+        label_names = label_names[:-1]
+        yield (name+"_sum", _format_labels(label_names, label_values),
+            self.sum)
+        yield (name+"_count", _format_labels(label_names, label_values),
+            total)
+
+class Metric(object):
+    """
+    A named metric with a child (a Counter or Histogram) for every
+    combination of label values.
+    """
+
+    def __init__(self, name, type, help, labels=(), factory=Counter):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.label_names = tuple(labels)
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        """
+        Get the child for the label values. Look children up once and keep
+        them, rather than calling this for every update.
+        """
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise Exception("Metric %s expects labels %s" % (self.name,
+                    self.label_names))
+            child = self.factory()
+            self.children[values] = child
+        return child
+
+    def samples(self):
+        for (values, child) in sorted(self.children.items()):
+            for sample in child.samples(self.name, self.label_names, values):
+                yield sample
+
+class CallbackMetric(object):
+    """
+    A metric whose value is read from a function when it is collected, so
+    objects that already keep counters cost nothing extra to expose.
+    """
+
+    def __init__(self, name, type, help, callback):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.callback = callback
+
+    def samples(self):
+        try:
+            yield (self.name, "", self.callback())
+        except Exception as e:
+            _LOG.warning("Failed to collect %s: %s", self.name, e)
+
+class Registry(object):
+    """
+    The set of metrics exposed by a process.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """
+        Add a metric, replacing any metric with the same name.
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(name, "counter", help, labels, Counter)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(name, "histogram", help, labels,
+            lambda: Histogram(buckets))
+
+    def callback(self, name, type, help, callback):
+        return self.register(CallbackMetric(name, type, help, callback))
+
+    def _get(self, name, type, help, labels, factory):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.register(Metric(name, type, help, labels, factory))
+        return metric
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append("# HELP "+name+" "+metric.help)
+            lines.append("# TYPE "+name+" "+metric.type)
+            for (sample_name, labels, value) in metric.samples():
+                lines.append(sample_name+labels+" "+_format_value(value))
+        return "\n".join(lines)+"\n"
+
+REGISTRY = Registry()
+
+QUERIES = REGISTRY.counter("dnsfilter_queries_total",
+    "Queries answered, by verdict", [ "verdict" ])
+
+FILTERING_SECONDS = REGISTRY.histogram("dnsfilter_filtering_seconds",
+    "Time to reach a verdict for a query, by verdict and whether the "
+    "verdict was cached", [ "verdict", "cached" ])
+
+FILTER_SECONDS = REGISTRY.histogram("dnsfilter_filter_seconds",
+    "Time spent in each filter of a chain, by verdict",
+    [ "filter", "verdict" ])
+
+UPSTREAM_SECONDS = REGISTRY.histogram("dnsfilter_upstream_seconds",
+    "Time to resolve allowed queries upstream, by result", [ "result" ])
+
+UPSTREAM_SERVER_SECONDS = REGISTRY.histogram(
+    "dnsfilter_upstream_server_seconds",
+    "Time for each upstream server to answer, by server and result",
+    [ "server", "result" ])
+
+STORAGE_SECONDS = REGISTRY.histogram("dnsfilter_storage_seconds",
+    "Time spent in storage calls, by store and method",
+    [ "store", "method" ])
+
+STORAGE_ERRORS = REGISTRY.counter("dnsfilter_storage_errors_total",
+    "Storage calls that raised, by store and method", [ "store", "method" ])
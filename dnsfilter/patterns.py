@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import logging
+import re
+
+"""
+Module containing the wildcard domain pattern components.
+
+Patterns use fnmatch style wildcards: * matches any characters, ? matches
+one character and [seq]/[!seq] match one character in/not in seq.
+"""
+
+_LOG = logging.getLogger("dnsfilter.patterns")
+
+_WILDCARDS = "*?["
+
+def is_pattern(entry):
+    """
+    Does the entry contain any wildcards.
+    """
+    for c in _WILDCARDS:
+        if c in entry:
+            return True
+    return False
+
+def literal_suffix(pattern):
+    """
+    Get the trailing labels of a pattern that contain no wildcards, e.g.
+    example.net for *.cdn-*.example.net. Empty if the last label has a
+    wildcard.
+    """
+    labels = pattern.split(".")
+    i = len(labels)
+    while i > 0 and not is_pattern(labels[i - 1]):
+        i -= 1
+    return ".".join(labels[i:])
+
+def translate(pattern):
+    """
+    Translate a pattern into a regular expression (without anchors).
+    """
+    result = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            result.append(".*")
+        elif c == "?":
+            result.append(".")
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                result.append("\\[")
+            else:
+                seq = pattern[i:j].replace("\\", "\\\\")
+                if seq.startswith("!"):
+                    seq = "^"+seq[1:]
+                elif seq.startswith("^"):
+                    seq = "\\"+seq
+                result.append("["+seq+"]")
+                i = j + 1
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+class PatternIndex(object):
+    """
+    A set of wildcard patterns, grouped by their literal suffix.
+
+    Each group is compiled into a single regular expression, so a name is
+    checked against every pattern with at most one regex match per label of
+    the name, however many patterns there are. Groups are compiled as they
+    change, so matching only reads the index. update() and discard_all()
+    compile each changed group once, for loading many patterns.
+    """
+
+    def __init__(self, patterns=[]):
+        self.groups = {}
+        self.compiled = {}
+        self.update(patterns)
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups.values())
+
+    def get_all(self):
+        result = []
+        for group in self.groups.values():
+            result.extend(group)
+        return result
+
+    def copy(self):
+        """
+        Get a copy of the index that can be changed without affecting this
+        one. The compiled groups are shared until they change.
+        """
+        index = PatternIndex()
+        index.groups = dict((suffix, set(group))
+            for (suffix, group) in self.groups.items())
+        index.compiled = dict(self.compiled)
+        return index
+
+    def contains(self, pattern):
+        group = self.groups.get(literal_suffix(pattern))
+        return group is not None and pattern in group
+
+    def add(self, pattern):
+        self.update([ pattern ])
+
+    def update(self, patterns):
+        """
+        Add many patterns, compiling each group they change once.
+        """
+        changed = set()
+        for pattern in patterns:
+            suffix = literal_suffix(pattern)
+            group = self.groups.setdefault(suffix, set())
+            if pattern not in group:
+                group.add(pattern)
+                changed.add(suffix)
+        for suffix in changed:
+            self._compile(suffix)
+
+    def discard(self, pattern):
+        self.discard_all([ pattern ])
+
+    def discard_all(self, patterns):
+        """
+        Remove many patterns, compiling each group they change once.
+        """
+        changed = set()
+        for pattern in patterns:
+            suffix = literal_suffix(pattern)
+            group = self.groups.get(suffix)
+            if group and pattern in group:
+                group.discard(pattern)
+                changed.add(suffix)
+        for suffix in changed:
+            self._compile(suffix)
+
+    def _compile(self, suffix):
+        group = self.groups.get(suffix)
+        if not group:
+            self.groups.pop(suffix, None)
+            self.compiled.pop(suffix, None)
+            return
+
+        # Match the pattern itself or any subdomain of it
+        regex = "^(?:.*\\.)?(?:"+"|".join(translate(p) for p in group)+")$"
+        _LOG.debug("Compiled %d patterns for '%s' into %s", len(group),
+            suffix, regex)
+        self.compiled[suffix] = re.compile(regex)
+
+    def match_suffix(self, suffix, name):
+        """
+        Check the name against the patterns whose literal suffix is suffix.
+        """
+        regex = self.compiled.get(suffix)
+        return regex is not None and regex.match(name) is not None
+
+    def matches(self, name):
+        """
+        Does the name, or any of its parent domains, match a pattern.
+        """
+        if not self.groups:
+            return False
+        if self.match_suffix("", name):
+            return True
+
+        start = 0
+        while True:
+            if self.match_suffix(name[start:], name):
+                return True
+            dot = name.find(".", start)
+            if dot < 0:
+                return False
+            start = dot + 1
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import time
+from twisted.internet import defer, task, threads
+
+"""
+Module containing the query log file writer and reader.
+"""
+
+_LOG = logging.getLogger("dnsfilter.querylog")
+
+TEXT_FORMAT = "text"
+NDJSON_FORMAT = "ndjson"
+
+_ROTATED_SUFFIX = "%Y%m%d-%H%M%S"
+
+RAW_VIEW = "raw"
+TOP_DOMAINS_VIEW = "top-domains"
+TOP_BLOCKED_VIEW = "top-blocked"
+TOP_DEVICES_VIEW = "top-devices"
+RATE_VIEW = "rate"
+VIEWS = [ RAW_VIEW, TOP_DOMAINS_VIEW, TOP_BLOCKED_VIEW, TOP_DEVICES_VIEW,
+    RATE_VIEW ]
+
+# The number of records in a raw report when no limit is given, for callers
+# that hold the whole report in memory
+RAW_LIMIT = 1000
+
+_RELATIVE_TIME = re.compile("^([0-9]+)([smhdw])$")
+_RELATIVE_UNITS = { "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800 }
+_TIME_FORMATS = [ "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M", "%Y-%m-%d" ]
+
+class QueryLogWriter(object):
+    """
+    A buffered, rotating query log file.
+
+    Records are formatted into an in-memory buffer which is written to the
+    file by a single background thread when buffer_size bytes are waiting or
+    every flush_interval seconds. The file is rotated when it grows past
+    max_bytes or is older than rotate_interval seconds, keeping at most
+    backups rotated files.
+
+    Records are written in one of two formats:
+
+        text   - "[<time>] <query>" lines
+        ndjson - one compact JSON object per line
+    """
+
+    def __init__(self, path, format=TEXT_FORMAT, buffer_size=65536,
+            flush_interval=1, max_bytes=0, rotate_interval=0, backups=0):
+        if format not in [ TEXT_FORMAT, NDJSON_FORMAT ]:
+            raise Exception("Invalid query log format : "+str(format))
+
+        self.path = path
+        self.format = format
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+
+        self._file = None
+        self._file_size = 0
+        self._file_opened = 0
+        self._timestamp_second = None
+        self._timestamp = None
+        self._flushing = None
+        self._flusher = None
+
+    def _get_timestamp(self, now):
+        """
+        Get the text timestamp for a time, formatting it once per second.
+        """
+        second = int(now)
+        if second != self._timestamp_second:
+            self._timestamp = str(datetime.datetime.fromtimestamp(second))
+            self._timestamp_second = second
+        return self._timestamp
+
+    def write(self, device, name, type, allowed, query):
+        """
+        Add a query to the log.
+        """
+        now = time.time()
+
+        if self.format == NDJSON_FORMAT:
+            line = json.dumps({ "time": round(now, 3), "device": device,
+                "name": name, "type": type, "allowed": allowed },
+                separators=(",", ":"))+"\n"
+        else:
+            line = "["+self._get_timestamp(now)+"] "+str(query)+"\n"
+
+        self.buffer.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size and not self._flushing:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffer to the file in a background thread. Returns a
+        Deferred that fires when the write is done.
+        """
+        if self._flushing:
+            return self._flushing
+        if not self.buffer:
+            return defer.succeed(None)
+
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        self._flushing = threads.deferToThread(self._write, data)
+        self._flushing.addCallbacks(self._flushed, self._flush_failed)
+        return self._flushing
+
+    def _flushed(self, result):
+        self._flushing = None
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def _flush_failed(self, failure):
+        self._flushing = None
+        _LOG.error("Failed to write query log %s: %s", self.path,
+            failure.getErrorMessage())
+
+    def _write(self, data):
+        """
+        Write data to the log file, rotating it first if needed. Only ever
+        run from one thread at a time.
+        """
+        if self._file and self._should_rotate(len(data)):
+            self._rotate()
+
+        if not self._file:
+            self._file = open(self.path, "a")
+            self._file_size = self._file.tell()
+            self._file_opened = time.time()
+
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        self.written += len(data)
+
+    def _should_rotate(self, size):
+        if self.max_bytes and self._file_size + size > self.max_bytes:
+            return True
+        if self.rotate_interval and \
+                time.time() - self._file_opened >= self.rotate_interval:
+            return True
+        return False
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+
+        rotated = self.path+"."+time.strftime(_ROTATED_SUFFIX)
+        n = 0
+        while os.path.exists(rotated):
+            n += 1
+            rotated = self.path+"."+time.strftime(_ROTATED_SUFFIX)+"-"+str(n)
+
+        _LOG.debug("Rotating query log %s to %s", self.path, rotated)
+        os.rename(self.path, rotated)
+
+        if self.backups:
+            for old in _get_rotated_files(self.path)[:-self.backups]:
+                _LOG.debug("Removing old query log %s", old)
+                os.remove(old)
+
+    def start(self):
+        """
+        Start flushing the buffer every flush_interval seconds.
+        """
+        if not self._flusher:
+            self._flusher = task.LoopingCall(self.flush)
+            self._flusher.start(self.flush_interval, now=False)
+
+    def stop(self):
+        """
+        Stop the periodic flushes, write the buffer and close the file.
+        """
+        if self._flusher:
+            self._flusher.stop()
+            self._flusher = None
+        return self._drain()
+
+    def _drain(self, result=None):
+        if self.buffer or self._flushing:
+            return self.flush().addBoth(self._drain)
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def _get_rotated_files(path):
+    return sorted(glob.glob(path+".*"))
+
+def get_log_files(path):
+    """
+    Get the files of a query log, oldest first. The current file is last.
+    """
+    files = _get_rotated_files(path)
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def read_log(path):
+    """
+    Stream the records of a query log, including its rotated files, oldest
+    first. Each record is a dict with at least "time" and "query" or "name".
+    """
+    for log_file in get_log_files(path):
+        with open(log_file) as f:
+            for line in f:
+                record = _parse_record(line)
+                if record:
+                    yield record
+
+def _parse_record(line):
+    line = line.strip()
+    if not line:
+        return None
+
+    if line.startswith("{"):
+        try:
+            return json.loads(line)
+        except ValueError:
+            _LOG.warning("Skipping invalid query log record %s", line)
+            return None
+
+    if line.startswith("[") and "] " in line:
+        (timestamp, query) = line[1:].split("] ", 1)
+        return { "time": timestamp, "query": query }
+
+    _LOG.warning("Skipping invalid query log record %s", line)
+    return None
+
+def parse_time(value, now=None):
+    """
+    Parse a UTC time given as an ISO date (2016-05-01 or
+    2016-05-01T12:30:00) or as a time before now (e.g. 30m, 12h or 7d).
+    """
+    match = _RELATIVE_TIME.match(value)
+    if match:
+        seconds = int(match.group(1)) * _RELATIVE_UNITS[match.group(2)]
+        return (now or datetime.datetime.utcnow()) - \
+            datetime.timedelta(seconds=seconds)
+
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid time : "+value)
+
+def build_log_query(since=None, until=None, device=None):
+    """
+    Build the store query for the request log records of a device (or all
+    devices) between since (inclusive) and until (exclusive).
+    """
+    query = {}
+    if device:
+        query["device"] = device
+
+    time_range = {}
+    if since:
+        time_range["$gte"] = since
+    if until:
+        time_range["$lt"] = until
+    if time_range:
+        query["time"] = time_range
+    return query
+
+def get_report(store, view=RAW_VIEW, since=None, until=None, device=None,
+        limit=0, interval=60):
+    """
+    Get a view of the request log store. The aggregated views are counted
+    by the store, so only the rows of the report leave it:
+
+        raw         - the matching records, oldest first
+        top-domains - the most queried domains
+        top-blocked - the most blocked domains, per device (limit is the
+                      number of domains for each device)
+        top-devices - the devices making the most queries
+        rate        - the number of queries every interval seconds
+
+    The raw view is a generator that reads the records as it is iterated,
+    so a report without a limit can be streamed. The other views are built
+    in memory, and without a limit they hold a row for every domain (or
+    device and domain pair) queried in the range, so reports over large
+    ranges should be given one.
+    """
+    query = build_log_query(since, until, device)
+
+    if view == RAW_VIEW:
+        return ( record.properties for record in store.find(query,
+            limit=limit) )
+    elif view == TOP_DOMAINS_VIEW:
+        return store.group_count([ "domain" ], query, limit)
+    elif view == TOP_BLOCKED_VIEW:
+        query["allowed"] = False
+        return store.group_count([ "device", "domain" ], query,
+            group_limit=limit)
+    elif view == TOP_DEVICES_VIEW:
+        return store.group_count([ "device" ], query, limit)
+    elif view == RATE_VIEW:
+        if interval <= 0:
+            raise ValueError("Invalid interval : "+str(interval))
+        return store.group_count([], query, limit, interval)
+    else:
+        raise ValueError("Unknown view : "+str(view))
+
+def format_row(row):
+    """
+    Format a report row as a line of text.
+    """
+    if "count" not in row:
+        return " ".join(str(row.get(key)) for key in
+            [ "time", "device", "domain", "allowed" ])
+
+    values = []
+    for key in [ "time", "device", "domain", "verdict" ]:
+        if key in row:
+            values.append(str(row[key]))
+    values.append(str(row["count"]))
+    return " ".join(values)
@@ -13,9 +13,14 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+import caches
 import logging
-from twisted.internet import defer
-from twisted.names import error
+import math
+from twisted.internet import defer, reactor
+from twisted.names import dns, error
+from twisted.python import failure
+import metrics
+import whitelists
 
 """
     Module containing the resolvers for the dnsfilter.
@@ -23,24 +28,385 @@ from twisted.names import error
 
 _LOG = logging.getLogger("dnsfilter.resolvers")
 
+class BlockedDomainError(error.DomainError):
+    """
+    The error for a blocked query answered with NXDOMAIN, carrying the
+    authority records to send with the response.
+    """
+
+    def __init__(self, authority):
+        error.DomainError.__init__(self)
+        self.authority = authority
+
+class BlockResponder(object):
+    """
+    Builds the responses served for queries the filter rejects.
+
+    The modes are:
+
+        error    - fail the query with a plain DomainError (NXDOMAIN without
+                   an SOA, so nothing caches it)
+        nxdomain - NXDOMAIN with an SOA carrying the negative cache TTL
+        nodata   - an empty answer with an SOA carrying the negative cache TTL
+        sinkhole - an A or AAAA record pointing at the sinkhole addresses,
+                   and NODATA for other query types
+
+    The record payloads are built once, and served with a TTL of ttl.
+    """
+
+    ERROR = "error"
+    NXDOMAIN = "nxdomain"
+    NODATA = "nodata"
+    SINKHOLE = "sinkhole"
+
+    MODES = [ ERROR, NXDOMAIN, NODATA, SINKHOLE ]
+
+    def __init__(self, mode=NXDOMAIN, ttl=300, sinkhole_addr="0.0.0.0",
+            sinkhole_addr6="::"):
+        if mode not in BlockResponder.MODES:
+            raise Exception("Invalid block response mode : "+str(mode))
+
+        self.mode = mode
+        self.ttl = ttl
+        self.soa = dns.Record_SOA(mname="dnsfilter",
+            rname="hostmaster.dnsfilter", serial=1, refresh=ttl, retry=ttl,
+            expire=ttl, minimum=ttl, ttl=ttl)
+        self.sinkholes = {
+            dns.A: dns.Record_A(sinkhole_addr, ttl),
+            dns.AAAA: dns.Record_AAAA(sinkhole_addr6, ttl)
+        }
+
+    def respond(self, query):
+        """
+        Get a Deferred for the response to a blocked query
+        """
+        if self.mode == BlockResponder.ERROR:
+            return defer.fail(error.DomainError())
+
+        name = query.name.name
+
+        if self.mode == BlockResponder.SINKHOLE and \
+                query.type in self.sinkholes:
+            answer = dns.RRHeader(name, query.type, dns.IN, self.ttl,
+                self.sinkholes[query.type], auth=True)
+            return defer.succeed(([ answer ], [], []))
+
+        authority = [ dns.RRHeader(name, dns.SOA, dns.IN, self.ttl, self.soa,
+            auth=True) ]
+
+        if self.mode == BlockResponder.NXDOMAIN:
+            return defer.fail(BlockedDomainError(authority))
+        return defer.succeed(([], authority, []))
+
 class FilterResolver(object):
     """
     A resolver that filters requests based on a filter object
+
+    Rejected queries are answered by the block responder.
+
+    Verdicts can be cached per device and query name in a VerdictCache,
+    which is invalidated when the filter reports a change. Every query is
+    passed to the optional recorder filter after its verdict is known, with
+    query.allowed set.
+
+    The verdicts, the time taken to reach them and the time taken to resolve
+    allowed queries are recorded in the metrics.
+
+    The filter and recorder can be swapped with set_filter() while queries
+    are being answered.
     """
 
-    def __init__(self, sub_resolver, filter):
+    def __init__(self, sub_resolver, filter, recorder=None,
+            verdict_cache=None, block_responder=None):
         self.sub_resolver = sub_resolver
         self.filter = filter
+        self.recorder = recorder
+        self.verdict_cache = verdict_cache
+        self.block_responder = block_responder or BlockResponder(
+            BlockResponder.ERROR)
+
+        if verdict_cache:
+            filter.add_listener(verdict_cache.invalidate)
+
+        self.allowed = metrics.QUERIES.labels("allowed")
+        self.blocked = metrics.QUERIES.labels("blocked")
+        self.filtering_timers = {
+            (True, False): metrics.FILTERING_SECONDS.labels("allowed", "no"),
+            (False, False): metrics.FILTERING_SECONDS.labels("blocked", "no"),
+            (True, True): metrics.FILTERING_SECONDS.labels("allowed", "yes"),
+            (False, True): metrics.FILTERING_SECONDS.labels("blocked", "yes")
+        }
+        self.upstream_answered = metrics.UPSTREAM_SECONDS.labels("answer")
+        self.upstream_failed = metrics.UPSTREAM_SECONDS.labels("error")
+
+    def set_filter(self, filter, recorder=None):
+        """
+        Use a new filter and recorder for the queries that arrive from now
+        on. Queries already being filtered finish with the old ones. Every
+        cached verdict is invalidated, as the new filter may disagree.
+        """
+        if self.verdict_cache:
+            filter.add_listener(self.verdict_cache.invalidate)
+            self.verdict_cache.invalidate()
+        self.filter = filter
+        self.recorder = recorder
 
     def query(self, query, timeout=None):
         """
         Run the query through this object's filter
         """
+        started = metrics.timer()
+        cache = self.verdict_cache
+        if cache:
+            device = query.device_addr
+            name = whitelists.normalize(query.name.name)
+            allowed = cache.get(device, name)
+            if allowed is not None:
+                self.filtering_timers[(allowed, True)].observe_since(started)
+                return self._resolve(allowed, query, timeout)
+            stamp = cache.stamp(device)
+
         filtered_query = self.filter.do_filter(query)
 
+        if isinstance(filtered_query, defer.Deferred):
+            if cache:
+                filtered_query.addCallback(self._cache_verdict, device, name,
+                    stamp)
+            filtered_query.addCallback(self._observe, started)
+            return filtered_query.addCallback(self._resolve, query, timeout)
+
+        if cache:
+            self._cache_verdict(filtered_query, device, name, stamp)
+        self._observe(filtered_query, started)
+        return self._resolve(filtered_query, query, timeout)
+
+    def _observe(self, filtered_query, started):
+        self.filtering_timers[(bool(filtered_query), False)].observe_since(
+            started)
+        return filtered_query
+
+    def _cache_verdict(self, filtered_query, device, name, stamp):
+        self.verdict_cache.set(device, name, bool(filtered_query), stamp)
+        return filtered_query
+
+    def _resolve(self, filtered_query, query, timeout):
+        """
+        Pass a query the filter allowed on to the sub resolver
+        """
+        if self.recorder:
+            query.allowed = bool(filtered_query)
+            self.recorder.do_filter(query)
+
         if filtered_query:
-            return self.sub_resolver.query(query, timeout)
+            self.allowed.inc()
+            started = metrics.timer()
+            d = self.sub_resolver.query(query, timeout)
+            d.addCallbacks(self._upstream_done, self._upstream_done,
+                callbackArgs=(self.upstream_answered, started),
+                errbackArgs=(self.upstream_failed, started))
+            return d
         else:
+            self.blocked.inc()
             _LOG.warning("Query for %s from %s rejected by filter %s", query,
                 query.device_addr, self.filter)
-            return defer.fail(error.DomainError())
+            return self.block_responder.respond(query)
+
+    def _upstream_done(self, result, histogram, started):
+        histogram.observe_since(started)
+        return result
+
+# The errors that are negative answers, which are cached like answers. The
+# other rcode errors subclass DomainError too, so NXDOMAIN is matched by its
+# own class.
+_NEGATIVE_ERRORS = (error.DNSNameError, error.AuthoritativeDomainError)
+
+def _get_ttl(result):
+    """
+    Get the TTL of an answer, the smallest TTL of its answer and authority
+    records, or None if it has none.
+    """
+    ttls = [ header.ttl for header in result[0] + result[1] ]
+    if not ttls:
+        return None
+    return min(ttls)
+
+def _with_ttl(result, ttl):
+    """
+    Copy the records of an answer with their TTLs set to ttl.
+    """
+    return tuple([ dns.RRHeader(header.name.name, header.type, header.cls,
+        ttl, header.payload, header.auth) for header in section ]
+        for section in result)
+
+class CachingResolver(object):
+    """
+    A resolver that caches the answers of another resolver.
+
+    Answers are cached for the smallest TTL of their records (capped at
+    max_ttl), and negative answers for negative_ttl seconds. Cached answers
+    are served with their TTLs counting down. If prefetch is set, a hit in
+    the last tenth of an answer's TTL refreshes it in the background, so
+    popular names don't all expire at once.
+
+    If max_stale is set, expired answers are kept for that many seconds and
+    served with a TTL of stale_ttl when they can't be refreshed, either
+    because the sub resolver failed or because it took longer than
+    stale_timeout seconds to answer (as in RFC 8767).
+
+    Times are read from and timers scheduled on clock.
+    """
+
+    def __init__(self, sub_resolver, max_size=10000, max_ttl=86400,
+            negative_ttl=60, prefetch=True, max_stale=0, stale_timeout=1.8,
+            stale_ttl=30, clock=reactor):
+        self.sub_resolver = sub_resolver
+        self.clock = clock
+        self.cache = caches.AnswerCache(max_size, max_stale)
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.prefetch = prefetch
+        self.stale_timeout = stale_timeout
+        self.stale_ttl = stale_ttl
+        self.prefetching = set()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.stale = 0
+
+    def query(self, query, timeout=None):
+        key = (query.name.name.lower(), query.type, query.cls)
+        now = self.clock.seconds()
+        entry = self.cache.get(key, now)
+
+        if entry is not None:
+            (result, ttl, expires) = entry
+            remaining = expires - now
+            if remaining > 0:
+                self.hits += 1
+                if self.prefetch and remaining <= ttl * 0.1:
+                    self._prefetch(key, query, timeout)
+                return self._answer(result, int(math.ceil(remaining)))
+
+        self.misses += 1
+        d = self._resolve(key, query, timeout)
+        if entry is None:
+            return d
+        return self._serve_stale(d, entry[0])
+
+    def _answer(self, result, ttl):
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(_with_ttl(result, ttl))
+
+    def _resolve(self, key, query, timeout):
+        d = self.sub_resolver.query(query, timeout)
+        return d.addBoth(self._cache, key)
+
+    def _cache(self, result, key):
+        if isinstance(result, failure.Failure):
+            if result.check(*_NEGATIVE_ERRORS) and self.negative_ttl:
+                self.cache.set(key, result.value, self.negative_ttl,
+                    self.clock.seconds())
+            return result
+
+        ttl = _get_ttl(result)
+        if ttl is None:
+            ttl = self.negative_ttl
+        ttl = min(ttl, self.max_ttl)
+        if ttl > 0:
+            self.cache.set(key, result, ttl, self.clock.seconds())
+        return result
+
+    def _prefetch(self, key, query, timeout):
+        if key in self.prefetching:
+            return
+
+        _LOG.debug("Prefetching %s", query)
+        self.prefetching.add(key)
+        self.prefetches += 1
+        d = self._resolve(key, query, timeout)
+        d.addBoth(self._prefetched, key, query)
+
+    def _prefetched(self, result, key, query):
+        self.prefetching.discard(key)
+        if isinstance(result, failure.Failure) and \
+                not result.check(*_NEGATIVE_ERRORS):
+            _LOG.debug("Failed to prefetch %s: %s", query,
+                result.getErrorMessage())
+
+    def _serve_stale(self, d, stale_result):
+        """
+        Answer with the result of d, or with the stale result if d fails or
+        takes longer than stale_timeout. d is left to refresh the cache
+        either way.
+        """
+        answer = defer.Deferred()
+        timer = self.clock.callLater(self.stale_timeout, self._stale_answer,
+            answer, stale_result, "timed out")
+        d.addBoth(self._refreshed, answer, timer, stale_result)
+        return answer
+
+    def _refreshed(self, result, answer, timer, stale_result):
+        if timer.active():
+            timer.cancel()
+        if answer.called:
+            return None
+
+        if isinstance(result, failure.Failure) and \
+                not result.check(*_NEGATIVE_ERRORS):
+            self._stale_answer(answer, stale_result, result.getErrorMessage())
+        elif isinstance(result, failure.Failure):
+            answer.errback(result)
+        else:
+            answer.callback(result)
+
+    def _stale_answer(self, answer, stale_result, reason):
+        _LOG.debug("Serving stale answer, refresh %s", reason)
+        self.stale += 1
+        self._answer(stale_result, self.stale_ttl).chainDeferred(answer)
+
+class CoalescingResolver(object):
+    """
+    A resolver that sends a query to another resolver only once while it is
+    in flight.
+
+    Queries for the same name, type and class that arrive before the first
+    one is answered wait for its answer instead of being sent again, so a
+    popular name expiring from the caches is looked up once rather than by
+    every device that asks for it at the same time.
+    """
+
+    def __init__(self, sub_resolver):
+        self.sub_resolver = sub_resolver
+        self.in_flight = {}
+
+        # Counters
+        self.sent = 0
+        self.coalesced = 0
+
+    def query(self, query, timeout=None):
+        key = (query.name.name.lower(), query.type, query.cls)
+        waiters = self.in_flight.get(key)
+        if waiters is not None:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+
+        waiters = []
+        self.in_flight[key] = waiters
+        self.sent += 1
+        d = self.sub_resolver.query(query, timeout)
+        return d.addBoth(self._answered, key, waiters)
+
+    def _answered(self, result, key, waiters):
+        del self.in_flight[key]
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                # Each caller gets its own lists of the shared records
+                waiter.callback(tuple(list(section) for section in result))
+        return result
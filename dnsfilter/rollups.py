@@ -0,0 +1,114 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import collections
+import datetime
+import logging
+import querylog
+
+"""
+Module containing the request rollup components.
+
+A rollup is a counter of the queries made by a device for a registered
+domain with the same verdict in the same minute. Rollups are named by their
+key, so a flush only touches one object per distinct key however many
+queries were counted.
+"""
+
+_LOG = logging.getLogger("dnsfilter.rollups")
+
+ALLOWED = "allowed"
+BLOCKED = "blocked"
+
+# The interval rollups are counted over, in seconds
+INTERVAL = 60
+
+# The fields rollups can be grouped by
+FIELDS = [ "device", "domain", "verdict" ]
+
+# Second level labels used under country code domains, e.g. co.uk
+_SECOND_LEVEL_LABELS = set([ "ac", "co", "com", "edu", "gov", "net", "ne",
+    "or", "org" ])
+
+def registered_domain(name):
+    """
+    Get the domain a name was registered under, e.g. example.co.uk for
+    www.example.co.uk. This is a heuristic rather than a public suffix list
+    lookup: a country code domain with a common second level label keeps
+    three labels, anything else keeps two.
+    """
+    labels = name.lower().rstrip(".").split(".")
+    if len(labels) > 2 and len(labels[-1]) == 2 and \
+            labels[-2] in _SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+def get_rollup_name(device, domain, verdict, time):
+    return "|".join([ time.strftime("%Y%m%d%H%M"), str(device), domain,
+        verdict ])
+
+class RollupCounter(object):
+    """
+    In-memory rollup counters, waiting to be written to a store.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, device, name, allowed, now=None):
+        now = now or datetime.datetime.utcnow()
+        minute = now.replace(second=0, microsecond=0)
+        verdict = ALLOWED if allowed is not False else BLOCKED
+        self.counts[(device, registered_domain(name), verdict, minute)] += 1
+
+    def take(self):
+        """
+        Get the store increments for the counted queries, and start counting
+        again from zero.
+        """
+        (counts, self.counts) = (self.counts, collections.Counter())
+
+        increments = []
+        for ((device, domain, verdict, minute), count) in counts.items():
+            fields = { "device": device, "domain": domain,
+                "verdict": verdict, "time": minute }
+            increments.append((get_rollup_name(device, domain, verdict,
+                minute), fields, { "count": count }))
+        return increments
+
+def get_rollups(store, group_by=[ "domain" ], since=None, until=None,
+        device=None, verdict=None, limit=0, interval=None):
+    """
+    Get the query counts of the rollups matching the device, verdict and
+    time range, grouped by the group_by fields (and by time every interval
+    seconds, if given). The counts are added up by the store.
+    """
+    for field in group_by:
+        if field not in FIELDS:
+            raise ValueError("Unknown rollup field : "+str(field))
+    if interval is not None and interval < INTERVAL:
+        raise ValueError("Invalid interval : "+str(interval))
+    if verdict is not None and verdict not in [ ALLOWED, BLOCKED ]:
+        raise ValueError("Unknown verdict : "+str(verdict))
+
+    query = querylog.build_log_query(since, until, device)
+    if verdict:
+        query["verdict"] = verdict
+
+    return store.group_count(group_by, query, limit, interval,
+        sum_field="count")
@@ -15,11 +15,23 @@
 #   limitations under the License.
 import argparse
 import logging
-from twisted.internet import reactor
-from twisted.names import client, dns, server
+import os
+import signal
+import socket
+import sys
+from twisted.internet import defer, reactor
+from twisted.names import dns, hosts, resolve, server
+from twisted.python import failure
+from twisted.web import server as web_server
+import admin
+import caches
 import filters
+import metrics
 import resolvers
+import storage
+import upstreams
 import utils
+import workers
 
 """
 Module containing the main DNS server components.
@@ -27,23 +39,147 @@ Module containing the main DNS server components.
 
 _LOG = logging.getLogger("dnsfilter.server")
 
+# The options that only take effect when the server is restarted
+RESTART_OPTIONS = [ "addr", "port", "workers", "admin_addr", "admin_port",
+    "storage_threads", "debug", "quiet", "logfile" ]
+
 class ServerFactory(server.DNSServerFactory):
     """
     A DNSServerFactory impl that allows interceptions of connection info
+
+    The configuration can be reloaded without dropping queries, see
+    reload().
     """
 
     def __init__(self, args):
         server.DNSServerFactory.__init__(self)
+        self.args = args
+        self.pool = None
+        self.answer_cache = None
+        self._reloading = None
 
         # Create the resolvers
-        dns_resolver = client.createResolver(resolvconf='/etc/resolv.conf')
-        filter_resolver = resolvers.FilterResolver(dns_resolver, 
-            self._get_filter(args))
+        dns_resolver = self._get_upstream_resolver(args)
+        self.filter = self._get_filter(args)
+        self.recorder = self._get_recorder(args)
+        for f in [ self.filter, self.recorder ]:
+            if f:
+                f.start()
+        reactor.addSystemEventTrigger("before", "shutdown", self._stop)
+
+        verdict_cache = None
+        if args.verdict_cache_size:
+            verdict_cache = caches.VerdictCache(args.verdict_cache_size,
+                args.verdict_cache_ttl)
+            metrics.REGISTRY.callback("dnsfilter_verdict_cache_hits_total",
+                "counter", "Verdicts served from the verdict cache",
+                lambda: verdict_cache.hits)
+            metrics.REGISTRY.callback("dnsfilter_verdict_cache_misses_total",
+                "counter", "Verdicts not found in the verdict cache",
+                lambda: verdict_cache.misses)
+
+        filter_resolver = resolvers.FilterResolver(dns_resolver, self.filter,
+            self.recorder, verdict_cache, self._get_block_responder(args))
 
         # Override the default resolver for the parent factory
         self.resolver = filter_resolver
         self.canRecurse = True
 
+    def _stop(self):
+        return _stop_filters([ self.filter, self.recorder ])
+
+    def reload(self):
+        """
+        Reload the configuration from the command line, including any @files
+        it names. The new filter chain is built in the storage thread pool,
+        then swapped into the resolver along with the new upstream, cache
+        and block settings; queries are answered throughout. Returns a
+        Deferred that fires when the reload has finished.
+        """
+        if self._reloading:
+            return defer.fail(Exception("A reload is already running"))
+
+        try:
+            args = parse_args(sys.argv[1:])
+        except SystemExit:
+            _LOG.error("Failed to reload: invalid configuration")
+            return defer.fail(Exception("Invalid configuration"))
+
+        _LOG.info("Reloading configuration")
+        for option in RESTART_OPTIONS:
+            if getattr(args, option) != getattr(self.args, option):
+                _LOG.warning("Restart the server to change --%s",
+                    option.replace("_", "-"))
+                # Keep the value that is actually in use
+                setattr(args, option, getattr(self.args, option))
+
+        self._reloading = storage.defer_to_thread(self._build, args)
+        self._reloading.addCallback(self._swap, args)
+        self._reloading.addBoth(self._reloaded)
+        return self._reloading
+
+    def _build(self, args):
+        """
+        Build the parts of the new configuration that do blocking work.
+        """
+        return (self._get_filter(args), self._get_recorder(args),
+            self._get_upstream_servers(args))
+
+    def _swap(self, built, args):
+        (filter, recorder, servers) = built
+        try:
+            block_responder = self._get_block_responder(args)
+            for f in [ filter, recorder ]:
+                if f:
+                    f.start()
+            self.pool.configure(servers, args.upstream_timeout,
+                args.upstream_race, args.upstream_probe_interval)
+        except Exception:
+            # Nothing has been swapped yet, so keep the old chain running
+            # and stop the new one
+            _stop_filters([ filter, recorder ])
+            raise
+
+        _hand_over_query_logs(self.recorder, recorder)
+
+        old = [ self.filter, self.recorder ]
+        (self.filter, self.recorder) = (filter, recorder)
+        self.resolver.set_filter(filter, recorder)
+        self.resolver.block_responder = block_responder
+        self._configure_caches(args)
+        self.args = args
+
+        return _stop_filters(old)
+
+    def _configure_caches(self, args):
+        """
+        Apply the cache settings to the existing caches, keeping their
+        entries.
+        """
+        verdict_cache = self.resolver.verdict_cache
+        if bool(verdict_cache) != bool(args.verdict_cache_size) or \
+                bool(self.answer_cache) != bool(args.answer_cache_size):
+            _LOG.warning("Restart the server to enable or disable a cache")
+
+        if verdict_cache and args.verdict_cache_size:
+            verdict_cache.cache.max_size = args.verdict_cache_size
+            verdict_cache.cache.ttl = args.verdict_cache_ttl
+
+        answer_cache = self.answer_cache
+        if answer_cache and args.answer_cache_size:
+            answer_cache.cache.max_size = args.answer_cache_size
+            answer_cache.cache.max_stale = args.answer_cache_stale
+            answer_cache.max_ttl = args.answer_cache_max_ttl
+            answer_cache.prefetch = args.answer_cache_prefetch
+
+    def _reloaded(self, result):
+        self._reloading = None
+        if isinstance(result, failure.Failure):
+            _LOG.error("Failed to reload: %s", result.getErrorMessage())
+        else:
+            _LOG.info("Reloaded configuration")
+        return result
+
     def _get_addr(self, protocol, address):
         """
         Get an address from either a protocol object (TCP) or from an address
@@ -54,6 +190,71 @@ class ServerFactory(server.DNSServerFactory):
         else:
             return protocol.transport.getPeer().host
 
+    def _get_block_responder(self, args):
+        return resolvers.BlockResponder(args.block_mode, args.block_ttl,
+            args.sinkhole_addr, args.sinkhole_addr6)
+
+    def _get_upstream_servers(self, args):
+        """
+        Get the --upstream servers, or the servers in /etc/resolv.conf
+        """
+        if args.upstream:
+            servers = [ utils.parse_addr(upstream)
+                for upstream in args.upstream ]
+        else:
+            servers = upstreams.read_resolv_conf()
+        _LOG.info("Using upstream servers %s", servers)
+        return servers
+
+    def _get_upstream_resolver(self, args):
+        """
+        Get the resolver that answers allowed queries, from a pool of the
+        upstream servers
+        """
+        pool = upstreams.UpstreamPool(self._get_upstream_servers(args),
+            args.upstream_timeout, args.upstream_race,
+            args.upstream_probe_interval)
+        pool.start()
+        reactor.addSystemEventTrigger("before", "shutdown", pool.stop)
+        self.pool = pool
+
+        # Send identical queries upstream once while they are in flight
+        coalescer = resolvers.CoalescingResolver(pool)
+        metrics.REGISTRY.callback("dnsfilter_upstream_queries_total",
+            "counter", "Queries sent to the upstream pool",
+            lambda: coalescer.sent)
+        metrics.REGISTRY.callback("dnsfilter_upstream_coalesced_total",
+            "counter", "Queries that waited for an identical query already "
+            "in flight", lambda: coalescer.coalesced)
+
+        if not args.answer_cache_size:
+            return resolve.ResolverChain([ hosts.Resolver(), coalescer ])
+
+        answer_cache = resolvers.CachingResolver(coalescer,
+            args.answer_cache_size, args.answer_cache_max_ttl,
+            prefetch=args.answer_cache_prefetch,
+            max_stale=args.answer_cache_stale)
+        self.answer_cache = answer_cache
+        metrics.REGISTRY.callback("dnsfilter_answer_cache_hits_total",
+            "counter", "Answers served from the answer cache",
+            lambda: answer_cache.hits)
+        metrics.REGISTRY.callback("dnsfilter_answer_cache_misses_total",
+            "counter", "Answers not found in the answer cache",
+            lambda: answer_cache.misses)
+        metrics.REGISTRY.callback("dnsfilter_answer_cache_prefetches_total",
+            "counter", "Cached answers refreshed before they expired",
+            lambda: answer_cache.prefetches)
+        metrics.REGISTRY.callback("dnsfilter_answer_cache_stale_total",
+            "counter", "Expired answers served because they couldn't be "
+            "refreshed", lambda: answer_cache.stale)
+        metrics.REGISTRY.callback("dnsfilter_answer_cache_evictions_total",
+            "counter", "Answers evicted from the answer cache",
+            lambda: answer_cache.cache.evictions)
+        metrics.REGISTRY.callback("dnsfilter_answer_cache_entries", "gauge",
+            "Answers in the answer cache", lambda: len(answer_cache.cache))
+
+        return resolve.ResolverChain([ hosts.Resolver(), answer_cache ])
+
     def _get_filter(self, args):
         """
         Get the main filter to provide to the resolver
@@ -61,20 +262,61 @@ class ServerFactory(server.DNSServerFactory):
 
         # Create the filters list
         filter_list = []
-    
-        # If we want to record all requests, add the file logger filter
-        if args.record:
-            filter_list.append(filters.StoreLoggerFilter(args.url))
 
         # Add the whitelist filter
-        wl_filter = filters.WhitelistedSiteFilter(args.url)
+        wl_filter = filters.WhitelistedSiteFilter(
+            args.whitelist_url or args.url, args.refresh_interval,
+            args.full_refresh_interval)
         filter_list.append(wl_filter)
 
         # Create the ACL filter that filters all requests from devices
-        acl_filter = filters.DeviceACLFilter(filter_list, args.url)
+        acl_filter = filters.DeviceACLFilter(filter_list, args.url,
+            refresh_interval=args.refresh_interval,
+            full_refresh_interval=args.full_refresh_interval)
 
         return acl_filter
 
+    def _get_recorder(self, args):
+        """
+        Get the filter that records every query once its verdict is known
+        """
+        recorder_list = []
+
+        # If we want to record all requests, add the file logger filter
+        if args.record_file:
+            recorder_list.append(filters.FileLoggerFilter(args.record_file,
+                args.record_format, args.record_rotate_size,
+                args.record_rotate_interval, args.record_backups))
+
+        # If we want to record all requests, add the store logger filter
+        if args.record:
+            recorder_list.append(filters.StoreLoggerFilter(args.url,
+                max_size=args.record_queue_size,
+                overflow=args.record_overflow,
+                retention=args.record_retention * 24 * 60 * 60))
+
+        # If we want per minute counts of the requests, add the rollup filter
+        if args.rollup:
+            recorder_list.append(filters.RollupRecorderFilter(args.url,
+                args.rollup_flush_interval,
+                retention=args.rollup_retention * 24 * 60 * 60))
+
+        if not recorder_list:
+            return None
+        return filters.FilterChain(recorder_list)
+
+    def gotResolverError(self, failure, protocol, message, address):
+        """
+        Send NXDOMAIN responses for blocked queries with their SOA record
+        """
+        if failure.check(resolvers.BlockedDomainError):
+            response = self._responseFromMessage(message=message,
+                rCode=dns.ENAME, authority=failure.value.authority)
+            self.sendReply(protocol, response, address)
+        else:
+            server.DNSServerFactory.gotResolverError(self, failure, protocol,
+                message, address)
+
     def handleQuery(self, message, protocol, address):
         """
         Handle a query, adding the device IP address to the query objects
@@ -89,17 +331,115 @@ class ServerFactory(server.DNSServerFactory):
 def init(args):
     utils.init_logging(None, args.debug, args.quiet, args.logfile)
 
+def _get_worker_path(path, worker_id):
+    """
+    Get a per-worker variant of a file path, e.g. queries-1.log
+    """
+    (base, ext) = os.path.splitext(path)
+    return base+"-"+str(worker_id)+ext
+
+def _listen_reuseport(args, factory, protocol):
+    """
+    Listen on sockets with SO_REUSEPORT set, shared with the other workers
+    """
+    udp_sock = workers.create_socket(args.addr, args.port, socket.SOCK_DGRAM)
+    tcp_sock = workers.create_socket(args.addr, args.port, socket.SOCK_STREAM)
+    tcp_sock.listen(50)
+
+    reactor.adoptDatagramPort(udp_sock.fileno(), udp_sock.family, protocol)
+    reactor.adoptStreamPort(tcp_sock.fileno(), tcp_sock.family, factory)
+
+    # The reactor has its own copies of the sockets now
+    udp_sock.close()
+    tcp_sock.close()
+
+def _stop_filters(filter_list):
+    """
+    Stop the filters that aren't None. Returns a Deferred that fires when
+    they have all stopped.
+    """
+    stopped = []
+    for f in filter_list:
+        if f:
+            stopped.append(defer.maybeDeferred(f.stop))
+    return defer.DeferredList(stopped)
+
+def _get_file_loggers(recorder):
+    if not recorder:
+        return []
+    return [ f for f in recorder.filters
+        if isinstance(f, filters.FileLoggerFilter) ]
+
+def _hand_over_query_logs(old_recorder, new_recorder):
+    """
+    Hand the query log writers of the old recorder over to the loggers of
+    the same files in the new recorder, so the old and new writers don't
+    both append to and rotate a file until the old one stops.
+    """
+    old_loggers = dict((os.path.abspath(f.writer.path), f)
+        for f in _get_file_loggers(old_recorder))
+    for logger in _get_file_loggers(new_recorder):
+        old_logger = old_loggers.get(os.path.abspath(logger.writer.path))
+        if old_logger:
+            logger.take_over(old_logger)
+
+def _listen_admin(args, factory):
+    """
+    Serve the admin interface, including /metrics and /reload. Each worker
+    listens on the admin port plus its worker id.
+    """
+    port = args.admin_port
+    if args.worker_id is not None:
+        port += args.worker_id
+
+    site = web_server.Site(admin.AdminResource(factory.reload))
+    reactor.listenTCP(port, site, interface=args.admin_addr)
+    _LOG.info("Admin interface listening on %s:%d...", args.admin_addr, port)
+
+def _on_sighup(fn):
+    """
+    Run fn on the reactor thread whenever the process gets SIGHUP.
+    """
+    signal.signal(signal.SIGHUP,
+        lambda signum, frame: reactor.callFromThread(fn))
+
+def start_workers(args):
+    """
+    Run the dnsfilter server as a number of worker processes.
+    """
+    supervisor = workers.WorkerSupervisor(args.workers,
+        [ os.path.abspath(__file__) ] + sys.argv[1:])
+    reactor.callWhenRunning(supervisor.start)
+    _on_sighup(supervisor.reload)
+
+    _LOG.info("DNS server starting %d workers on %s:%d...", args.workers,
+        args.addr, args.port)
+    reactor.run()
+
 def start(args):
     """
     Run the dnsfilter server.
     """
+    if args.workers > 1 and args.worker_id is None:
+        return start_workers(args)
+
+    storage.init_thread_pool(args.storage_threads)
+
     # Create the controller
     factory = ServerFactory(args)
     
     protocol = dns.DNSDatagramProtocol(controller=factory)
     
-    reactor.listenUDP(args.port, protocol, args.addr)
-    reactor.listenTCP(args.port, factory, 50, args.addr)
+    if args.worker_id is None:
+        reactor.listenUDP(args.port, protocol, args.addr)
+        reactor.listenTCP(args.port, factory, 50, args.addr)
+    else:
+        _listen_reuseport(args, factory, protocol)
+        reactor.callWhenRunning(workers.notify_ready)
+
+    if args.admin_port:
+        _listen_admin(args, factory)
+    _on_sighup(lambda: factory.reload().addErrback(lambda failure: None))
 
     _LOG.info("DNS server listening on %s:%d...", args.addr, args.port)
     reactor.run()
@@ -108,8 +448,96 @@ def start(args):
 parser = utils.init_argparser("Start the DNS server", { "port": 10053 })
 parser.add_argument("--record", action="store_true", default=False, 
     help="Enable DNS lookup recording")
-args = parser.parse_args()
+parser.add_argument("--record-queue-size", type=int, default=100000,
+    help="Maximum number of recorded lookups waiting to be written")
+parser.add_argument("--record-overflow", type=str, default="drop-oldest",
+    choices=["drop-oldest", "sample"],
+    help="What to drop when the recording queue is full")
+parser.add_argument("--record-retention", type=int, default=0,
+    help="Days to keep recorded lookups in the store for (0 keeps them "
+         "forever)")
+parser.add_argument("--rollup", action="store_true", default=False,
+    help="Enable per minute counts of DNS lookups by device, domain and "
+         "verdict")
+parser.add_argument("--rollup-flush-interval", type=int, default=10,
+    help="Seconds between writes of the lookup counts")
+parser.add_argument("--rollup-retention", type=int, default=0,
+    help="Days to keep the lookup counts in the store for (0 keeps them "
+         "forever)")
+parser.add_argument("--record-file", type=str, default=None,
+    help="Record DNS lookups to this file")
+parser.add_argument("--record-format", type=str, default="text",
+    choices=["text", "ndjson"], help="Format of the records in --record-file")
+parser.add_argument("--record-rotate-size", type=int, default=0,
+    help="Rotate --record-file when it grows past this many bytes")
+parser.add_argument("--record-rotate-interval", type=int, default=0,
+    help="Rotate --record-file after this many seconds")
+parser.add_argument("--record-backups", type=int, default=0,
+    help="Number of rotated record files to keep (0 keeps all)")
+parser.add_argument("--whitelist-url", type=str, default=None,
+    help="Whitelist to filter with, e.g. snapshot:/path (defaults to the "
+         "storage url)")
+parser.add_argument("--refresh-interval", type=int, default=30,
+    help="Seconds between checks for whitelist and device changes")
+parser.add_argument("--full-refresh-interval", type=int, default=3600,
+    help="Seconds between full reloads of the whitelist and devices, to "
+         "pick up changes made without dnsfilter, e.g. directly in MongoDB")
+parser.add_argument("--block-mode", type=str, default="nxdomain",
+    choices=resolvers.BlockResponder.MODES,
+    help="How to answer blocked queries")
+parser.add_argument("--block-ttl", type=int, default=300,
+    help="TTL of blocked query responses, and their negative cache TTL")
+parser.add_argument("--sinkhole-addr", type=str, default="0.0.0.0",
+    help="IPv4 address blocked queries resolve to in sinkhole mode")
+parser.add_argument("--sinkhole-addr6", type=str, default="::",
+    help="IPv6 address blocked queries resolve to in sinkhole mode")
+parser.add_argument("--verdict-cache-size", type=int, default=10000,
+    help="Number of filter verdicts to cache (0 disables the cache)")
+parser.add_argument("--verdict-cache-ttl", type=int, default=300,
+    help="Seconds to cache a filter verdict for")
+parser.add_argument("--answer-cache-size", type=int, default=10000,
+    help="Number of upstream answers to cache (0 disables the cache)")
+parser.add_argument("--answer-cache-max-ttl", type=int, default=86400,
+    help="Maximum seconds to cache an upstream answer for")
+parser.add_argument("--no-answer-cache-prefetch", dest="answer_cache_prefetch",
+    action="store_false", default=True,
+    help="Don't refresh popular answers before they expire")
+parser.add_argument("--answer-cache-stale", type=int, default=86400,
+    help="Seconds to keep expired answers for, to serve when upstreams "
+         "fail or are slow (0 disables serving stale answers)")
+parser.add_argument("--storage-threads", type=int, default=4,
+    help="Number of threads used for storage calls")
+parser.add_argument("--upstream", type=str, action="append", default=[],
+    help="Upstream DNS server as HOST[:PORT], may be repeated (defaults to "
+         "the servers in /etc/resolv.conf)")
+parser.add_argument("--upstream-timeout", type=float, default=2.0,
+    help="Seconds to wait for an upstream server before trying the next")
+parser.add_argument("--upstream-race", action="store_true", default=False,
+    help="Send each query to the two best upstream servers and use the "
+         "first answer")
+parser.add_argument("--upstream-probe-interval", type=int, default=10,
+    help="Seconds between health probes of the upstream servers (0 "
+         "disables them)")
+parser.add_argument("--admin-addr", type=str, default="127.0.0.1",
+    help="IP address the admin interface listens on")
+parser.add_argument("--admin-port", type=int, default=0,
+    help="Port for the admin interface serving /metrics, offset by the "
+         "worker id with --workers (0 disables it)")
+parser.add_argument("--workers", type=int, default=1,
+    help="Number of worker processes to serve queries with")
+parser.add_argument("--worker-id", type=int, default=None,
+    help=argparse.SUPPRESS)
+
+def parse_args(argv=None):
+    """
+    Parse the server options, giving each worker its own record file.
+    """
+    args = parser.parse_args(argv)
+    if args.worker_id is not None and args.record_file:
+        args.record_file = _get_worker_path(args.record_file, args.worker_id)
+    return args
 
 if __name__ == '__main__':
+    args = parse_args()
     init(args)
     raise SystemExit(start(args))
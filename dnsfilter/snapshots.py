@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import hashlib
+import logging
+import mmap
+import os
+import patterns
+import struct
+
+"""
+Module containing the compiled domain snapshot format.
+
+A snapshot file is laid out as:
+
+    header   - magic "DNSFSNAP", format version, entry count and (from
+               version 2) the size of the patterns block
+    hashes   - count sorted little-endian uint64 hashes, one per entry
+    offsets  - count+1 uint32 offsets into the string table; entry i is
+               strings[offsets[i]:offsets[i+1]]
+    strings  - the utf-8 names, in the same order as the hashes
+    patterns - (version 2) newline separated utf-8 wildcard patterns
+
+Each hash is the first 8 bytes of the md5 of the name with its labels
+reversed (www.example.com is hashed as com.example.www), so lookups can
+build the candidate names while walking the labels of a query from the
+right. Files are mapped read-only, so every process using a snapshot shares
+a single page cache copy of it. Wildcard patterns are few, so they are
+compiled into a PatternIndex when the snapshot is loaded.
+"""
+
+_LOG = logging.getLogger("dnsfilter.snapshots")
+
+MAGIC = b"DNSFSNAP"
+VERSION = 2
+
+_HEADER_V1 = struct.Struct("<8sII")
+_HEADER = struct.Struct("<8sIII")
+_HASH = struct.Struct("<Q")
+_OFFSET = struct.Struct("<I")
+
+def reverse_name(name):
+    """
+    Reverse the labels of a domain name.
+    """
+    return ".".join(reversed(name.split(".")))
+
+def hash_name(reversed_name):
+    """
+    Get the 64-bit hash of a reversed domain name.
+    """
+    return _HASH.unpack_from(
+        hashlib.md5(reversed_name.encode("utf-8")).digest())[0]
+
+def write_snapshot(names, path):
+    """
+    Compile the names into a snapshot file. The file is written to a
+    temporary file and renamed into place, so readers never see a partial
+    snapshot.
+    """
+    entries = []
+    pattern_list = []
+    for name in set(names):
+        if patterns.is_pattern(name):
+            pattern_list.append(name)
+        else:
+            entries.append((hash_name(reverse_name(name)),
+                name.encode("utf-8")))
+    entries.sort()
+    pattern_data = "\n".join(sorted(pattern_list)).encode("utf-8")
+
+    tmp_path = path+".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(entries),
+            len(pattern_data)))
+        for (hash, name) in entries:
+            f.write(_HASH.pack(hash))
+
+        offset = 0
+        for (hash, name) in entries:
+            f.write(_OFFSET.pack(offset))
+            offset += len(name)
+        f.write(_OFFSET.pack(offset))
+
+        for (hash, name) in entries:
+            f.write(name)
+
+        f.write(pattern_data)
+
+    os.rename(tmp_path, path)
+    _LOG.info("Wrote snapshot of %d names and %d patterns to %s",
+        len(entries), len(pattern_list), path)
+
+class Snapshot(object):
+    """
+    A read-only, memory mapped snapshot file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, count) = _HEADER_V1.unpack_from(self.data)
+        if magic != MAGIC:
+            raise Exception("Invalid snapshot file : "+path)
+
+        if version == 1:
+            header_size = _HEADER_V1.size
+            patterns_size = 0
+        elif version == VERSION:
+            header_size = _HEADER.size
+            patterns_size = _HEADER.unpack_from(self.data)[3]
+        else:
+            raise Exception("Unsupported snapshot version %d : %s" %
+                (version, path))
+
+        self.count = count
+        self.hashes_offset = header_size
+        self.offsets_offset = self.hashes_offset + count * _HASH.size
+        self.strings_offset = self.offsets_offset + \
+            (count + 1) * _OFFSET.size
+
+        self.patterns = patterns.PatternIndex()
+        if patterns_size:
+            patterns_offset = self.strings_offset + _OFFSET.unpack_from(
+                self.data, self.strings_offset - _OFFSET.size)[0]
+            pattern_data = self.data[patterns_offset:
+                patterns_offset + patterns_size].decode("utf-8")
+            self.patterns.update(pattern_data.split("\n"))
+
+    def __len__(self):
+        return self.count + len(self.patterns)
+
+    def _hash_at(self, i):
+        return _HASH.unpack_from(self.data, self.hashes_offset +
+            i * _HASH.size)[0]
+
+    def _name_at(self, i):
+        (start, end) = struct.unpack_from("<II", self.data,
+            self.offsets_offset + i * _OFFSET.size)
+        return self.data[self.strings_offset + start:
+            self.strings_offset + end].decode("utf-8")
+
+    def _find(self, hash):
+        """
+        Binary search for the first entry with the hash, or -1.
+        """
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._hash_at(lo) == hash:
+            return lo
+        return -1
+
+    def _contains_reversed(self, reversed_name, name=None):
+        hash = hash_name(reversed_name)
+        i = self._find(hash)
+        if i < 0:
+            return False
+
+        # Check the names too, in case of a hash collision
+        if name is None:
+            name = reverse_name(reversed_name)
+        while i < self.count and self._hash_at(i) == hash:
+            if self._name_at(i) == name:
+                return True
+            i += 1
+        return False
+
+    def contains(self, name):
+        if patterns.is_pattern(name):
+            return self.patterns.contains(name)
+        return self._contains_reversed(reverse_name(name), name)
+
+    def matches(self, name):
+        """
+        Does the name, or any of its parent domains, appear in the snapshot
+        or match one of its patterns.
+
+        Bare top level domains are never matched by exact names.
+        """
+        labels = name.split(".")
+        reversed_name = labels[-1]
+        for i in range(len(labels) - 2, -1, -1):
+            reversed_name = reversed_name+"."+labels[i]
+            if self._contains_reversed(reversed_name):
+                return True
+        return self.patterns.matches(name)
+
+    def names(self):
+        for i in range(self.count):
+            yield self._name_at(i)
+        for pattern in self.patterns.get_all():
+            yield pattern
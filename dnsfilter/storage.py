@@ -13,9 +13,19 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+import collections
 import copy
+import datetime
+import json
 import logging
+import metrics
 import pymongo
+import random
+import sqlite3
+import threading
+from bson import json_util, objectid, son
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import threadpool
 
 """
 Module containing storage components.
@@ -26,6 +36,10 @@ _LOG = logging.getLogger("dnsfilter.storage")
 KNOWN_DEVICES_STORE = "known_devices"
 TRUSTED_SITES_STORE = "trusted_sites"
 REQUEST_LOG_STORE = "request_log"
+REQUEST_ROLLUP_STORE = "request_rollups"
+
+# Stores whose versions are tracked so readers can detect changes cheaply
+VERSIONED_STORES = [ KNOWN_DEVICES_STORE, TRUSTED_SITES_STORE ]
 
 class Store(object):
     """
@@ -38,12 +52,42 @@ class Store(object):
         """
         pass
 
+    def create_all(self, objects):
+        """
+        Create many named objects from a list of (name, value) pairs
+        """
+        for (name, value) in objects:
+            self.create(name, value)
+
+    def upsert_all(self, objects):
+        """
+        Create many named objects from a list of (name, value) pairs, or
+        update the ones that already exist. The writes may be applied in any
+        order.
+        """
+        for (name, value) in objects:
+            if self.read(name) is None:
+                self.create(name, value)
+            else:
+                self.update(name, value)
+
     def read(self, name):
         """
         Read the value of a named object
         """
         pass
 
+    def read_all(self, names):
+        """
+        Read many named objects, returning a dict of the ones found by name
+        """
+        objects = {}
+        for name in names:
+            obj = self.read(name)
+            if obj is not None:
+                objects[name] = obj
+        return objects
+
     def update(self, name, value):
         """
         Update the named object with the provide value
@@ -56,31 +100,516 @@ class Store(object):
         """
         pass
 
-    def find(self, query):
+    def delete_all(self, names):
+        """
+        Delete many named objects
         """
-        Find objects in the store.
+        for name in names:
+            self.delete(name)
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        """
+        Find objects in the store matching a query. Returns an iterator that
+        fetches the objects lazily, batch_size at a time where the store
+        supports it.
+
+        Query values are matched for equality, or can be a range such as
+        { "$gte": since, "$lt": until }.
+
+        projection - the properties to fetch (name is always fetched)
+        limit      - the maximum number of objects to return (0 for all)
+        skip       - the number of objects to skip
+        after      - a token from get_token(), to continue after that object
+
+        Objects are returned in the order they were created when paging
+        with limit, skip or after.
         """
         pass
 
-def create_store(url, name):
+    def get_token(self, obj):
+        """
+        Get the continuation token for an object returned by find().
+        """
+        return str(obj._id)
+
+    def increment_all(self, increments):
+        """
+        Add to the counters of many named objects, from a list of (name,
+        fields, counts) tuples. An object that doesn't exist is created
+        with the fields, and counts is a dict of the amount to add to each
+        counter.
+
+        This implementation reads and then updates each object, stores that
+        can should increment atomically where the data is.
+        """
+        for (name, fields, counts) in increments:
+            obj = self.read(name)
+            if obj is None:
+                value = dict(fields)
+                value.update(counts)
+                self.create(name, value)
+            else:
+                self.update(name, dict((counter, (obj.get(counter) or 0) +
+                    amount) for (counter, amount) in counts.items()))
+
+    def group_count(self, fields, query={}, limit=0, interval=None,
+            sum_field=None, group_limit=0):
+        """
+        Count the objects matching a query, grouped by the values of fields.
+        If interval is given the objects are also grouped by their time,
+        rounded down to interval seconds. If sum_field is given the values
+        of that field are added up instead of counting the objects. If
+        group_limit is given only the group_limit largest counts for each
+        value of the first field are kept (not with interval).
+
+        Returns a list of dicts of the field values (and "time") with a
+        "count", largest count first or in time order when grouping by
+        time. This implementation counts the results of find(), stores that
+        can should count where the data is.
+        """
+        _check_group_limit(fields, interval, group_limit)
+        projection = list(fields) + ([ "time" ] if interval else []) + \
+            ([ sum_field ] if sum_field else [])
+        counts = collections.Counter()
+        for obj in self.find(query, projection=projection):
+            key = tuple(obj.get(field) for field in fields)
+            if interval:
+                key += (_time_bucket(obj.get("time"), interval),)
+            if sum_field:
+                counts[key] += obj.get(sum_field) or 0
+            else:
+                counts[key] += 1
+
+        keys = list(fields) + ([ "time" ] if interval else [])
+        rows = []
+        for (key, count) in counts.items():
+            row = dict(zip(keys, key))
+            row["count"] = count
+            rows.append(row)
+        return _sort_counts(rows, keys, limit, interval, group_limit)
+
+    def get_version(self):
+        """
+        Get a token that changes whenever the content of the store changes,
+        or None if the store does not track versions.
+        """
+        return None
+
+    def set_retention(self, seconds):
+        """
+        Expire objects once their time is more than seconds old, or keep
+        them forever if seconds is 0. Stores that can't expire objects log
+        a warning.
+        """
+        if seconds:
+            _LOG.warning("%s does not support retention", self)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _to_millis(value):
+    """
+    Get the milliseconds since the epoch of a naive UTC datetime.
+    """
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + \
+        delta.microseconds // 1000
+
+def _time_bucket(value, interval):
+    """
+    Round a datetime down to a multiple of interval seconds.
+    """
+    if value is None:
+        return None
+    millis = _to_millis(value)
+    return _EPOCH + datetime.timedelta(
+        milliseconds=millis - millis % (interval * 1000))
+
+def _sort_counts(rows, keys, limit, interval, group_limit=0):
+    if interval:
+        rows.sort(key=lambda row: [ row["time"] ] +
+            [ row[key] for key in keys ])
+    else:
+        rows.sort(key=lambda row: [ -row["count"] ] +
+            [ row[key] for key in keys ])
+    if group_limit:
+        counts = collections.Counter()
+        kept = []
+        for row in rows:
+            group = row[keys[0]]
+            if counts[group] < group_limit:
+                kept.append(row)
+                counts[group] += 1
+        rows = kept
+    if limit:
+        rows = rows[:limit]
+    return rows
+
+def _check_group_limit(fields, interval, group_limit):
+    if group_limit and (interval or not fields):
+        raise ValueError("group_limit needs a field to group by, and no "
+            "interval")
+
+# The range operators find() understands
+_RANGE_OPERATORS = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b
+}
+
+def _is_range(value):
+    return isinstance(value, dict) and value and \
+        all(op in _RANGE_OPERATORS for op in value)
+
+def _matches(doc, query):
+    """
+    Does a document match every field of a query.
+    """
+    for (field, value) in query.items():
+        doc_value = doc.get(field)
+        if _is_range(value):
+            if doc_value is None:
+                return False
+            for (op, bound) in value.items():
+                if not _RANGE_OPERATORS[op](doc_value, bound):
+                    return False
+        elif doc_value != value:
+            return False
+    return True
+
+_THREAD_POOL = None
+
+def init_thread_pool(max_threads=4):
+    """
+    Create the thread pool that runs blocking storage calls off the reactor
+    thread. The pool is started with the reactor and stopped on shutdown.
+    """
+    global _THREAD_POOL
+    if _THREAD_POOL:
+        return _THREAD_POOL
+
+    _LOG.debug("Creating storage thread pool with %d threads", max_threads)
+    _THREAD_POOL = threadpool.ThreadPool(1, max_threads, "dnsfilter-storage")
+    reactor.callWhenRunning(_THREAD_POOL.start)
+    reactor.addSystemEventTrigger("during", "shutdown", _THREAD_POOL.stop)
+    return _THREAD_POOL
+
+def defer_to_thread(fn, *args, **kwargs):
+    """
+    Run a blocking storage function in the storage thread pool, returning a
+    Deferred that fires with its result.
+    """
+    return threads.deferToThreadPool(reactor, init_thread_pool(), fn,
+        *args, **kwargs)
+
+def create_store(url, name, acknowledged=True):
     """
     Create a new store object for the provided URL
+
+    If acknowledged is False the store may skip waiting for writes to be
+    acknowledged, where the storage type allows it.
     """
     (type, uri) = url.split(":", 1)
 
     if type == "mongo":
-        return MongoStore(uri, name)
+        return InstrumentedStore(MongoStore(uri, name, acknowledged), name)
+    if type == "memory":
+        return InstrumentedStore(MemoryStore(uri, name), name)
+    if type == "sqlite":
+        return InstrumentedStore(SQLiteStore(uri, name), name)
 
     _LOG.warning("Unknown storage type '%s'", type)
     raise Exception("Invalid storage url : "+url)
  
 
+class InstrumentedStore(Store):
+    """
+    A wrapper that times every call to another store, recording the time
+    and any errors per method in the storage metrics.
+    """
+
+    METHODS = [ "create", "create_all", "upsert_all", "read", "read_all",
+        "update", "delete", "delete_all", "find", "increment_all",
+        "group_count", "get_version" ]
+
+    def __init__(self, store, name):
+        self.store = store
+        self.timers = {}
+        for method in InstrumentedStore.METHODS:
+            self.timers[method] = (metrics.STORAGE_SECONDS.labels(name, method),
+                metrics.STORAGE_ERRORS.labels(name, method))
+
+    def _call(self, method, *args):
+        (histogram, errors) = self.timers[method]
+        started = metrics.timer()
+        try:
+            return getattr(self.store, method)(*args)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            histogram.observe_since(started)
+
+    def create(self, name, value):
+        return self._call("create", name, value)
+
+    def create_all(self, objects):
+        return self._call("create_all", objects)
+
+    def upsert_all(self, objects):
+        return self._call("upsert_all", objects)
+
+    def read(self, name):
+        return self._call("read", name)
+
+    def read_all(self, names):
+        return self._call("read_all", names)
+
+    def update(self, name, value):
+        return self._call("update", name, value)
+
+    def delete(self, name):
+        return self._call("delete", name)
+
+    def delete_all(self, names):
+        return self._call("delete_all", names)
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        (histogram, errors) = self.timers["find"]
+        started = metrics.timer()
+        try:
+            results = self.store.find(query, projection, limit, skip, after,
+                batch_size)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            elapsed = metrics.timer() - started
+        return self._time_results(results, histogram, errors, elapsed)
+
+    def _time_results(self, results, histogram, errors, elapsed):
+        """
+        Time the fetches of a lazy find() as its results are consumed.
+        """
+        results = iter(results)
+        try:
+            while True:
+                started = metrics.timer()
+                try:
+                    obj = next(results)
+                except StopIteration:
+                    return
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    elapsed += metrics.timer() - started
+                yield obj
+        finally:
+            histogram.observe(elapsed)
+
+    def get_token(self, obj):
+        return self.store.get_token(obj)
+
+    def increment_all(self, increments):
+        return self._call("increment_all", increments)
+
+    def group_count(self, fields, query={}, limit=0, interval=None,
+            sum_field=None, group_limit=0):
+        return self._call("group_count", fields, query, limit, interval,
+            sum_field, group_limit)
+
+    def get_version(self):
+        return self._call("get_version")
+
+    def set_retention(self, seconds):
+        return self.store.set_retention(seconds)
+
+    def __getattr__(self, name):
+        # Anything else is specific to the wrapped store
+        return getattr(self.store, name)
+
+    def __str__(self):
+        return str(self.store)
+
+def _find_all(store, *args):
+    return list(store.find(*args))
+
+class AsyncStore(object):
+    """
+    A wrapper that runs the calls of another store in the storage thread
+    pool. Every method of the Store interface returns a Deferred.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, name, value):
+        return defer_to_thread(self.store.create, name, value)
+
+    def create_all(self, objects):
+        return defer_to_thread(self.store.create_all, objects)
+
+    def upsert_all(self, objects):
+        return defer_to_thread(self.store.upsert_all, objects)
+
+    def read(self, name):
+        return defer_to_thread(self.store.read, name)
+
+    def read_all(self, names):
+        return defer_to_thread(self.store.read_all, names)
+
+    def update(self, name, value):
+        return defer_to_thread(self.store.update, name, value)
+
+    def delete(self, name):
+        return defer_to_thread(self.store.delete, name)
+
+    def delete_all(self, names):
+        return defer_to_thread(self.store.delete_all, names)
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        return defer_to_thread(_find_all, self.store, query, projection,
+            limit, skip, after, batch_size)
+
+    def increment_all(self, increments):
+        return defer_to_thread(self.store.increment_all, increments)
+
+    def group_count(self, fields, query={}, limit=0, interval=None,
+            sum_field=None, group_limit=0):
+        return defer_to_thread(self.store.group_count, fields, query, limit,
+            interval, sum_field, group_limit)
+
+    def get_version(self):
+        return defer_to_thread(self.store.get_version)
+
+    def __str__(self):
+        return "AsyncStore["+str(self.store)+"]"
+
+class BatchWriter(object):
+    """
+    A bounded queue of objects that are written to a store in batches.
+
+    Objects are flushed with create_all() in the storage thread pool when a
+    full batch is queued or every flush_interval seconds. When the queue is
+    full the overflow policy decides what is lost:
+
+        drop-oldest - the oldest queued object is dropped
+        sample      - the queue keeps a uniform random sample of everything
+                      added since the last flush
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    SAMPLE = "sample"
+
+    def __init__(self, store, max_size=100000, batch_size=1000,
+            flush_interval=1, overflow=DROP_OLDEST):
+        if overflow not in [ BatchWriter.DROP_OLDEST, BatchWriter.SAMPLE ]:
+            raise Exception("Invalid overflow policy : "+str(overflow))
+
+        self.store = AsyncStore(store)
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = collections.deque()
+
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._offered = 0
+        self._flushing = None
+        self._flusher = None
+
+    def add(self, name, value):
+        """
+        Queue an object to be written.
+        """
+        queue = self.queue
+        self._offered += 1
+
+        if len(queue) >= self.max_size:
+            self.dropped += 1
+            if self.overflow == BatchWriter.SAMPLE:
+                i = random.randrange(self._offered)
+                if i < len(queue):
+                    queue[i] = (name, value)
+                return
+            queue.popleft()
+
+        queue.append((name, value))
+        if len(queue) >= self.batch_size and not self._flushing:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the next batch of queued objects. Returns a Deferred that fires
+        when the batch has been written.
+        """
+        if self._flushing:
+            return self._flushing
+        if not self.queue:
+            return defer.succeed(None)
+
+        batch = []
+        for i in range(min(self.batch_size, len(self.queue))):
+            batch.append(self.queue.popleft())
+        self._offered = len(self.queue)
+
+        self._flushing = self.store.create_all(batch)
+        self._flushing.addCallbacks(self._flushed, self._flush_failed,
+            callbackArgs=(batch,), errbackArgs=(batch,))
+        return self._flushing
+
+    def _flushed(self, result, batch):
+        self.written += len(batch)
+        self._flushing = None
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def _flush_failed(self, failure, batch):
+        self.failed += len(batch)
+        self._flushing = None
+        _LOG.error("Failed to write %d objects to %s: %s", len(batch),
+            self.store, failure.getErrorMessage())
+
+    def start(self):
+        """
+        Start flushing the queue every flush_interval seconds.
+        """
+        if not self._flusher:
+            self._flusher = task.LoopingCall(self.flush)
+            self._flusher.start(self.flush_interval, now=False)
+
+    def stop(self):
+        """
+        Stop the periodic flushes and write whatever is still queued.
+        """
+        if self._flusher:
+            self._flusher.stop()
+            self._flusher = None
+        return self._drain()
+
+    def _drain(self, result=None):
+        if not self.queue and not self._flushing:
+            return defer.succeed(None)
+        return self.flush().addBoth(self._drain)
+
 class StoreObject(object):
-    
+    """
+    An object read from a store. The properties are a shallow copy of the
+    stored document.
+    """
+
     def __init__(self, name, properties={}):
         self._id = properties["_id"]
         self.name = name
-        self.properties = copy.deepcopy(properties)
+        self.properties = dict(properties)
         self.properties.pop("_id")
 
     def __iter__(self):
@@ -100,17 +629,54 @@ class StoreObject(object):
 
 _MONGO_CLIENTS = { }
 
+_MONGO_VERSIONS_COLLECTION = "store_versions"
+
+# The indexes each collection needs, as (name, keys, options)
+_MONGO_INDEXES = {
+    KNOWN_DEVICES_STORE: [
+        ("name_unique", [ ("name", pymongo.ASCENDING) ], { "unique": True })
+    ],
+    TRUSTED_SITES_STORE: [
+        ("name_unique", [ ("name", pymongo.ASCENDING) ], { "unique": True })
+    ],
+    REQUEST_LOG_STORE: [
+        ("device_time", [ ("device", pymongo.ASCENDING),
+            ("time", pymongo.DESCENDING) ], {})
+    ],
+    REQUEST_ROLLUP_STORE: [
+        ("name_unique", [ ("name", pymongo.ASCENDING) ], { "unique": True }),
+        ("device_time", [ ("device", pymongo.ASCENDING),
+            ("time", pymongo.DESCENDING) ], {})
+    ]
+}
+
+# The index that expires old objects
+_MONGO_TTL_INDEX = "time_ttl"
+
+# The collections whose indexes have been checked by this process
+_MONGO_INDEXED = set()
+
 class MongoStore(Store):
     """
     A store implementation backed by Mongo DB
+
+    The indexes a collection needs are created the first time a process
+    opens it.
+
+    The version of a versioned collection is a counter in the
+    store_versions collection, bumped by every write made through a
+    MongoStore. Writes made any other way (in the mongo shell, or by older
+    clients) don't change it, so they are only seen by the next full reload
+    of the devices and whitelist.
     """
 
-    def __init__(self, url, collection_name):
+    def __init__(self, url, collection_name, acknowledged=True):
         (host, port, db_name) = url.split(":") 
         self.host = host
         self.port = int(port)
         self.db_name = db_name
         self.collection_name = collection_name
+        self.acknowledged = acknowledged
         self._connect()
         _LOG.debug("Connected, using db=%s collection=%s", self.db_name,
             self.collection_name)
@@ -123,6 +689,68 @@ class MongoStore(Store):
 
         self.client = _MONGO_CLIENTS[key]
         self.collection = self.client[self.db_name][self.collection_name]
+        if not self.acknowledged:
+            self.collection = self.collection.with_options(
+                write_concern=pymongo.WriteConcern(w=0))
+        self.versions = self.client[self.db_name][_MONGO_VERSIONS_COLLECTION]
+        self.versioned = self.collection_name in VERSIONED_STORES
+
+        key = (self.host, self.port, self.db_name, self.collection_name)
+        if key not in _MONGO_INDEXED:
+            self._ensure_indexes()
+            _MONGO_INDEXED.add(key)
+
+    def _ensure_indexes(self):
+        collection = self.client[self.db_name][self.collection_name]
+        for (name, keys, options) in _MONGO_INDEXES.get(self.collection_name,
+                []):
+            try:
+                collection.create_index(keys, name=name, **options)
+            except pymongo.errors.OperationFailure as e:
+                if not options.get("unique"):
+                    raise
+
+                # Existing duplicates stop a unique index being built, index
+                # the keys anyway so lookups don't scan the collection
+                _LOG.error("Failed to create unique index %s on %s, remove "
+                    "the duplicates and restart: %s", name,
+                    self.collection_name, e)
+                collection.create_index(keys, name=name+"_duplicates")
+            _LOG.debug("Ensured index %s on %s", name, self.collection_name)
+
+    def set_retention(self, seconds):
+        """
+        Expire objects using a TTL index on their time field. Changing the
+        retention updates the existing index in place.
+        """
+        db = self.client[self.db_name]
+        collection = db[self.collection_name]
+        index = collection.index_information().get(_MONGO_TTL_INDEX)
+
+        if not seconds:
+            if index:
+                _LOG.info("Removing retention from %s", self.collection_name)
+                collection.drop_index(_MONGO_TTL_INDEX)
+        elif not index:
+            _LOG.info("Expiring objects in %s after %d seconds",
+                self.collection_name, seconds)
+            collection.create_index([ ("time", pymongo.ASCENDING) ],
+                name=_MONGO_TTL_INDEX, expireAfterSeconds=seconds)
+        elif index.get("expireAfterSeconds") != seconds:
+            _LOG.info("Changing retention of %s to %d seconds",
+                self.collection_name, seconds)
+            db.command("collMod", self.collection_name, index={
+                "keyPattern": { "time": pymongo.ASCENDING },
+                "expireAfterSeconds": seconds
+            })
+
+    def _changed(self):
+        if self.versioned:
+            self.versions.update(
+                { '_id': self.collection_name },
+                { '$inc': { 'version': 1 } },
+                upsert=True
+            )
 
     def _mongo_to_store(self, obj):
         if not obj:
@@ -137,7 +765,30 @@ class MongoStore(Store):
 
     def create(self, name, value):
         value["name"] = name
-        self.collection.insert(value)
+        try:
+            self.collection.insert(value)
+        except pymongo.errors.DuplicateKeyError:
+            _LOG.warning("Failed to create %s, it already exists", name)
+            return
+        self._changed()
+
+    def create_all(self, objects):
+        docs = []
+        for (name, value) in objects:
+            doc = dict(value)
+            doc["name"] = name
+            docs.append(doc)
+
+        if not docs:
+            return
+
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            _LOG.warning("Failed to create %d of %d objects: %s",
+                len(e.details["writeErrors"]), len(docs),
+                e.details["writeErrors"][0]["errmsg"])
+        self._changed()
 
     def read(self, name):
         doc = self.collection.find_one({ "name": name })
@@ -156,15 +807,754 @@ class MongoStore(Store):
             { '_id': doc["_id"] },
             { '$set': value } 
         ) 
+        self._changed()
         
     def delete(self, name):
         self.collection.remove({"name": name})
+        self._changed()
+
+    def read_all(self, names):
+        objects = {}
+        for doc in self.collection.find({ "name": { "$in": list(names) } }):
+            if doc["name"] not in objects:
+                objects[doc["name"]] = self._mongo_to_store(doc)
+        return objects
+
+    def delete_all(self, names):
+        self.collection.delete_many({ "name": { "$in": list(names) } })
+        self._changed()
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        if after is not None:
+            if not objectid.ObjectId.is_valid(after):
+                raise ValueError("Invalid continuation token : "+str(after))
+            query = dict(query)
+            query["_id"] = { "$gt": objectid.ObjectId(after) }
+
+        if projection is not None:
+            projection = dict.fromkeys(list(projection) + [ "name" ], True)
+
+        cursor = self.collection.find(query, projection)
+        if after is not None or limit or skip:
+            cursor = cursor.sort("_id", pymongo.ASCENDING)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+
+        _LOG.debug("Finding %s", str(query))
+        return ( self._mongo_to_store(doc) for doc in cursor )
+
+    def upsert_all(self, objects):
+        """
+        Write the objects with $set upserts, in a single unordered bulk
+        write.
+        """
+        requests = []
+        for (name, value) in objects:
+            doc = dict(value)
+            doc["name"] = name
+            requests.append(pymongo.UpdateOne({ "name": name },
+                { "$set": doc }, upsert=True))
+
+        if not requests:
+            return
+
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            _LOG.warning("Failed to upsert %d of %d objects: %s",
+                len(e.details["writeErrors"]), len(requests),
+                e.details["writeErrors"][0]["errmsg"])
+        self._changed()
+
+    def increment_all(self, increments):
+        """
+        Increment the objects with $inc upserts, in a single unordered bulk
+        write.
+        """
+        requests = []
+        for (name, fields, counts) in increments:
+            fields = dict(fields)
+            fields["name"] = name
+            requests.append(pymongo.UpdateOne({ "name": name },
+                { "$setOnInsert": fields, "$inc": counts }, upsert=True))
+
+        if not requests:
+            return
+
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            _LOG.warning("Failed to increment %d of %d objects: %s",
+                len(e.details["writeErrors"]), len(requests),
+                e.details["writeErrors"][0]["errmsg"])
+        self._changed()
+
+    def group_count(self, fields, query={}, limit=0, interval=None,
+            sum_field=None, group_limit=0):
+        _check_group_limit(fields, interval, group_limit)
+        group_id = dict((field, "$"+field) for field in fields)
+        if interval:
+            # Round the time down with date arithmetic, so Mongo 3.x can
+            # run the pipeline
+            group_id["time"] = { "$subtract": [ "$time", { "$mod": [
+                { "$subtract": [ "$time", _EPOCH ] }, interval * 1000 ] } ] }
+
+        pipeline = [
+            { "$match": query },
+            { "$group": { "_id": group_id, "count": { "$sum":
+                "$"+sum_field if sum_field else 1 } } },
+            { "$sort": son.SON([ ("_id.time", 1), ("_id", 1) ]) if interval
+                else son.SON([ ("count", -1), ("_id", 1) ]) }
+        ]
+        if group_limit:
+            # Collect the counts of each value of the first field, largest
+            # first, and keep the first group_limit of them
+            pipeline.extend([
+                { "$group": { "_id": "$_id."+fields[0], "rows": { "$push":
+                    { "_id": "$_id", "count": "$count" } } } },
+                { "$project": { "rows": { "$slice": [ "$rows",
+                    group_limit ] } } },
+                { "$unwind": "$rows" },
+                { "$project": { "_id": "$rows._id",
+                    "count": "$rows.count" } },
+                { "$sort": son.SON([ ("count", -1), ("_id", 1) ]) }
+            ])
+        if limit:
+            pipeline.append({ "$limit": limit })
+
+        _LOG.debug("Running pipeline %s", pipeline)
+        rows = []
+        for doc in self.collection.aggregate(pipeline, allowDiskUse=True):
+            row = dict(doc["_id"])
+            row["count"] = doc["count"]
+            rows.append(row)
+        return rows
+
+    def get_version(self):
+        if not self.versioned:
+            return None
+
+        doc = self.versions.find_one({ '_id': self.collection_name })
+        if not doc:
+            return 0
+        return doc["version"]
+
+def _parse_int_token(after):
+    try:
+        return int(after)
+    except ValueError:
+        raise ValueError("Invalid continuation token : "+str(after))
+
+def _project(doc, projection):
+    if projection is None:
+        return doc
+    result = { "_id": doc["_id"], "name": doc.get("name") }
+    for field in projection:
+        if field in doc:
+            result[field] = doc[field]
+    return result
+
+_MEMORY_DATABASES = { }
+
+# The index key of values that can't be hashed
+_UNHASHABLE = object()
+
+class _MemoryCollection(object):
+    """
+    The objects of a memory store collection, with secondary indexes on the
+    fields that have been queried.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.objects = collections.OrderedDict()
+        self.version = 0
+        self.next_id = 0
+
+        # field -> value -> ids of the objects with that value. Objects
+        # whose value can't be hashed are kept under _UNHASHABLE.
+        self.indexes = { "name": {} }
+
+    def _index_key(self, value):
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return _UNHASHABLE
+
+    def _index_doc(self, field, index, doc):
+        key = self._index_key(doc.get(field))
+        index.setdefault(key, set()).add(doc["_id"])
+
+    def _unindex_doc(self, field, index, doc):
+        key = self._index_key(doc.get(field))
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(doc["_id"])
+            if not ids:
+                del index[key]
+
+    def insert(self, doc):
+        self.next_id += 1
+        doc["_id"] = self.next_id
+        self.objects[doc["_id"]] = doc
+        for (field, index) in self.indexes.items():
+            self._index_doc(field, index, doc)
+
+    def update(self, doc, value):
+        for (field, index) in self.indexes.items():
+            self._unindex_doc(field, index, doc)
+        doc.update(value)
+        for (field, index) in self.indexes.items():
+            self._index_doc(field, index, doc)
+
+    def remove(self, doc):
+        for (field, index) in self.indexes.items():
+            self._unindex_doc(field, index, doc)
+        del self.objects[doc["_id"]]
+
+    def _get_index(self, field):
+        index = self.indexes.get(field)
+        if index is None:
+            _LOG.debug("Indexing field %s", field)
+            index = {}
+            for doc in self.objects.values():
+                self._index_doc(field, index, doc)
+            self.indexes[field] = index
+        return index
+
+    def find(self, query):
+        """
+        Find the objects matching every field of a query, using the index
+        of the first field matched for equality.
+        """
+        equality = [ (field, value) for (field, value) in query.items()
+            if not _is_range(value) ]
+        if not equality:
+            return [ doc for doc in self.objects.values()
+                if _matches(doc, query) ]
+
+        (field, value) = sorted(equality)[0]
+        index = self._get_index(field)
+        key = self._index_key(value)
+        ids = set(index.get(key, ()))
+        if key is not _UNHASHABLE:
+            ids.update(index.get(_UNHASHABLE, ()))
 
-    def find(self, query={}):
         result = []
-        for doc in self.collection.find(query):
-            _LOG.debug("Found doc %s", doc)
-            result.append(self._mongo_to_store(doc))
-       
-        _LOG.debug("Found %d results for %s", len(result), str(query))
+        for id in sorted(ids):
+            doc = self.objects[id]
+            if _matches(doc, query):
+                result.append(doc)
         return result
+
+class MemoryStore(Store):
+    """
+    A store implementation that keeps its objects in a dict in the current
+    process. Stores created with the same url share their objects, which
+    makes it useful for tests, benchmarks and single process deployments
+    that don't need the data to outlive the process.
+
+    Fields are indexed the first time they are queried, so find() with an
+    equality query only looks at the objects that match its first field.
+    """
+
+    def __init__(self, db_name, collection_name):
+        self.db_name = db_name
+        self.collection_name = collection_name
+        db = _MEMORY_DATABASES.setdefault(db_name, {})
+        if collection_name not in db:
+            db[collection_name] = _MemoryCollection()
+        self.collection = db[collection_name]
+        self.versioned = collection_name in VERSIONED_STORES
+
+    def _to_store(self, doc):
+        return StoreObject(doc["name"], doc)
+
+    def create(self, name, value):
+        self.create_all([ (name, value) ])
+
+    def create_all(self, objects):
+        with self.collection.lock:
+            for (name, value) in objects:
+                doc = copy.deepcopy(value)
+                doc["name"] = name
+                self.collection.insert(doc)
+            self.collection.version += 1
+
+    def upsert_all(self, objects):
+        with self.collection.lock:
+            for (name, value) in objects:
+                doc = copy.deepcopy(value)
+                doc["name"] = name
+                for existing in self.collection.find({ "name": name }):
+                    self.collection.update(existing, doc)
+                    break
+                else:
+                    self.collection.insert(doc)
+            self.collection.version += 1
+
+    def read(self, name):
+        with self.collection.lock:
+            for doc in self.collection.find({ "name": name }):
+                return self._to_store(doc)
+        return None
+
+    def read_all(self, names):
+        objects = {}
+        with self.collection.lock:
+            for name in names:
+                for doc in self.collection.find({ "name": name }):
+                    objects[name] = self._to_store(doc)
+                    break
+        return objects
+
+    def update(self, name, value):
+        with self.collection.lock:
+            for doc in self.collection.find({ "name": name }):
+                self.collection.update(doc, copy.deepcopy(value))
+                self.collection.version += 1
+                return
+        _LOG.warning("Failed to update missing object %s", name)
+
+    def delete(self, name):
+        self.delete_all([ name ])
+
+    def delete_all(self, names):
+        with self.collection.lock:
+            for name in names:
+                for doc in self.collection.find({ "name": name }):
+                    self.collection.remove(doc)
+            self.collection.version += 1
+
+    def increment_all(self, increments):
+        with self.collection.lock:
+            for (name, fields, counts) in increments:
+                docs = self.collection.find({ "name": name })
+                if not docs:
+                    doc = copy.deepcopy(fields)
+                    doc["name"] = name
+                    doc.update(counts)
+                    self.collection.insert(doc)
+                    continue
+
+                doc = docs[0]
+                self.collection.update(doc, dict((counter,
+                    (doc.get(counter) or 0) + amount)
+                    for (counter, amount) in counts.items()))
+            self.collection.version += 1
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        if after is not None:
+            after = _parse_int_token(after)
+
+        with self.collection.lock:
+            docs = self.collection.find(query)
+        return self._iter_docs(docs, projection, limit, skip, after)
+
+    def _iter_docs(self, docs, projection, limit, skip, after):
+        count = 0
+        for doc in docs:
+            if after is not None and doc["_id"] <= after:
+                continue
+            if skip:
+                skip -= 1
+                continue
+
+            # Copy the document, so callers can't change the stored one
+            yield self._to_store(copy.deepcopy(_project(doc, projection)))
+            count += 1
+            if count == limit:
+                return
+
+    def get_version(self):
+        if not self.versioned:
+            return None
+        return self.collection.version
+
+    def __str__(self):
+        return "MemoryStore["+self.db_name+"/"+self.collection_name+"]"
+
+_SQLITE_VERSIONS_TABLE = "store_versions"
+
+# Decode dates as naive UTC datetimes, as pymongo does
+_SQLITE_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+# The types that can be compared in SQL, other query values are compared
+# after the rows are decoded
+_SQLITE_SCALARS = (basestring, bool, int, long, float, type(None))
+
+def _sqlite_dumps(doc):
+    """
+    Encode a document as JSON, with extended JSON for any BSON types. Plain
+    documents skip the much slower json_util conversion.
+    """
+    for value in doc.itervalues():
+        if not isinstance(value, _SQLITE_SCALARS):
+            return json_util.dumps(doc)
+    return json.dumps(doc)
+
+def _sqlite_loads(text):
+    """
+    Decode a document encoded by _sqlite_dumps.
+    """
+    if "{\"$" in text:
+        return json_util.loads(text, json_options=_SQLITE_JSON_OPTIONS)
+    return json.loads(text)
+
+# The most parameters bound to one statement, below SQLite's default limit
+_SQLITE_MAX_PARAMS = 500
+
+_SQLITE_OPERATORS = { "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=" }
+
+def _json_path(*fields):
+    """
+    Get the JSON path of a (nested) field, for json_extract.
+    """
+    return "$"+"".join(".\""+field.replace("\"", "\\\"")+"\""
+        for field in fields)
+
+def _sql_str(value):
+    """
+    Quote a string for use as a SQL literal.
+    """
+    return "'"+value.replace("'", "''")+"'"
+
+class SQLiteStore(Store):
+    """
+    A store implementation backed by a SQLite database file.
+
+    Each collection is a table of JSON documents with an indexed name
+    column. The database runs in WAL mode, so readers don't block the
+    writer, and each thread uses its own connection. find() compares
+    equality queries in SQL with json_extract.
+    """
+
+    def __init__(self, path, collection_name):
+        self.path = path
+        self.collection_name = collection_name
+        self.versioned = collection_name in VERSIONED_STORES
+        self.local = threading.local()
+
+        table = "\"" + collection_name.replace("\"", "\"\"") + "\""
+        self.table = table
+        self.insert_sql = "INSERT INTO "+table+" (name, doc) VALUES (?, ?)"
+        self.read_sql = "SELECT id, doc FROM "+table+" WHERE name = ? " \
+            "ORDER BY id LIMIT 1"
+        self.update_sql = "UPDATE "+table+" SET doc = ? WHERE id = ?"
+        self.delete_sql = "DELETE FROM "+table+" WHERE name = ?"
+        self.find_sql = "SELECT id, doc FROM "+table
+        self.version_sql = "SELECT version FROM "+_SQLITE_VERSIONS_TABLE+ \
+            " WHERE collection = ?"
+        self.changed_sql = "INSERT OR REPLACE INTO "+_SQLITE_VERSIONS_TABLE+ \
+            " (collection, version) VALUES (?, COALESCE((SELECT version " \
+            "FROM "+_SQLITE_VERSIONS_TABLE+" WHERE collection = ?), 0) + 1)"
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS "+table+" (id INTEGER "
+                "PRIMARY KEY, name TEXT, doc TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS \""+collection_name+
+                "_name\" ON "+table+" (name)")
+            conn.execute("CREATE TABLE IF NOT EXISTS "+_SQLITE_VERSIONS_TABLE+
+                " (collection TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        _LOG.debug("Opened sqlite db=%s table=%s", path, collection_name)
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            _LOG.debug("Connecting to sqlite %s", self.path)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _changed(self, conn):
+        if self.versioned:
+            conn.execute(self.changed_sql, (self.collection_name,
+                self.collection_name))
+
+    def _encode(self, name, value):
+        doc = dict(value)
+        doc.pop("_id", None)
+        doc["name"] = name
+        return _sqlite_dumps(doc)
+
+    def _to_store(self, row):
+        doc = _sqlite_loads(row[1])
+        doc["_id"] = row[0]
+        return StoreObject(doc.get("name"), doc)
+
+    def create(self, name, value):
+        self.create_all([ (name, value) ])
+
+    def create_all(self, objects):
+        rows = [ (name, self._encode(name, value))
+            for (name, value) in objects ]
+        if not rows:
+            return
+
+        with self._connect() as conn:
+            conn.executemany(self.insert_sql, rows)
+            self._changed(conn)
+
+    def upsert_all(self, objects):
+        objects = list(objects)
+        if not objects:
+            return
+
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+
+            # Merge the values into the first object of each name, as read()
+            # and update() do, then write each object once
+            docs = {}
+            ids = {}
+            for i in range(0, len(objects), _SQLITE_MAX_PARAMS):
+                names = [ name for (name, value)
+                    in objects[i:i + _SQLITE_MAX_PARAMS] ]
+                sql = self.find_sql+" WHERE name IN ("+ \
+                    ", ".join("?" * len(names))+") ORDER BY id"
+                for row in conn.execute(sql, names):
+                    obj = self._to_store(row)
+                    if obj.name not in ids:
+                        ids[obj.name] = row[0]
+                        docs[obj.name] = obj.properties
+            created = []
+            for (name, value) in objects:
+                if name not in docs:
+                    docs[name] = {}
+                    created.append(name)
+                docs[name].update(value)
+
+            updates = [ (self._encode(name, docs[name]), ids[name])
+                for name in ids ]
+            inserts = [ (name, self._encode(name, docs[name]))
+                for name in created ]
+            conn.executemany(self.update_sql, updates)
+            conn.executemany(self.insert_sql, inserts)
+            self._changed(conn)
+
+    def read(self, name):
+        row = self._connect().execute(self.read_sql, (name,)).fetchone()
+        if not row:
+            return None
+        return self._to_store(row)
+
+    def read_all(self, names):
+        names = list(names)
+        objects = {}
+        conn = self._connect()
+        for i in range(0, len(names), _SQLITE_MAX_PARAMS):
+            chunk = names[i:i + _SQLITE_MAX_PARAMS]
+            sql = self.find_sql+" WHERE name IN ("+ \
+                ", ".join("?" * len(chunk))+") ORDER BY id"
+            for row in conn.execute(sql, chunk):
+                obj = self._to_store(row)
+                if obj.name not in objects:
+                    objects[obj.name] = obj
+        return objects
+
+    def update(self, name, value):
+        with self._connect() as conn:
+            row = conn.execute(self.read_sql, (name,)).fetchone()
+            if not row:
+                _LOG.warning("Failed to update missing object %s", name)
+                return
+
+            doc = _sqlite_loads(row[1])
+            doc.update(value)
+            conn.execute(self.update_sql, (self._encode(name, doc), row[0]))
+            self._changed(conn)
+
+    def delete(self, name):
+        self.delete_all([ name ])
+
+    def delete_all(self, names):
+        with self._connect() as conn:
+            conn.executemany(self.delete_sql, [ (name,) for name in names ])
+            self._changed(conn)
+
+    def increment_all(self, increments):
+        """
+        Increment the objects in a single transaction, which takes the write
+        lock up front so other processes can't create the same objects
+        between the reads and the writes.
+        """
+        if not increments:
+            return
+
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for (name, fields, counts) in increments:
+                row = conn.execute(self.read_sql, (name,)).fetchone()
+                if not row:
+                    doc = dict(fields)
+                    doc.update(counts)
+                    conn.execute(self.insert_sql,
+                        (name, self._encode(name, doc)))
+                    continue
+
+                doc = _sqlite_loads(row[1])
+                for (counter, amount) in counts.items():
+                    doc[counter] = (doc.get(counter) or 0) + amount
+                conn.execute(self.update_sql, (self._encode(name, doc),
+                    row[0]))
+            self._changed(conn)
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        (clauses, params, remaining) = self._where(query)
+        if after is not None:
+            clauses.append("id > ?")
+            params.append(_parse_int_token(after))
+
+        sql = self.find_sql
+        if clauses:
+            sql += " WHERE "+" AND ".join(clauses)
+        sql += " ORDER BY id"
+
+        # Page in SQL unless some of the query is checked after decoding
+        if not remaining and (limit or skip):
+            sql += " LIMIT ? OFFSET ?"
+            params += [ limit or -1, skip ]
+            (limit, skip) = (0, 0)
+
+        _LOG.debug("Finding %s", str(query))
+        cursor = self._connect().execute(sql, params)
+        return self._iter_rows(cursor, remaining, projection, limit, skip)
+
+    def _where(self, query):
+        """
+        Get the SQL clauses and parameters for a query, and the part of it
+        that can only be checked after the rows are decoded.
+        """
+        clauses = []
+        params = []
+        remaining = {}
+        for (field, value) in sorted(query.items()):
+            if _is_range(value):
+                for (op, bound) in sorted(value.items()):
+                    (expr, bound) = self._range_expr(field, bound)
+                    if expr is None:
+                        remaining[field] = value
+                        continue
+                    clauses.append(expr+" "+_SQLITE_OPERATORS[op]+" ?")
+                    params.append(bound)
+            elif not isinstance(value, _SQLITE_SCALARS):
+                remaining[field] = value
+            elif field == "name":
+                clauses.append("name IS ?")
+                params.append(value)
+            else:
+                clauses.append("json_extract(doc, ?) IS ?")
+                params.append(_json_path(field))
+                params.append(value)
+        return (clauses, params, remaining)
+
+    def _range_expr(self, field, bound):
+        if isinstance(bound, datetime.datetime):
+            # Dates are encoded as { "$date": millis }
+            path = _json_path(field, "$date")
+            bound = _to_millis(bound)
+        elif isinstance(bound, _SQLITE_SCALARS):
+            path = _json_path(field)
+        else:
+            return (None, None)
+        return ("json_extract(doc, "+_sql_str(path)+")", bound)
+
+    def group_count(self, fields, query={}, limit=0, interval=None,
+            sum_field=None, group_limit=0):
+        _check_group_limit(fields, interval, group_limit)
+        (clauses, params, remaining) = self._where(query)
+        if remaining:
+            return Store.group_count(self, fields, query, limit, interval,
+                sum_field, group_limit)
+
+        columns = [ "json_extract(doc, "+_sql_str(_json_path(field))+")"
+            for field in fields ]
+        keys = list(fields)
+        if interval:
+            millis = interval * 1000
+            path = _sql_str(_json_path("time", "$date"))
+            columns.append("CAST(json_extract(doc, %s) / %d AS INTEGER) * %d"
+                % (path, millis, millis))
+            keys.append("time")
+
+        group_by = ", ".join(str(i + 1) for i in range(len(columns)))
+        if sum_field:
+            count = "TOTAL(json_extract(doc, "+ \
+                _sql_str(_json_path(sum_field))+"))"
+        else:
+            count = "COUNT(*)"
+        select = columns + [ count ]
+        if group_limit:
+            # Number the counts of each value of the first field, largest
+            # first, so that the query below keeps the first group_limit
+            select.append("ROW_NUMBER() OVER (PARTITION BY "+columns[0]+
+                " ORDER BY "+count+" DESC, "+", ".join(columns)+")")
+            select = [ "%s AS c%d" % (column, i)
+                for (i, column) in enumerate(select) ]
+        sql = "SELECT "+", ".join(select)+" FROM "+self.table
+        if clauses:
+            sql += " WHERE "+" AND ".join(clauses)
+        if group_by:
+            sql += " GROUP BY "+group_by
+        order = [ str(i + 1) for i in range(len(columns)) ]
+        if interval:
+            order.insert(0, order.pop())
+        else:
+            order.insert(0, str(len(columns) + 1)+" DESC")
+        if group_limit:
+            sql = "SELECT "+", ".join("c%d" % i for i in range(len(columns)
+                + 1))+" FROM ("+sql+") WHERE c%d <= %d" % (len(columns) + 1,
+                group_limit)
+        sql += " ORDER BY "+", ".join(order)
+        if limit:
+            sql += " LIMIT %d" % limit
+
+        rows = []
+        for row in self._connect().execute(sql, params):
+            result = dict(zip(keys, row))
+            if interval and result["time"] is not None:
+                result["time"] = _EPOCH + datetime.timedelta(
+                    milliseconds=result["time"])
+            result["count"] = int(row[-1])
+            rows.append(result)
+        return rows
+
+    def _iter_rows(self, cursor, remaining, projection, limit, skip):
+        count = 0
+        for row in cursor:
+            doc = _sqlite_loads(row[1])
+            doc["_id"] = row[0]
+            if _matches(doc, remaining):
+                if skip:
+                    skip -= 1
+                    continue
+
+                yield StoreObject(doc.get("name"), _project(doc, projection))
+                count += 1
+                if count == limit:
+                    return
+
+    def get_version(self):
+        if not self.versioned:
+            return None
+
+        row = self._connect().execute(self.version_sql,
+            (self.collection_name,)).fetchone()
+        if not row:
+            return 0
+        return row[0]
+
+    def __str__(self):
+        return "SQLiteStore["+self.path+"/"+self.collection_name+"]"
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import logging
+from twisted.internet import defer, task
+from twisted.names import client, common, dns, error
+from twisted.python import failure
+import metrics
+
+"""
+Module containing the upstream resolver pool.
+"""
+
+_LOG = logging.getLogger("dnsfilter.upstreams")
+
+# The errors that are answers from an upstream, rather than failures of it.
+# The other rcode errors (SERVFAIL, REFUSED...) subclass DomainError too, so
+# NXDOMAIN is matched by its own class.
+_ANSWER_ERRORS = (error.DNSNameError, error.AuthoritativeDomainError)
+
+def _is_answer(result):
+    return not isinstance(result, failure.Failure) or \
+        result.check(*_ANSWER_ERRORS) is not None
+
+def read_resolv_conf(path="/etc/resolv.conf"):
+    """
+    Get the (host, port) of the nameservers in a resolv.conf file, or the
+    local nameserver if it doesn't list any.
+    """
+    servers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    servers.append((fields[1], dns.PORT))
+    except IOError as e:
+        _LOG.warning("Failed to read %s: %s", path, e)
+
+    if not servers:
+        _LOG.warning("No nameservers found in %s, using 127.0.0.1", path)
+        servers.append(("127.0.0.1", dns.PORT))
+    return servers
+
+class Upstream(object):
+    """
+    An upstream DNS server, with its smoothed round trip time and failure
+    rate.
+
+    The srtt and failure rate are exponentially weighted moving averages of
+    the answers and failures seen, by live queries and by probes. After
+    max_failures failures in a row the upstream is marked down until it
+    answers again.
+    """
+
+    def __init__(self, addr, alpha=0.125, max_failures=3):
+        self.addr = addr
+        self.name = "%s:%d" % addr
+        self.resolver = client.Resolver(servers=[ addr ])
+        self.alpha = alpha
+        self.max_failures = max_failures
+
+        self.srtt = None
+        self.failure_rate = 0.0
+        self.failures = 0
+        self.healthy = True
+
+        self.answered = metrics.UPSTREAM_SERVER_SECONDS.labels(self.name,
+            "answer")
+        self.failed = metrics.UPSTREAM_SERVER_SECONDS.labels(self.name,
+            "error")
+
+    def score(self, timeout):
+        """
+        Get the expected time for the upstream to answer a query, counting
+        a failure as a timeout. Upstreams that have not answered yet score
+        0, so they are tried.
+        """
+        return (self.srtt or 0.0) + self.failure_rate * timeout
+
+    def query(self, query, timeout):
+        """
+        Send a query to the upstream, with a single attempt of timeout
+        seconds.
+        """
+        started = metrics.timer()
+        d = self.resolver.query(query, (timeout,))
+        d.addBoth(self._done, started)
+        return d
+
+    def _done(self, result, started):
+        rtt = metrics.timer() - started
+        if _is_answer(result):
+            self.answered.observe(rtt)
+            self._succeeded(rtt)
+        else:
+            self.failed.observe(rtt)
+            self._failed(result)
+        return result
+
+    def _succeeded(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.failure_rate -= self.alpha * self.failure_rate
+        self.failures = 0
+        if not self.healthy:
+            _LOG.info("Upstream %s is answering again", self.name)
+            self.healthy = True
+
+    def _failed(self, reason):
+        self.failure_rate += self.alpha * (1.0 - self.failure_rate)
+        self.failures += 1
+        if self.healthy and self.failures >= self.max_failures:
+            _LOG.warning("Upstream %s is down after %d failures: %s",
+                self.name, self.failures, reason.getErrorMessage())
+            self.healthy = False
+
+    def __str__(self):
+        return "Upstream[%s srtt=%s failure_rate=%.2f healthy=%s]" % (
+            self.name, self.srtt, self.failure_rate, self.healthy)
+
+class _Race(object):
+    """
+    The first answer from a number of upstreams sent the same query.
+    """
+
+    def __init__(self, count):
+        self.result = defer.Deferred()
+        self.pending = count
+
+    def done(self, result):
+        self.pending -= 1
+        if self.result.called:
+            return None
+
+        # Wait for the others when one fails, unless it was the last
+        if not _is_answer(result) and self.pending:
+            return None
+
+        if isinstance(result, failure.Failure):
+            self.result.errback(result)
+        else:
+            self.result.callback(result)
+
+class UpstreamPool(common.ResolverBase):
+    """
+    A resolver that sends queries to the best of a pool of upstream DNS
+    servers.
+
+    Healthy upstreams are tried in order of their score (srtt plus the
+    expected cost of a failure), moving on to the next when one times out
+    or fails, so a degraded upstream is only tried while it is still
+    faster than the others. If race is set a query is sent to the best two
+    upstreams at once and the first answer is used. Every upstream is
+    probed every probe_interval seconds, keeping the srtt of the unused
+    ones current and bringing upstreams that were down back into rotation.
+    """
+
+    def __init__(self, servers, timeout=2.0, race=False, probe_interval=10,
+            probe_name=".", max_failures=3):
+        common.ResolverBase.__init__(self)
+        self.upstreams = []
+        self.max_failures = max_failures
+        self.probe_query = dns.Query(probe_name, dns.NS, dns.IN)
+        self._prober = None
+        self.configure(servers, timeout, race, probe_interval)
+
+        metrics.REGISTRY.callback("dnsfilter_upstreams_healthy", "gauge",
+            "Upstream servers in rotation",
+            lambda: len([ u for u in self.upstreams if u.healthy ]))
+
+    def configure(self, servers, timeout=2.0, race=False, probe_interval=10):
+        """
+        Change the servers and settings of the pool. Servers that stay in
+        the pool keep their srtt and health.
+        """
+        if not servers:
+            raise Exception("No upstream servers")
+
+        existing = dict((u.addr, u) for u in self.upstreams)
+        self.upstreams = [ existing.get(addr) or
+            Upstream(addr, max_failures=self.max_failures)
+            for addr in servers ]
+        self.timeout = timeout
+        self.race = race
+
+        if self._prober and probe_interval != self.probe_interval:
+            self.stop()
+            self.probe_interval = probe_interval
+            self.start()
+        else:
+            self.probe_interval = probe_interval
+
+    def start(self):
+        if self.probe_interval and not self._prober:
+            self._prober = task.LoopingCall(self.probe)
+            self._prober.start(self.probe_interval, now=False)
+
+    def stop(self):
+        if self._prober:
+            self._prober.stop()
+            self._prober = None
+
+    def probe(self):
+        """
+        Send the probe query to every upstream. Returns a Deferred that
+        fires when they have all answered or failed.
+        """
+        probes = []
+        for upstream in self.upstreams:
+            d = upstream.query(self.probe_query, self.timeout)
+            d.addErrback(lambda reason: None)
+            probes.append(d)
+        return defer.DeferredList(probes)
+
+    def get_upstreams(self):
+        """
+        Get the upstreams in the order to try them, best first. If every
+        upstream is down they are all tried anyway.
+        """
+        upstreams = [ u for u in self.upstreams if u.healthy ] or \
+            self.upstreams
+        return sorted(upstreams, key=lambda u: u.score(self.timeout))
+
+    def _lookup(self, name, cls, type, timeout):
+        query = dns.Query(name, type, cls)
+        upstreams = self.get_upstreams()
+
+        if self.race and len(upstreams) > 1:
+            race = _Race(2)
+            for upstream in upstreams[:2]:
+                upstream.query(query, self.timeout).addBoth(race.done)
+            d = race.result
+            upstreams = upstreams[2:]
+        else:
+            d = upstreams[0].query(query, self.timeout)
+            upstreams = upstreams[1:]
+
+        return d.addErrback(self._failover, query, upstreams)
+
+    def _failover(self, reason, query, upstreams):
+        if _is_answer(reason) or not upstreams:
+            return reason
+
+        _LOG.debug("Retrying %s with %s: %s", query, upstreams[0],
+            reason.getErrorMessage())
+        d = upstreams[0].query(query, self.timeout)
+        return d.addErrback(self._failover, query, upstreams[1:])
+
+    def __str__(self):
+        return "UpstreamPool["+", ".join(str(u) for u in self.upstreams)+"]"
@@ -49,8 +49,13 @@ def init_logging(fmt, debug, quiet, filename):
 def init_argparser(desc, defaults={}, is_server=True):
     """
     Init a default argparser
+
+    Arguments can also be read from files named on the command line as
+    @PATH, with any number of arguments per line and # comments.
     """
-    parser = argparse.ArgumentParser(description=desc)
+    parser = argparse.ArgumentParser(description=desc,
+        fromfile_prefix_chars="@")
+    parser.convert_arg_line_to_args = _convert_arg_line
 
     if is_server:
         parser.add_argument('--addr', nargs='?', type=str, default="", 
@@ -60,7 +65,8 @@ def init_argparser(desc, defaults={}, is_server=True):
 
     parser.add_argument('--storage-url', nargs='?', type=str,
         default="mongo:localhost:27017:dnsfilter", 
-        help="A storage service to use", dest="url")
+        help="A storage service to use: mongo:HOST:PORT:DB, sqlite:PATH or "
+             "memory:NAME", dest="url")
     parser.add_argument("--debug", action="store_true", default=False,
         help="Enable debugging mode (verbose logging)")
     parser.add_argument("--quiet", action="store_true", default=False,
@@ -70,5 +76,25 @@ def init_argparser(desc, defaults={}, is_server=True):
 
     return parser
 
+def _convert_arg_line(line):
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return []
+    return line.split()
+
+def parse_addr(value, default_port=53):
+    """
+    Parse a HOST[:PORT] string into a (host, port) tuple. IPv6 addresses
+    with a port are written as [ADDR]:PORT.
+    """
+    if value.startswith("["):
+        (host, rest) = value[1:].split("]", 1)
+        port = rest[1:] if rest.startswith(":") else None
+    elif value.count(":") == 1:
+        (host, port) = value.split(":")
+    else:
+        (host, port) = (value, None)
+    return (host, int(port) if port else default_port)
+
 def get_current_user():
     return pwd.getpwuid(os.getuid())[0]+"@"+socket.gethostname()
@@ -18,11 +18,14 @@ from bson import json_util
 import json
 import logging
 import os
+import querylog
+import rollups
 import storage
-from twisted.internet import reactor
+from twisted.internet import defer, interfaces, reactor, task
 from twisted.web import static, server, resource, http
 import utils
 import whitelists
+from zope.interface import implementer
 
 """
 Module containing the web interface
@@ -30,18 +33,50 @@ Module containing the web interface
 
 _LOG = logging.getLogger("dnsfilter.web")
 
+class HTTPError(Exception):
+    """
+    An error to send as the response to a request.
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
 class WebResource(resource.Resource):
 
     """
     Base resource type
+
+    Storage calls block, so handlers run them in the storage thread pool
+    with _defer() and return NOT_DONE_YET, leaving the reactor free to serve
+    other requests.
     """
 
     def render(self, request):
         _LOG.info("Request received: %s", request)
         
         response = resource.Resource.render(self, request)
+        if response is server.NOT_DONE_YET:
+            return response
         return _get_response(request, response)
 
+    def getChild(self, path, request):
+        # Handlers dispatch on the full request path. The wrapper doesn't
+        # wrap the children it returns, so wrap the handler again for them
+        return _gzip(self)
+
+    def _defer(self, request, fn, *args):
+        """
+        Run fn in the storage thread pool and send its result as the
+        response. fn may raise an HTTPError to send an error response.
+        """
+        d = storage.defer_to_thread(fn, *args)
+        d.addCallback(_finish, request)
+        d.addErrback(_finish_error, request)
+        _cancel_on_disconnect(d, request)
+        return server.NOT_DONE_YET
+
     def _done(self, request):
         return "DONE\n"
 
@@ -65,12 +100,15 @@ class RootWebResource(WebResource):
 
     def __init__(self, args):
         WebResource.__init__(self)
-        self.putChild("sites", SitesWebservice(args.url))
-        self.putChild("devices", DevicesWebservice(args.url))
+        self.putChild("sites", _gzip(SitesWebservice(args.url)))
+        self.putChild("devices", _gzip(DevicesWebservice(args.url)))
+        self.putChild("logs", _gzip(LogsWebservice(args.url)))
+        self.putChild("rollups", _gzip(RollupsWebservice(args.url)))
         self.putChild("admin", static.File(os.getcwd()+"/www/admin"))
+        self.index = static.File(os.getcwd()+"/www/index.html")
 
     def getChild(self, path, request):
-        return static.File(os.getcwd()+"/www/index.html")
+        return self.index
 
 class WelcomeHandler(WebResource):
     
@@ -89,11 +127,9 @@ class SitesWebservice(WebResource):
 
     def __init__(self, storage_url):
         self.storage_url = storage_url
+        self.whitelist = whitelists.load(storage_url)
         WebResource.__init__(self)
 
-    def getChild(self, path, request):
-        return SitesWebservice(self.storage_url)
-
     def render_POST(self, request):
         """
         Add a new site entry
@@ -104,32 +140,35 @@ class SitesWebservice(WebResource):
                 return "BAD REQUEST\n"
 
             site = request.args["site"][0]
-            wl = _get_whitelist(self.storage_url)
-
-            if not wl.contains(site):
-                _LOG.info("Adding site %s for request %s", site, request)
-                wl.add(site)
-            
             request.setHeader("Location", "/sites/"+site)
-            return "CREATED\n" 
+            return self._defer(request, self._add_site, site)
         else:
             return self._not_found(request)
 
+    def _add_site(self, site):
+        if not self.whitelist.contains(site):
+            _LOG.info("Adding site %s", site)
+            self.whitelist.add(site)
+        return "CREATED\n"
+
     def render_GET(self, request):
         """
         Read the list of configure sites
         """
         if request.path == "/sites":
             _LOG.debug("Getting sites for %s", request)
-            result = []
-
-            for site in _get_whitelist(self.storage_url).get_all():
-                result.append({ "name": site })
-
-            _LOG.debug("Got sites %s for request %s", result, request)
-            return result
+            try:
+                (limit, after) = _get_page_args(request)
+            except ValueError as e:
+                _LOG.debug("Bad sites request %s: %s", request, e)
+                return self._bad_request(request)
+            return _stream_page(request, self._get_sites, limit, after)
         else:
-            self._not_found(request)
+            return self._not_found(request)
+
+    def _get_sites(self, limit, after):
+        return [ (token, { "name": site })
+            for (token, site) in self.whitelist.iter_all(limit, after) ]
 
     def render_DELETE(self, request):
         """
@@ -137,16 +176,18 @@ class SitesWebservice(WebResource):
         """
         if request.path.startswith("/sites/"):
             site = request.path.replace("/sites/", "")
-            wl = _get_whitelist(self.storage_url)
-            if wl.contains(site):
-                _LOG.info("Deleting site %s for request %s", site, request)
-                wl.delete(site)
-                return "DELETED\n"
-            else:
-                return self._not_found(request)
+            return self._defer(request, self._delete_site, site)
         else:
             return self._not_found(request)
 
+    def _delete_site(self, site):
+        if not self.whitelist.contains(site):
+            raise HTTPError(http.NOT_FOUND, "NOT FOUND\n")
+
+        _LOG.info("Deleting site %s", site)
+        self.whitelist.delete(site)
+        return "DELETED\n"
+
     def render_PUT(self, request):
         return self._not_implemented(request)
 
@@ -157,87 +198,390 @@ class DevicesWebservice(WebResource):
 
     def __init__(self, storage_url):
         self.storage_url = storage_url
+        self.store = storage.create_store(storage_url,
+            storage.KNOWN_DEVICES_STORE)
         WebResource.__init__(self)
 
-    def getChild(self, path, request):
-        return DevicesWebservice(self.storage_url)
-
     def render_POST(self, request):
         """
         Update the value of a device's attribute
         """
         if request.path.startswith("/devices"):
             _LOG.debug("Device update %s", request.path)
-            result = []
-            store = _get_known_devices_store(self.storage_url)
-
             path_bits = request.path.split("/")
             _LOG.debug("Path bits is %s", str(path_bits))
             if len(path_bits) >= 3:
-                device = store.read(path_bits[2])
-                if device:
-                    if len(path_bits) == 3:
-                        return self._not_implemented(request)
-                    elif len(path_bits) == 4 and "value" in request.args:
-                        prop_name = path_bits[3]
-                        prop_value = request.args["value"][0]
-                        store.update(device.name, { prop_name: prop_value })
-                        return self._done(request)
-                    else:
-                        return self._not_found(request)
-                else:
-                    return self._not_found(request)
+                value = None
+                if "value" in request.args:
+                    value = request.args["value"][0]
+                return self._defer(request, self._update_device, path_bits,
+                    value)
             else:
                 return self._not_found(request)
         else: 
             return self._not_found(request)
 
+    def _update_device(self, path_bits, value):
+        device = self.store.read(path_bits[2])
+        if not device:
+            raise HTTPError(http.NOT_FOUND, "NOT FOUND\n")
+
+        if len(path_bits) == 3:
+            raise HTTPError(http.NOT_IMPLEMENTED, "NOT IMPLEMENTED\n")
+        elif len(path_bits) == 4 and value is not None:
+            self.store.update(device.name, { path_bits[3]: value })
+            return "DONE\n"
+        else:
+            raise HTTPError(http.NOT_FOUND, "NOT FOUND\n")
+
     def render_GET(self, request):
         """
         Read the list of known devices
         """
         if request.path.startswith("/devices"):
             _LOG.debug("Getting devices for %s", request.path)
-            result = []
-            store = _get_known_devices_store(self.storage_url)
-
             path_bits = request.path.split("/")
             _LOG.debug("Path bits is %s", str(path_bits))
             if len(path_bits) == 2:
                 # Get all devices
-                for device in store.find():
-                    result.append(device.properties)
-            elif len(path_bits) >= 3:
-                device = store.read(path_bits[2])
-                if not device:
-                    return self._not_found(request)
-
-                if len(path_bits) == 3:
-                    # Get device attribute names
-                    result = device.properties
-                elif len(path_bits) == 4 and path_bits[3] in device:
-                    # Get device attribute values
-                    result = [ device[path_bits[3]] ]
-                else:
-                    return self._not_found(request)
-
-            _LOG.debug("Got %s for request %s", result, request)
-            return result
+                try:
+                    (limit, after) = _get_page_args(request)
+                except ValueError as e:
+                    _LOG.debug("Bad devices request %s: %s", request, e)
+                    return self._bad_request(request)
+                return _stream_page(request, self._get_devices, limit, after)
+            else:
+                return self._defer(request, self._get_device, path_bits)
         else:
             return self._not_found(request)
 
+    def _get_devices(self, limit, after):
+        return [ (self.store.get_token(device), device.properties)
+            for device in self.store.find(limit=limit, after=after) ]
+
+    def _get_device(self, path_bits):
+        device = self.store.read(path_bits[2])
+        if not device:
+            raise HTTPError(http.NOT_FOUND, "NOT FOUND\n")
+
+        if len(path_bits) == 3:
+            # Get device attribute names
+            return device.properties
+        elif len(path_bits) == 4 and path_bits[3] in device:
+            # Get device attribute values
+            return [ device[path_bits[3]] ]
+        else:
+            raise HTTPError(http.NOT_FOUND, "NOT FOUND\n")
+
+    def render_DELETE(self, request):
+        return self._not_implemented(request)
+
+    def render_PUT(self, request):
+        return self._not_implemented(request)
+
+class LogsWebservice(WebResource):
+    """
+    The handler for the request log webservice interface. GET /logs takes
+    the since, until, device, limit, view and interval arguments of the
+    show-logs client command.
+    """
+
+    def __init__(self, storage_url):
+        self.storage_url = storage_url
+        self.store = storage.create_store(storage_url,
+            storage.REQUEST_LOG_STORE)
+        WebResource.__init__(self)
+
+    def render_GET(self, request):
+        """
+        Read the recorded lookups, or a report of them
+        """
+        if request.path.rstrip("/") != "/logs":
+            return self._not_found(request)
+
+        try:
+            options = _get_report_args(request, [ "since", "until",
+                "device", "limit", "view", "interval" ])
+            if options.get("view", querylog.RAW_VIEW) not in querylog.VIEWS:
+                raise ValueError("Unknown view : "+options["view"])
+        except ValueError as e:
+            _LOG.debug("Bad logs request %s: %s", request, e)
+            return self._bad_request(request)
+        return self._defer(request, self._get_logs, options)
+
+    def _get_logs(self, options):
+        if options.get("view", querylog.RAW_VIEW) == querylog.RAW_VIEW and \
+                not options.get("limit"):
+            options["limit"] = querylog.RAW_LIMIT
+        return list(querylog.get_report(self.store, **options))
+
+    def render_POST(self, request):
+        return self._not_implemented(request)
+
+    def render_DELETE(self, request):
+        return self._not_implemented(request)
+
+    def render_PUT(self, request):
+        return self._not_implemented(request)
+
+class RollupsWebservice(WebResource):
+    """
+    The handler for the request rollups webservice interface. GET /rollups
+    takes the since, until, device, verdict, group_by, limit and interval
+    arguments of the show-rollups client command.
+    """
+
+    def __init__(self, storage_url):
+        self.storage_url = storage_url
+        self.store = storage.create_store(storage_url,
+            storage.REQUEST_ROLLUP_STORE)
+        WebResource.__init__(self)
+
+    def render_GET(self, request):
+        """
+        Read the lookup counts from the rollups
+        """
+        if request.path.rstrip("/") != "/rollups":
+            return self._not_found(request)
+
+        try:
+            options = _get_report_args(request, [ "since", "until",
+                "device", "verdict", "group_by", "limit", "interval" ])
+        except ValueError as e:
+            _LOG.debug("Bad rollups request %s: %s", request, e)
+            return self._bad_request(request)
+        return self._defer(request, self._get_rollups, options)
+
+    def _get_rollups(self, options):
+        return rollups.get_rollups(self.store, **options)
+
+    def render_POST(self, request):
+        return self._not_implemented(request)
+
     def render_DELETE(self, request):
-        return self.not_implemented(request)
+        return self._not_implemented(request)
 
     def render_PUT(self, request):
-        return self.not_implemented(request)
+        return self._not_implemented(request)
+
+class ListWriter(object):
+    """
+    Writes the items of a list response as JSON or text lines, in chunks.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.json = _wants_json(request)
+        self.started = False
+
+    def write(self, items):
+        parts = []
+        for item in items:
+            if self.json:
+                parts.append("," if self.started else "[")
+                parts.append(json.dumps(item, default=json_util.default))
+            else:
+                parts.append(_get_item_str(item)+"\n")
+            self.started = True
 
+        if parts:
+            self.request.write("".join(parts))
 
-def _get_whitelist(url):
-    return whitelists.load(url)
+    def finish(self):
+        if self.json:
+            self.request.write("]" if self.started else "[]")
+        self.request.finish()
 
-def _get_known_devices_store(url):
-    return storage.create_store(url, storage.KNOWN_DEVICES_STORE)
+@implementer(interfaces.IPushProducer)
+class ListProducer(object):
+    """
+    Streams a list response, fetching chunk_size items at a time in the
+    storage thread pool.
+
+    fetch(limit, after) returns a list of (token, item) pairs, and each
+    chunk continues after the token of the last item of the previous one,
+    so no cursor is shared between threads. The producer is registered with
+    the request, so no more chunks are fetched while the transport's buffer
+    is full. The stream stops if the client goes away.
+    """
+
+    def __init__(self, request, fetch, after=None, chunk_size=100):
+        self.request = request
+        self.fetch = fetch
+        self.after = after
+        self.chunk_size = chunk_size
+        self.writer = ListWriter(request)
+        self.more = True
+        self.task = None
+
+    def start(self):
+        self.task = task.cooperate(self._chunks())
+        self.task.whenDone().addCallbacks(self._done, self._failed)
+        self.request.notifyFinish().addErrback(self._disconnected)
+        self.request.registerProducer(self, True)
+
+    def pauseProducing(self):
+        try:
+            self.task.pause()
+        except task.TaskFinished:
+            pass
+
+    def resumeProducing(self):
+        try:
+            self.task.resume()
+        except task.NotPaused:
+            pass
+
+    def stopProducing(self):
+        self._stop()
+
+    def _chunks(self):
+        while self.more:
+            d = storage.defer_to_thread(self.fetch, self.chunk_size,
+                self.after)
+            d.addCallback(self._write)
+            yield d
+
+    def _write(self, chunk):
+        self.writer.write([ item for (token, item) in chunk ])
+        self.more = len(chunk) == self.chunk_size
+        if chunk:
+            self.after = chunk[-1][0]
+
+    def _done(self, result):
+        self.request.unregisterProducer()
+        self.writer.finish()
+
+    def _failed(self, failure):
+        if failure.check(task.TaskStopped):
+            return
+        self.request.unregisterProducer()
+        if not self.writer.started:
+            return _finish_error(failure, self.request)
+
+        # The items already sent can't be taken back, so cut the response
+        # short
+        _LOG.error("Failed to stream response for %s: %s", self.request,
+            failure.getErrorMessage())
+        self.request.finish()
+
+    def _disconnected(self, failure):
+        _LOG.debug("Client went away during %s", self.request)
+        self._stop()
+
+    def _stop(self):
+        if self.task:
+            try:
+                self.task.stop()
+            except task.TaskFinished:
+                pass
+
+def _gzip(resource_):
+    """
+    Compress the responses of a resource when the client accepts gzip.
+    """
+    return resource.EncodingResourceWrapper(resource_,
+        [ server.GzipEncoderFactory() ])
+
+def _get_page_args(request):
+    """
+    Get the limit and after arguments of a paginated request.
+    """
+    limit = 0
+    if "limit" in request.args:
+        limit = int(request.args["limit"][0])
+        if limit < 0:
+            raise ValueError("Invalid limit : "+str(limit))
+
+    after = None
+    if "after" in request.args:
+        after = request.args["after"][0]
+    return (limit, after)
+
+def _get_report_args(request, keys):
+    """
+    Get the report options of a logs or rollups request.
+    """
+    options = {}
+    for key in keys:
+        if key not in request.args:
+            continue
+        value = request.args[key][0]
+        if key in [ "since", "until" ]:
+            options[key] = querylog.parse_time(value)
+        elif key in [ "limit", "interval" ]:
+            options[key] = int(value)
+        elif key == "group_by":
+            options[key] = value.split(",")
+        else:
+            options[key] = value
+
+    if options.get("limit", 0) < 0:
+        raise ValueError("Invalid limit : "+str(options["limit"]))
+    return options
+
+def _stream_page(request, fetch, limit, after):
+    """
+    Send a list response of the items from fetch(limit, after). When a limit
+    is given and there are more items, the token to continue from is sent in
+    the X-Next-After header. Otherwise every item is streamed.
+    """
+    if not limit:
+        ListProducer(request, fetch, after).start()
+        return server.NOT_DONE_YET
+
+    d = storage.defer_to_thread(fetch, limit + 1, after)
+    d.addCallback(_write_page, request, limit)
+    d.addErrback(_finish_error, request)
+    _cancel_on_disconnect(d, request)
+    return server.NOT_DONE_YET
+
+def _write_page(page, request, limit):
+    if len(page) > limit:
+        page = page[:limit]
+        request.setHeader("X-Next-After", page[-1][0])
+
+    writer = ListWriter(request)
+    writer.write([ item for (token, item) in page ])
+    writer.finish()
+
+def _cancel_on_disconnect(d, request):
+    """
+    Cancel the deferred response d if the client goes away before it is
+    sent.
+    """
+    request.notifyFinish().addErrback(lambda failure: d.cancel())
+
+def _finish(data, request):
+    """
+    Send the response for a deferred request.
+    """
+    if request.finished:
+        return
+    request.write(_get_response(request, data))
+    request.finish()
+
+def _finish_error(failure, request):
+    """
+    Send the error response for a deferred request that failed.
+    """
+    if failure.check(defer.CancelledError):
+        _LOG.debug("Client went away during %s", request)
+        return
+    if failure.check(HTTPError):
+        (code, message) = (failure.value.code, failure.value.message)
+    elif failure.check(ValueError):
+        (code, message) = (http.BAD_REQUEST, "BAD REQUEST\n")
+    else:
+        _LOG.error("Failed to handle %s: %s", request,
+            failure.getErrorMessage())
+        (code, message) = (http.INTERNAL_SERVER_ERROR, "ERROR\n")
+
+    if request.finished:
+        return
+    request.setResponseCode(code)
+    request.write(message)
+    request.finish()
 
 def _get_response_str(data):
     if isinstance(data, dict):
@@ -247,21 +591,28 @@ def _get_response_str(data):
         _LOG.debug("Getting list response string for %s", data)
         list_entries=[]
         for i in data:
-            if isinstance(i, dict) and "name" in i:
-                list_entries.append(str(i["name"]))
-            else:
-                list_entries.append(str(i))
+            list_entries.append(_get_item_str(i))
         return '\n'.join(list_entries)+"\n"
     else:
         _LOG.debug("Getting str response string for %s", data)
         return str(data)
 
+def _get_item_str(item):
+    if isinstance(item, dict) and "name" in item:
+        return str(item["name"])
+    if isinstance(item, dict) and ("count" in item or "domain" in item):
+        return querylog.format_row(item)
+    return str(item)
+
+def _wants_json(request):
+    return "application/json" in (request.getHeader("Accept") or "")
+
 def _get_response(request, data):
     content_type = request.getHeader("Accept")
 
     _LOG.debug("Returning %s as %s content", str(data), content_type)
     
-    if content_type.find("application/json") != -1:
+    if _wants_json(request):
         return json.dumps(data, default=json_util.default)
     else:
         return _get_response_str(data)
@@ -282,8 +633,8 @@ def start(args):
 
 # Read options from CLI
 parser = utils.init_argparser("Start the DNS filter web", { "port": 8080 })
-args = parser.parse_args()
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     init(args)
     raise SystemExit(start(args))
@@ -13,10 +13,22 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-from fnmatch import fnmatch
+import bisect
 import logging
 import os
+import patterns
+import snapshots
 import storage
+import threading
+import time
+from twisted.internet import reactor
+from twisted.python import filepath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # inotify is Linux only, other platforms rely on refresh() polling
+    inotify = None
 
 """
 Module containing all whitelist implementations and utils.
@@ -34,6 +46,8 @@ def load(url):
         return FileWhitelist(id)
     if type == "dir":
         return DirWhitelist(id)
+    if type == "snapshot":
+        return SnapshotWhitelist(id)
     else:
         return StoreWhitelist(url)
 
@@ -47,19 +61,148 @@ def copy(src_url, dst_url):
     """
     src_wl = load(src_url)
     dst_wl = load(dst_url)
-    copy_lists(src_wl, dst_wl)
+    copy_whitelists(src_wl, dst_wl)
 
-def copy_whitelists(src, dst):
+def copy_whitelists(src, dst, chunk_size=10000):
     """
-    Copy the content of the src whitelist to the dst whitelist.
+    Copy the content of the src whitelist to the dst whitelist, adding the
+    entries in chunks of chunk_size.
     """
+    chunk = []
     for entry in src.get_all():
-        dst.add(entry)
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            dst.add_all(chunk)
+            chunk = []
+    if chunk:
+        dst.add_all(chunk)
+
+def compile_snapshot(whitelist, path):
+    """
+    Compile the contents of the whitelist into a snapshot file.
+    """
+    snapshots.write_snapshot((normalize(entry)
+        for entry in whitelist.get_all()), path)
+
+def index(whitelist, full_refresh_interval=3600):
+    """
+    Get an in-memory indexed view of the provided whitelist.
+    """
+    if whitelist.indexed:
+        return whitelist
+    return IndexedWhitelist(whitelist, full_refresh_interval)
+
+def normalize(name):
+    """
+    Normalize a domain name for lookups (lowercase, no trailing dot).
+    """
+    return name.lower().rstrip(".")
+
+class DomainIndex(object):
+    """
+    An in-memory set of domain names and wildcard patterns that can be
+    matched against the suffixes of a query name.
+
+    Exact names are kept in a hashed set and patterns in a PatternIndex, so
+    a lookup costs one hash probe (and at most one regex match) per label of
+    the query name, whatever the size of the index.
+    """
+
+    def __init__(self, names=[]):
+        self.names = set()
+        self.patterns = patterns.PatternIndex()
+        self.update(names)
+
+    def __len__(self):
+        return len(self.names) + len(self.patterns)
+
+    def get_all(self):
+        return list(self.names) + self.patterns.get_all()
+
+    def copy(self):
+        index = DomainIndex()
+        index.names = set(self.names)
+        index.patterns = self.patterns.copy()
+        return index
+
+    def update(self, names):
+        new_patterns = []
+        for name in names:
+            name = normalize(name)
+            if patterns.is_pattern(name):
+                new_patterns.append(name)
+            else:
+                self.names.add(name)
+        self.patterns.update(new_patterns)
+
+    def add(self, name):
+        name = normalize(name)
+        if patterns.is_pattern(name):
+            self.patterns.add(name)
+        else:
+            self.names.add(name)
+
+    def discard(self, name):
+        name = normalize(name)
+        if patterns.is_pattern(name):
+            self.patterns.discard(name)
+        else:
+            self.names.discard(name)
+
+    def discard_all(self, names):
+        old_patterns = []
+        for name in names:
+            name = normalize(name)
+            if patterns.is_pattern(name):
+                old_patterns.append(name)
+            else:
+                self.names.discard(name)
+        self.patterns.discard_all(old_patterns)
+
+    def contains(self, name):
+        name = normalize(name)
+        if patterns.is_pattern(name):
+            return self.patterns.contains(name)
+        return name in self.names
+
+    def matches(self, name):
+        """
+        Does the name, or any of its parent domains, appear in the index or
+        match one of its patterns.
+
+        Bare top level domains are never matched by exact names.
+        """
+        name = normalize(name)
+        names = self.names
+        pattern_index = self.patterns
+        has_patterns = len(pattern_index.groups) > 0
+
+        if has_patterns and pattern_index.match_suffix("", name):
+            return True
+
+        start = 0
+        while True:
+            suffix = name[start:]
+            if has_patterns and pattern_index.match_suffix(suffix, name):
+                return True
+
+            dot = name.find(".", start)
+            if dot < 0:
+                return False
+            if suffix in names:
+                return True
+            start = dot + 1
 
 class Whitelist(object):
     """
     Base whitelist interface
     """
+
+    # Whether lookups are served from memory without touching storage
+    indexed = False
+
+    # The (version, sorted entries) last used by iter_all
+    _sorted = None
     
     def contains(self, entry):
         """
@@ -67,24 +210,537 @@ class Whitelist(object):
         """
         pass
 
+    def contains_all(self, entries):
+        """
+        Get the set of the provided entries that the whitelist contains.
+        """
+        return set( entry for entry in entries if self.contains(entry) )
+
     def get_all(self):
         """
         Get all entries in the whitelist.
         """
         pass
 
+    def iter_all(self, limit=0, after=None):
+        """
+        Iterate over the entries in the whitelist as (token, entry) pairs,
+        in a stable order. Pass the token of the last entry seen as after
+        to continue from it.
+
+        The sorted entries are kept until the version changes, so paging
+        through the whitelist sorts it once.
+        """
+        version = self.get_version()
+        if version is not None and self._sorted is not None and \
+                self._sorted[0] == version:
+            entries = self._sorted[1]
+        else:
+            entries = sorted(self.get_all())
+            if version is not None:
+                self._sorted = (version, entries)
+
+        if after is not None:
+            entries = entries[bisect.bisect_right(entries, after):]
+        if limit:
+            entries = entries[:limit]
+        return ( (entry, entry) for entry in entries )
+
     def add(self, entry):
         """
         Add an entry to the whitelist.
         """
         pass
 
+    def add_all(self, entries):
+        """
+        Add many entries to the whitelist.
+        """
+        for entry in entries:
+            self.add(entry)
+
     def delete(self, entry):
         """
         Delete an entry from the whitelist.
         """
         pass
 
+    def delete_all(self, entries):
+        """
+        Delete many entries from the whitelist.
+        """
+        for entry in entries:
+            self.delete(entry)
+
+    def matches(self, name):
+        """
+        Does the whitelist contain the provided name or any of its parent
+        domains.
+        """
+        segments = name.count('.')
+        for i in range(0, segments):
+            site = name.split('.', i)[-1]
+            if self.contains(site):
+                return True
+
+        return False
+
+    def get_version(self):
+        """
+        Get a token that changes when the whitelist content changes, or None
+        if changes can't be detected.
+        """
+        return None
+
+    def refresh(self):
+        """
+        Reload any in-memory copy of the whitelist. Returns True if the
+        content changed.
+        """
+        return False
+
+    def add_listener(self, listener):
+        """
+        Register a callable that is called on the reactor thread when the
+        whitelist notices a change by itself, rather than through refresh().
+        """
+        pass
+
+    def close(self):
+        """
+        Release any watches or other resources held by the whitelist.
+        """
+        pass
+
+class IndexedWhitelist(Whitelist):
+    """
+    A whitelist that serves lookups from an in-memory index of another
+    whitelist. Writes are passed through to the underlying whitelist.
+
+    The index is rebuilt when the version of the underlying whitelist
+    changes, and every full_refresh_interval seconds whatever the version,
+    to pick up changes the version doesn't track (such as documents edited
+    directly in MongoDB).
+    """
+
+    indexed = True
+
+    def __init__(self, whitelist, full_refresh_interval=3600):
+        self.whitelist = whitelist
+        self.full_refresh_interval = full_refresh_interval
+        self.version = None
+        self.loaded = 0
+        self.index = DomainIndex()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuild the index if the underlying whitelist has changed, or is due
+        a full refresh. Returns True if the index changed.
+        """
+        version = self.whitelist.get_version()
+        now = time.time()
+        if version is not None and version == self.version and \
+                now < self.loaded + self.full_refresh_interval:
+            return False
+
+        index = DomainIndex(self.whitelist.get_all())
+        self.loaded = now
+        if version is not None and version == self.version and \
+                index.names == self.index.names and \
+                index.patterns.groups == self.index.patterns.groups:
+            return False
+
+        self.index = index
+        self.version = version
+        _LOG.debug("Indexed %d sites from %s (version=%s)", len(self.index),
+            self.whitelist, version)
+        return True
+
+    def contains(self, entry):
+        return self.index.contains(entry)
+
+    def matches(self, name):
+        return self.index.matches(name)
+
+    def add(self, entry):
+        self.whitelist.add(entry)
+        self.index.add(entry)
+        self._sorted = None
+
+    def add_all(self, entries):
+        self.whitelist.add_all(entries)
+        self.index.update(entries)
+        self._sorted = None
+
+    def delete(self, entry):
+        self.whitelist.delete(entry)
+        self.index.discard(entry)
+        self._sorted = None
+
+    def delete_all(self, entries):
+        self.whitelist.delete_all(entries)
+        self.index.discard_all(entries)
+        self._sorted = None
+
+    def get_all(self):
+        return self.index.get_all()
+
+    def get_version(self):
+        return self.version
+
+    def __str__(self):
+        return "IndexedWhitelist["+str(self.whitelist)+"]"
+
+class SnapshotWhitelist(Whitelist):
+    """
+    A read-only whitelist served from a compiled snapshot file (see the
+    snapshots module). refresh() maps the file again if it has been replaced.
+    """
+
+    indexed = True
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = snapshots.Snapshot(path)
+        _LOG.debug("Mapped snapshot %s with %d sites", path,
+            len(self.snapshot))
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        old_stat = self.snapshot.stat
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == \
+                (old_stat.st_ino, old_stat.st_mtime, old_stat.st_size):
+            return False
+
+        # The old mapping is closed once nothing references it
+        self.snapshot = snapshots.Snapshot(self.path)
+        _LOG.debug("Remapped snapshot %s with %d sites", self.path,
+            len(self.snapshot))
+        return True
+
+    def contains(self, entry):
+        return self.snapshot.contains(normalize(entry))
+
+    def matches(self, name):
+        return self.snapshot.matches(normalize(name))
+
+    def get_all(self):
+        return list(self.snapshot.names())
+
+    def add(self, entry):
+        raise Exception("Snapshot whitelists are read-only : "+self.path)
+
+    def delete(self, entry):
+        raise Exception("Snapshot whitelists are read-only : "+self.path)
+
+    def get_version(self):
+        stat = self.snapshot.stat
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def __str__(self):
+        return "SnapshotWhitelist["+self.path+"]"
+
+def _read_entries(path):
+    """
+    Read the entries of a whitelist file, one per line. Blank lines and
+    anything after a # are ignored.
+    """
+    entries = set()
+    with open(path) as f:
+        for line in f:
+            entry = line.split("#", 1)[0].strip()
+            if entry:
+                entries.add(normalize(entry))
+    return entries
+
+def _get_file_key(path):
+    """
+    Get the values used to tell if a file has changed.
+    """
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+class _FilesWhitelist(Whitelist):
+    """
+    Base for the in-memory whitelists read from files.
+
+    refresh() checks the mtime and size of every file, re-reads only the
+    files that changed and applies just the added and removed entries to a
+    copy of the index, which then replaces it, so lookups never see a half
+    applied change while a refresh runs in a thread. With inotify available
+    the watched directory also triggers a refresh as soon as anything in it
+    changes.
+    """
+
+    indexed = True
+
+    def __init__(self, watch_path):
+        self.watch_path = watch_path
+        self.index = DomainIndex()
+        self.version = 0
+        self.lock = threading.Lock()
+        self.listeners = []
+
+        # The entries and file keys of each file
+        self.files = {}
+
+        # The number of files listing each entry
+        self.counts = {}
+
+        self._notifier = None
+        self._pending = None
+
+    def _list_files(self):
+        """
+        Get the paths of the files making up the whitelist.
+        """
+        return []
+
+    def refresh(self):
+        with self.lock:
+            changed = False
+            paths = self._list_files()
+
+            # The entries to add to and remove from the index
+            added = set()
+            removed = set()
+
+            for path in list(self.files.keys()):
+                if path not in paths:
+                    _LOG.debug("Whitelist file %s removed", path)
+                    self._apply(path, None, set(), added, removed)
+                    changed = True
+
+            for path in paths:
+                try:
+                    key = _get_file_key(path)
+                    if path in self.files and self.files[path][0] == key:
+                        continue
+                    entries = _read_entries(path)
+                except (IOError, OSError) as e:
+                    _LOG.warning("Failed to read whitelist file %s: %s",
+                        path, e)
+                    continue
+
+                if self._apply(path, key, entries, added, removed):
+                    changed = True
+
+            if added or removed:
+                # Lookups run on the reactor while this runs in a thread, so
+                # change a copy of the index and swap it in
+                index = self.index.copy()
+                index.discard_all(removed)
+                index.update(added)
+                self.index = index
+
+            if changed:
+                self.version += 1
+            return changed
+
+    def _apply(self, path, key, entries, added, removed):
+        """
+        Record the differences between the old and new entries of a file,
+        adding the entries that enter or leave the index to the added and
+        removed sets. Returns True if any entries changed.
+        """
+        old_entries = self.files[path][1] if path in self.files else set()
+        file_added = entries - old_entries
+        file_removed = old_entries - entries
+
+        for entry in file_added:
+            count = self.counts.get(entry, 0)
+            if not count:
+                if entry in removed:
+                    removed.discard(entry)
+                else:
+                    added.add(entry)
+            self.counts[entry] = count + 1
+
+        for entry in file_removed:
+            count = self.counts[entry] - 1
+            if not count:
+                del self.counts[entry]
+                if entry in added:
+                    added.discard(entry)
+                else:
+                    removed.add(entry)
+            else:
+                self.counts[entry] = count
+
+        if key is None:
+            del self.files[path]
+        else:
+            self.files[path] = (key, entries)
+
+        if file_added or file_removed:
+            _LOG.debug("Whitelist file %s: %d added, %d removed", path,
+                len(file_added), len(file_removed))
+        return bool(file_added or file_removed)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        if inotify and not self._notifier:
+            self._notifier = inotify.INotify()
+            self._notifier.startReading()
+            self._notifier.watch(filepath.FilePath(self.watch_path),
+                mask=inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+                    inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                    inotify.IN_MOVED_TO,
+                callbacks=[ self._notified ])
+            _LOG.debug("Watching %s for changes", self.watch_path)
+
+    def _notified(self, watch, path, mask):
+        # Editors often make several changes at once, so wait for them to
+        # settle before refreshing
+        if not self._pending:
+            self._pending = reactor.callLater(0.1, self._refresh_notified)
+
+    def _refresh_notified(self):
+        self._pending = None
+        d = storage.defer_to_thread(self.refresh)
+        d.addCallbacks(self._notify_listeners, self._refresh_failed)
+
+    def _notify_listeners(self, changed):
+        if changed:
+            for listener in self.listeners:
+                listener()
+
+    def _refresh_failed(self, failure):
+        _LOG.error("Failed to refresh %s: %s", self,
+            failure.getErrorMessage())
+
+    def close(self):
+        if self._pending:
+            self._pending.cancel()
+            self._pending = None
+        if self._notifier:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def contains(self, entry):
+        return self.index.contains(entry)
+
+    def matches(self, name):
+        return self.index.matches(name)
+
+    def get_all(self):
+        return self.index.get_all()
+
+    def get_version(self):
+        return self.version
+
+    def _append_entries(self, path, entries):
+        with open(path, "a") as f:
+            for entry in entries:
+                f.write(normalize(entry)+"\n")
+
+    def _remove_entries(self, path, entries):
+        """
+        Rewrite a file without the lines for any of the entries.
+        """
+        entries = set( normalize(entry) for entry in entries )
+        with open(path) as f:
+            lines = f.readlines()
+
+        kept = [ line for line in lines
+            if normalize(line.split("#", 1)[0].strip()) not in entries ]
+        if len(kept) == len(lines):
+            return
+
+        tmp_path = path+".tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(kept)
+        os.rename(tmp_path, path)
+
+def _get_missing(whitelist, entries):
+    """
+    Get the entries that aren't in the whitelist, without duplicates.
+    """
+    missing = []
+    seen = set()
+    for entry in entries:
+        name = normalize(entry)
+        if name not in seen and not whitelist.contains(entry):
+            missing.append(entry)
+        seen.add(name)
+    return missing
+
+class FileWhitelist(_FilesWhitelist):
+    """
+    An in-memory whitelist read from a file with one entry per line.
+    """
+
+    def __init__(self, path):
+        _FilesWhitelist.__init__(self, os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.refresh()
+
+    def _list_files(self):
+        if os.path.exists(self.path):
+            return [ self.path ]
+        return []
+
+    def add(self, entry):
+        self.add_all([ entry ])
+
+    def add_all(self, entries):
+        self._append_entries(self.path, _get_missing(self, entries))
+        self.refresh()
+
+    def delete(self, entry):
+        self.delete_all([ entry ])
+
+    def delete_all(self, entries):
+        self._remove_entries(self.path, entries)
+        self.refresh()
+
+    def __str__(self):
+        return "FileWhitelist["+self.path+"]"
+
+class DirWhitelist(_FilesWhitelist):
+    """
+    An in-memory whitelist read from every file in a directory, ignoring
+    hidden files and editor backups. New entries are added to local.conf.
+    """
+
+    LOCAL_FILE = "local.conf"
+
+    def __init__(self, path):
+        _FilesWhitelist.__init__(self, path)
+        self.path = path
+        self.refresh()
+
+    def _list_files(self):
+        paths = []
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith(".") or name.endswith("~") or \
+                    name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.path, name)
+            if os.path.isfile(path):
+                paths.append(path)
+        return paths
+
+    def add(self, entry):
+        self.add_all([ entry ])
+
+    def add_all(self, entries):
+        self._append_entries(os.path.join(self.path,
+            DirWhitelist.LOCAL_FILE), _get_missing(self, entries))
+        self.refresh()
+
+    def delete(self, entry):
+        self.delete_all([ entry ])
+
+    def delete_all(self, entries):
+        for path in list(self.files.keys()):
+            self._remove_entries(path, entries)
+        self.refresh()
+
+    def __str__(self):
+        return "DirWhitelist["+self.path+"]"
+
 class StoreWhitelist(Whitelist):
     """
     A whitelist of sites provided by a store.
@@ -96,16 +752,33 @@ class StoreWhitelist(Whitelist):
 
     def contains(self, entry):
         return self.store.read(entry) is not None
+
+    def contains_all(self, entries):
+        return set(self.store.read_all(entries).keys())
         
     def add(self, entry):
         self.store.create(entry, { })
 
+    def add_all(self, entries):
+        self.store.upsert_all([ (entry, { }) for entry in entries ])
+
     def delete(self, entry):
         self.store.delete(entry)
 
+    def delete_all(self, entries):
+        self.store.delete_all(entries)
+
     def get_all(self):
         sites = []
-        for site in self.store.find():
+        for site in self.store.find(projection=[ "name" ], batch_size=10000):
             if "name" in site:
                 sites.append(site["name"])
         return sites
+
+    def iter_all(self, limit=0, after=None):
+        sites = self.store.find(projection=[ "name" ], limit=limit,
+            after=after)
+        return ( (self.store.get_token(site), site.name) for site in sites )
+
+    def get_version(self):
+        return self.store.get_version()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import logging
+import os
+import signal
+import socket
+import sys
+from twisted.internet import defer, protocol, reactor
+
+"""
+Module containing the components used to run the server as several worker
+processes.
+"""
+
+_LOG = logging.getLogger("dnsfilter.workers")
+
+# Not every python exposes the constant, this is its value on Linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+# The fd a worker writes to when it is ready to serve
+READY_FD = 3
+
+def create_socket(addr, port, type):
+    """
+    Create a non-blocking socket bound to addr:port with SO_REUSEPORT set, so
+    that every worker can bind the same port and the kernel spreads the load
+    between them.
+    """
+    family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+    sock = socket.socket(family, type)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind((addr, port))
+    return sock
+
+def notify_ready():
+    """
+    Tell the supervisor this worker is ready to serve.
+    """
+    try:
+        os.write(READY_FD, "ready\n".encode("ascii"))
+        os.close(READY_FD)
+    except OSError:
+        _LOG.debug("Not running under a worker supervisor")
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    The protocol for one worker process.
+    """
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ready = False
+
+    def childDataReceived(self, fd, data):
+        if fd == READY_FD and not self.ready:
+            self.ready = True
+            self.supervisor.worker_ready(self)
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+    def signal(self, sig):
+        try:
+            self.transport.signalProcess(sig)
+        except Exception:
+            # The process has already gone
+            pass
+
+class WorkerSupervisor(object):
+    """
+    Runs a number of worker processes, each started with the same command
+    line plus a --worker-id argument.
+
+    If a worker exits before every worker has first been ready, or when the
+    supervisor shuts down, every worker is stopped with SIGTERM (and SIGKILL
+    after stop_timeout seconds). Once they have all started, workers that
+    exit are restarted after restart_delay seconds, doubling the delay up
+    to max_restart_delay while a worker keeps exiting before it is ready.
+    """
+
+    def __init__(self, count, argv, restart_delay=1, stop_timeout=10,
+            max_restart_delay=60, reactor=reactor):
+        self.count = count
+        self.argv = argv
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.max_restart_delay = max_restart_delay
+        self.reactor = reactor
+        self.workers = {}
+        self.started = False
+        self.stopping = False
+        self._stopped = None
+
+        # The failed starts in a row of each worker id
+        self.failures = {}
+
+    def start(self):
+        _LOG.info("Starting %d workers", self.count)
+        for worker_id in range(self.count):
+            self._spawn(worker_id)
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def _spawn(self, worker_id):
+        if self.stopping:
+            return
+
+        argv = [ sys.executable ] + self.argv + [ "--worker-id",
+            str(worker_id) ]
+        worker = WorkerProcess(self, worker_id)
+        self.reactor.spawnProcess(worker, sys.executable, argv,
+            env=os.environ, childFDs={ 0: 0, 1: 1, 2: 2, READY_FD: "r" })
+        self.workers[worker_id] = worker
+
+    def worker_ready(self, worker):
+        _LOG.info("Worker %d ready (pid=%s)", worker.worker_id,
+            worker.transport.pid)
+        self.failures.pop(worker.worker_id, None)
+        if not self.started and len(self.workers) == self.count and \
+                all(w.ready for w in self.workers.values()):
+            _LOG.info("All %d workers ready", self.count)
+            self.started = True
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+
+        if self.stopping:
+            if not self.workers and self._stopped:
+                self._stopped.callback(None)
+        elif not self.started:
+            _LOG.error("Worker %d failed to start: %s", worker.worker_id,
+                reason.getErrorMessage())
+            self.reactor.stop()
+        elif not worker.ready:
+            failures = self.failures.get(worker.worker_id, 0) + 1
+            self.failures[worker.worker_id] = failures
+            delay = min(self.restart_delay * 2 ** (failures - 1),
+                self.max_restart_delay)
+            _LOG.error("Worker %d failed to start (%s), restarting in %ss",
+                worker.worker_id, reason.getErrorMessage(), delay)
+            self.reactor.callLater(delay, self._spawn, worker.worker_id)
+        else:
+            _LOG.warning("Worker %d exited (%s), restarting",
+                worker.worker_id, reason.getErrorMessage())
+            self.reactor.callLater(self.restart_delay, self._spawn,
+                worker.worker_id)
+
+    def reload(self):
+        """
+        Tell every worker to reload its configuration.
+        """
+        _LOG.info("Reloading %d workers", len(self.workers))
+        self.signal(signal.SIGHUP)
+
+    def signal(self, sig):
+        """
+        Send a signal to every worker.
+        """
+        for worker in self.workers.values():
+            worker.signal(sig)
+
+    def stop(self):
+        """
+        Stop every worker. Returns a Deferred that fires when they have all
+        exited.
+        """
+        self.stopping = True
+        if not self.workers:
+            return defer.succeed(None)
+
+        _LOG.info("Stopping %d workers", len(self.workers))
+        self._stopped = defer.Deferred()
+        self.signal(signal.SIGTERM)
+        killer = self.reactor.callLater(self.stop_timeout, self.signal,
+            signal.SIGKILL)
+        self._stopped.addBoth(self._cancel, killer)
+        return self._stopped
+
+    def _cancel(self, result, call):
+        if call.active():
+            call.cancel()
+        return result
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import sys
+
+"""
+The dnsfilter tests, run with trial from the top of the repository:
+
+    python -m twisted.trial tests
+"""
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DNSFILTER_DIR = os.path.join(os.path.dirname(TESTS_DIR), "dnsfilter")
+
+# The dnsfilter modules import each other as top level modules
+if DNSFILTER_DIR not in sys.path:
+    sys.path.insert(0, DNSFILTER_DIR)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.trial import unittest
+import caches
+
+"""
+Tests of the verdict cache.
+"""
+
+class _FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000000000.0
+
+    def time(self):
+        return self.now
+
+class VerdictCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = _FakeTime()
+        self.patch(caches, "time", self.time)
+        self.cache = caches.VerdictCache(max_size=100, ttl=300)
+
+    def _set(self, device, name, allowed):
+        self.cache.set(device, name, allowed, self.cache.stamp(device))
+
+    def test_get_and_set(self):
+        self._set("10.0.0.1", "a.com", True)
+        self._set("10.0.0.1", "b.com", False)
+
+        self.assertEqual(self.cache.get("10.0.0.1", "a.com"), True)
+        self.assertEqual(self.cache.get("10.0.0.1", "b.com"), False)
+        self.assertIsNone(self.cache.get("10.0.0.2", "a.com"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_expires_after_ttl(self):
+        self._set("10.0.0.1", "a.com", True)
+        self.time.now += 301
+        self.assertIsNone(self.cache.get("10.0.0.1", "a.com"))
+
+    def test_invalidate_device(self):
+        self._set("10.0.0.1", "a.com", True)
+        self._set("10.0.0.2", "a.com", True)
+        self.cache.invalidate("10.0.0.1")
+
+        self.assertIsNone(self.cache.get("10.0.0.1", "a.com"))
+        self.assertEqual(self.cache.get("10.0.0.2", "a.com"), True)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        self._set("10.0.0.1", "a.com", False)
+        self.assertEqual(self.cache.get("10.0.0.1", "a.com"), False)
+
+    def test_invalidate_all(self):
+        self._set("10.0.0.1", "a.com", True)
+        self._set("10.0.0.2", "a.com", True)
+        self.cache.invalidate("10.0.0.1")
+        self.cache.invalidate()
+
+        self.assertIsNone(self.cache.get("10.0.0.1", "a.com"))
+        self.assertIsNone(self.cache.get("10.0.0.2", "a.com"))
+        self.assertEqual(len(self.cache.device_generations), 0)
+
+        self._set("10.0.0.1", "a.com", False)
+        self.assertEqual(self.cache.get("10.0.0.1", "a.com"), False)
+
+    def test_set_after_invalidation_is_ignored(self):
+        # A verdict computed while the device was invalidated may be stale
+        stamp = self.cache.stamp("10.0.0.1")
+        self.cache.invalidate("10.0.0.1")
+        self.cache.set("10.0.0.1", "a.com", True, stamp)
+        self.assertIsNone(self.cache.get("10.0.0.1", "a.com"))
+
+        stamp = self.cache.stamp("10.0.0.1")
+        self.cache.invalidate()
+        self.cache.set("10.0.0.1", "a.com", True, stamp)
+        self.assertIsNone(self.cache.get("10.0.0.1", "a.com"))
+
+    def test_other_device_invalidation_keeps_verdicts(self):
+        stamp = self.cache.stamp("10.0.0.1")
+        self.cache.invalidate("10.0.0.2")
+        self.cache.set("10.0.0.1", "a.com", True, stamp)
+        self.assertEqual(self.cache.get("10.0.0.1", "a.com"), True)
+
+    def test_forgets_old_device_invalidations(self):
+        for i in range(50):
+            self.cache.invalidate("10.0.1.%d" % i)
+        self.time.now += 200
+        self.cache.invalidate("10.0.0.1")
+        self.assertEqual(len(self.cache.device_generations), 51)
+
+        self.time.now += 101
+        self.cache.invalidate("10.0.0.2")
+        self.assertEqual(list(self.cache.device_generations),
+            [ "10.0.0.1", "10.0.0.2" ])
+
+    def test_forgotten_invalidation_keeps_old_verdicts_invalid(self):
+        self._set("10.0.0.1", "a.com", True)
+        self.cache.invalidate("10.0.0.1")
+
+        self.time.now += 301
+        self.cache.invalidate("10.0.0.2")
+        self.assertNotIn("10.0.0.1", self.cache.device_generations)
+        self.assertIsNone(self.cache.get("10.0.0.1", "a.com"))
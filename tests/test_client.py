@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+from twisted.trial import unittest
+import client
+
+"""
+Tests of the client batch mode.
+"""
+
+class _RecordingSession(client.Session):
+    """
+    A session that keeps the lines it writes.
+    """
+
+    def __init__(self, url):
+        client.Session.__init__(self, url)
+        self.lines = []
+
+    def write(self, text, **record):
+        self.lines.append(text)
+
+class GetBatchCmdsTest(unittest.TestCase):
+
+    def test_merges_bulk_commands(self):
+        cmds = list(client._get_batch_cmds([ "add-trusted-sites a.com",
+            "add-trusted-sites b.com c.com", "delete-trusted-sites d.com" ]))
+        self.assertEqual(cmds, [
+            ("add-trusted-sites", [ "a.com", "b.com", "c.com" ], False),
+            ("delete-trusted-sites", [ "d.com" ], False) ])
+
+    def test_does_not_merge_other_commands(self):
+        cmds = list(client._get_batch_cmds([ "get-trusted-sites a.com",
+            "get-trusted-sites b.com" ]))
+        self.assertEqual(cmds, [
+            ("get-trusted-sites", [ "a.com" ], False),
+            ("get-trusted-sites", [ "b.com" ], False) ])
+
+    def test_does_not_merge_text_and_json(self):
+        cmds = list(client._get_batch_cmds([ "add-trusted-sites a.com",
+            '{"cmd": "add-trusted-sites", "args": "b.com"}' ]))
+        self.assertEqual(cmds, [
+            ("add-trusted-sites", [ "a.com" ], False),
+            ("add-trusted-sites", [ "b.com" ], True) ])
+
+    def test_flushes_when_no_input_is_ready(self):
+        lines = iter([ "add-trusted-sites a.com", None,
+            "add-trusted-sites b.com" ])
+        cmds = client._get_batch_cmds(lines)
+
+        self.assertEqual(next(cmds),
+            ("add-trusted-sites", [ "a.com" ], False))
+        self.assertEqual(next(cmds),
+            ("add-trusted-sites", [ "b.com" ], False))
+
+    def test_limits_merged_commands(self):
+        lines = [ "add-trusted-sites s%d.com" % i for i in
+            range(client.BATCH_SIZE + 1) ]
+        cmds = list(client._get_batch_cmds(lines))
+        self.assertEqual([ len(cmd[1]) for cmd in cmds ],
+            [ client.BATCH_SIZE, 1 ])
+
+    def test_skips_comments_and_reports_invalid_lines(self):
+        cmds = list(client._get_batch_cmds([ "# comment", "",
+            "add-trusted-sites a.com", "{not json",
+            "add-trusted-sites b.com" ]))
+        self.assertEqual(len(cmds), 3)
+        self.assertEqual(cmds[0], ("add-trusted-sites", [ "a.com" ], False))
+        self.assertIsNone(cmds[1][0])
+        self.assertTrue(cmds[1][2])
+        self.assertEqual(cmds[2], ("add-trusted-sites", [ "b.com" ], False))
+
+class ReadBatchLinesTest(unittest.TestCase):
+
+    def test_yields_none_when_no_input_is_ready(self):
+        (r, w) = os.pipe()
+        f = os.fdopen(r)
+        self.addCleanup(f.close)
+        os.write(w, "add-trusted-sites a.com\nadd-trusted")
+
+        lines = client._read_batch_lines(f)
+        self.assertEqual(next(lines), "add-trusted-sites a.com")
+        self.assertIsNone(next(lines))
+
+        os.write(w, "-sites b.com")
+        os.close(w)
+        self.assertEqual(list(lines), [ "add-trusted-sites b.com" ])
+
+class RunBatchTest(unittest.TestCase):
+
+    def test_runs_commands(self):
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write("add-trusted-sites a.com b.com\n"
+                "add-trusted-sites a.com\n"
+                "delete-trusted-sites b.com c.com\n"
+                "unknown-cmd\n")
+
+        session = _RecordingSession("memory:"+self.id())
+        self.assertEqual(client.run_batch(path, session), 1)
+        self.assertEqual(session.lines, [ "added a.com", "added b.com",
+            "exists a.com", "deleted b.com", "missing c.com",
+            "error unknown-cmd Unknown cmd unknown-cmd" ])
+        self.assertEqual(list(session.get_whitelist().contains_all(
+            [ "a.com", "b.com" ])), [ "a.com" ])
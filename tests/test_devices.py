@@ -0,0 +1,75 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.trial import unittest
+import devices
+import storage
+
+"""
+Tests of the resident device table.
+"""
+
+class _FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000000000.0
+
+    def time(self):
+        return self.now
+
+class _UntrackedStore(storage.Store):
+    """
+    A store whose version doesn't change when its devices do, like a
+    MongoDB collection edited without dnsfilter.
+    """
+
+    def __init__(self):
+        self.devices = {}
+
+    def find(self, query={}, projection=None, limit=0, skip=0, after=None,
+            batch_size=0):
+        return [ storage.StoreObject(name, dict(properties, _id=name))
+            for (name, properties) in self.devices.items() ]
+
+    def get_version(self):
+        return 1
+
+class DeviceTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = _FakeTime()
+        self.patch(devices, "time", self.time)
+        self.store = _UntrackedStore()
+        self.store.devices["10.0.0.1"] = { "is_filtered": False }
+        self.table = devices.DeviceTable(self.store,
+            full_refresh_interval=3600)
+
+    def test_skips_refresh_when_version_unchanged(self):
+        self.store.devices["10.0.0.1"] = { "is_filtered": True }
+        self.time.now += 30
+        self.assertEqual(self.table.refresh(), [])
+        self.assertEqual(self.table.get("10.0.0.1"), { "is_filtered": False })
+
+    def test_full_refresh_picks_up_untracked_changes(self):
+        self.store.devices["10.0.0.1"] = { "is_filtered": True }
+        self.store.devices["10.0.0.2"] = { "is_filtered": False }
+        self.time.now += 3600
+        self.assertEqual(sorted(self.table.refresh()),
+            [ "10.0.0.1", "10.0.0.2" ])
+        self.assertEqual(self.table.get("10.0.0.1"), { "is_filtered": True })
+
+    def test_full_refresh_without_changes(self):
+        self.time.now += 3600
+        self.assertEqual(self.table.refresh(), [])
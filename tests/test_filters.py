@@ -0,0 +1,160 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.internet import defer
+from twisted.names import dns, error
+from twisted.trial import unittest
+import caches
+import filters
+import resolvers
+
+"""
+Tests of the filter chain.
+"""
+
+class _FilterError(Exception):
+    pass
+
+class _StubFilter(filters.Filter):
+    """
+    A filter that allows or blocks every query, returning its verdict
+    directly or through a Deferred, or fails.
+    """
+
+    def __init__(self, allow=True, deferred=False, fail=False):
+        self.allow = allow
+        self.deferred = deferred
+        self.fail = fail
+        self.queries = []
+
+    def do_filter(self, query):
+        self.queries.append(query)
+        if self.fail:
+            if self.deferred:
+                return defer.fail(_FilterError())
+            raise _FilterError()
+
+        result = query if self.allow else None
+        if self.deferred:
+            return defer.succeed(result)
+        return result
+
+def _query():
+    query = dns.Query("example.com", dns.A, dns.IN)
+    query.device_addr = "10.0.0.1"
+    return query
+
+def _result(d):
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+class FilterChainTest(unittest.TestCase):
+
+    def test_sync_filters(self):
+        query = _query()
+        chain = filters.FilterChain([ _StubFilter(), _StubFilter() ])
+        self.assertIs(chain.do_filter(query), query)
+
+        last = _StubFilter()
+        chain = filters.FilterChain([ _StubFilter(allow=False), last ])
+        self.assertIsNone(chain.do_filter(query))
+        self.assertEqual(last.queries, [])
+
+    def test_async_filter_continues_chain(self):
+        query = _query()
+        last = _StubFilter()
+        chain = filters.FilterChain([ _StubFilter(),
+            _StubFilter(deferred=True), last ])
+
+        d = chain.do_filter(query)
+        self.assertIsInstance(d, defer.Deferred)
+        self.assertIs(_result(d), query)
+        self.assertEqual(last.queries, [ query ])
+
+    def test_async_filter_rejects(self):
+        last = _StubFilter()
+        chain = filters.FilterChain([ _StubFilter(allow=False, deferred=True),
+            last ])
+
+        self.assertIsNone(_result(chain.do_filter(_query())))
+        self.assertEqual(last.queries, [])
+
+    def test_sync_filter_rejects_after_async(self):
+        chain = filters.FilterChain([ _StubFilter(deferred=True),
+            _StubFilter(allow=False) ])
+        self.assertIsNone(_result(chain.do_filter(_query())))
+
+    def test_async_filters_in_a_row(self):
+        query = _query()
+        chain = filters.FilterChain([ _StubFilter(deferred=True),
+            _StubFilter(deferred=True) ])
+        self.assertIs(_result(chain.do_filter(query)), query)
+
+    def test_async_failure(self):
+        chain = filters.FilterChain([ _StubFilter(deferred=True, fail=True),
+            _StubFilter() ])
+        return self.assertFailure(chain.do_filter(_query()), _FilterError)
+
+    def test_failure_after_async_filter(self):
+        chain = filters.FilterChain([ _StubFilter(deferred=True),
+            _StubFilter(fail=True) ])
+        return self.assertFailure(chain.do_filter(_query()), _FilterError)
+
+    def test_async_failure_after_async_filter(self):
+        chain = filters.FilterChain([ _StubFilter(deferred=True),
+            _StubFilter(deferred=True, fail=True) ])
+        return self.assertFailure(chain.do_filter(_query()), _FilterError)
+
+class _StubResolver(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query, timeout=None):
+        self.queries.append(query)
+        return defer.succeed(([], [], []))
+
+class FilterResolverAsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sub_resolver = _StubResolver()
+        self.cache = caches.VerdictCache()
+
+    def _resolver(self, *chain):
+        return resolvers.FilterResolver(self.sub_resolver,
+            filters.FilterChain(list(chain)), verdict_cache=self.cache)
+
+    def test_resolves_async_allowed_query(self):
+        resolver = self._resolver(_StubFilter(deferred=True))
+        query = _query()
+        self.assertEqual(_result(resolver.query(query)), ([], [], []))
+        self.assertEqual(self.sub_resolver.queries, [ query ])
+        self.assertEqual(self.cache.get("10.0.0.1", "example.com"), True)
+
+    def test_blocks_async_rejected_query(self):
+        resolver = self._resolver(_StubFilter(deferred=True),
+            _StubFilter(allow=False))
+        d = resolver.query(_query())
+        self.assertEqual(self.sub_resolver.queries, [])
+        self.assertEqual(self.cache.get("10.0.0.1", "example.com"), False)
+        return self.assertFailure(d, error.DomainError)
+
+    def test_async_failure_is_not_cached(self):
+        resolver = self._resolver(_StubFilter(deferred=True),
+            _StubFilter(deferred=True, fail=True))
+        d = resolver.query(_query())
+        self.assertIsNone(self.cache.get("10.0.0.1", "example.com"))
+        return self.assertFailure(d, _FilterError)
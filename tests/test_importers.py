@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.trial import unittest
+import importers
+import whitelists
+
+"""
+Tests of the domain list importer.
+"""
+
+class IterNamesTest(unittest.TestCase):
+
+    def _names(self, lines, format=importers.AUTO_FORMAT):
+        stats = {}
+        names = list(importers.iter_names(lines, format, stats))
+        return (names, stats)
+
+    def test_hosts(self):
+        (names, stats) = self._names([ "# comment", "127.0.0.1 localhost",
+            "0.0.0.0 Example.COM. www.example.com # ads", "::1 ip6-localhost",
+            "example.net" ], importers.HOSTS_FORMAT)
+        self.assertEqual(names, [ "example.com", "www.example.com" ])
+        self.assertEqual(stats, { "lines": 4, "invalid": 1 })
+
+    def test_list(self):
+        (names, stats) = self._names([ "example.com", "", "two words",
+            "bad_domain-.com" ], importers.LIST_FORMAT)
+        self.assertEqual(names, [ "example.com" ])
+        self.assertEqual(stats, { "lines": 3, "invalid": 2 })
+
+    def test_adblock(self):
+        (names, stats) = self._names([ "! comment", "[Adblock Plus 2.0]",
+            "||example.com^", "@@||example.net^|", "||ads.example.org/path^",
+            "||*.example.org^" ], importers.ADBLOCK_FORMAT)
+        self.assertEqual(names, [ "example.com", "example.net" ])
+        self.assertEqual(stats, { "lines": 4, "invalid": 2 })
+
+    def test_auto(self):
+        (names, stats) = self._names([ "0.0.0.0 a.com", "b.com",
+            "||c.com^" ])
+        self.assertEqual(names, [ "a.com", "b.com", "c.com" ])
+        self.assertEqual(stats, { "lines": 3 })
+
+    def test_unknown_format(self):
+        self.assertRaises(Exception, list,
+            importers.iter_names([ "a.com" ], "csv"))
+
+class ImportNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.whitelist = whitelists.load("memory:"+self.id())
+
+    def _entries(self):
+        return sorted(self.whitelist.get_all())
+
+    def test_adds_new_names(self):
+        self.whitelist.add("a.com")
+        stats = importers.import_names(self.whitelist,
+            [ "a.com", "b.com", "b.com", "c.com" ], chunk_size=2)
+
+        # The second b.com is in the next chunk, so it's already there
+        self.assertEqual(self._entries(), [ "a.com", "b.com", "c.com" ])
+        self.assertEqual(stats, { "added": 2, "unchanged": 2, "deleted": 0,
+            "kept": 0 })
+
+    def test_replace_deletes_stale_entries(self):
+        self.whitelist.add_all([ "a.com", "Stale.COM" ])
+        stats = importers.import_names(self.whitelist, [ "a.com", "b.com" ],
+            replace=True)
+
+        self.assertEqual(self._entries(), [ "a.com", "b.com" ])
+        self.assertEqual(stats["deleted"], 1)
+
+    def test_replace_keeps_entries_as_stored(self):
+        self.whitelist.add("Example.COM.")
+        stats = importers.import_names(self.whitelist, [ "example.com" ],
+            replace=True)
+
+        self.assertEqual(self._entries(), [ "Example.COM." ])
+        self.assertEqual(stats["unchanged"], 1)
+        self.assertEqual(stats["deleted"], 0)
+
+    def test_replace_refuses_empty_import(self):
+        self.whitelist.add_all([ "a.com", "b.com" ])
+        stats = importers.import_names(self.whitelist, [], replace=True)
+
+        self.assertEqual(self._entries(), [ "a.com", "b.com" ])
+        self.assertEqual(stats["kept"], 2)
+        self.assertEqual(stats["deleted"], 0)
+
+    def test_replace_refuses_invalid_lines(self):
+        self.whitelist.add_all([ "a.com", "b.com" ])
+        stats = importers.import_lists(self.whitelist, [ self._list(
+            "a.com\nnot a name\n") ], replace=True)
+
+        self.assertEqual(self._entries(), [ "a.com", "b.com" ])
+        self.assertEqual(stats["invalid"], 1)
+        self.assertEqual(stats["kept"], 1)
+
+    def test_replace_with_force(self):
+        self.whitelist.add_all([ "a.com", "b.com" ])
+        stats = importers.import_lists(self.whitelist, [ self._list(
+            "a.com\nnot a name\n") ], replace=True, force=True)
+
+        self.assertEqual(self._entries(), [ "a.com" ])
+        self.assertEqual(stats["deleted"], 1)
+        self.assertEqual(stats["kept"], 0)
+
+    def _list(self, text):
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write(text)
+        return path
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.trial import unittest
+import patterns
+
+"""
+Tests of the wildcard domain patterns.
+"""
+
+class LiteralSuffixTest(unittest.TestCase):
+
+    def test_literal_suffix(self):
+        self.assertEqual(patterns.literal_suffix("*.cdn-*.example.net"),
+            "example.net")
+        self.assertEqual(patterns.literal_suffix("ads.*"), "")
+        self.assertEqual(patterns.literal_suffix("example.com"),
+            "example.com")
+
+class PatternIndexTest(unittest.TestCase):
+
+    def test_wildcard(self):
+        index = patterns.PatternIndex([ "ads*.example.com" ])
+        self.assertTrue(index.matches("ads.example.com"))
+        self.assertTrue(index.matches("ads2.example.com"))
+        self.assertFalse(index.matches("example.com"))
+        self.assertFalse(index.matches("www.example.com"))
+
+    def test_single_character(self):
+        index = patterns.PatternIndex([ "cdn?.example.com" ])
+        self.assertTrue(index.matches("cdn1.example.com"))
+        self.assertFalse(index.matches("cdn.example.com"))
+        self.assertFalse(index.matches("cdn12.example.com"))
+
+    def test_character_class(self):
+        index = patterns.PatternIndex([ "s[0-9].example.com",
+            "t[!0-9].example.com" ])
+        self.assertTrue(index.matches("s1.example.com"))
+        self.assertFalse(index.matches("sa.example.com"))
+        self.assertTrue(index.matches("ta.example.com"))
+        self.assertFalse(index.matches("t1.example.com"))
+
+    def test_multiple_wildcard_labels(self):
+        index = patterns.PatternIndex([ "*.cdn-*.example.net" ])
+        self.assertTrue(index.matches("a.cdn-1.example.net"))
+        self.assertTrue(index.matches("a.b.cdn-eu.example.net"))
+        self.assertFalse(index.matches("cdn-1.example.net"))
+        self.assertFalse(index.matches("a.cdn.example.net"))
+
+    def test_wildcard_suffix(self):
+        index = patterns.PatternIndex([ "tracker.*" ])
+        self.assertTrue(index.matches("tracker.example.com"))
+        self.assertFalse(index.matches("example.com"))
+
+    def test_parent_domains(self):
+        index = patterns.PatternIndex([ "cdn?.example.com" ])
+        self.assertTrue(index.matches("img.cdn1.example.com"))
+        self.assertTrue(index.matches("a.b.cdn1.example.com"))
+        self.assertFalse(index.matches("img.cdn.example.com"))
+
+    def test_literal_characters(self):
+        index = patterns.PatternIndex([ "a+b*.example.com" ])
+        self.assertTrue(index.matches("a+b1.example.com"))
+        self.assertFalse(index.matches("aab1.example.com"))
+
+    def test_add(self):
+        index = patterns.PatternIndex([ "a*.example.com" ])
+        index.add("b*.example.com")
+        self.assertTrue(index.matches("a1.example.com"))
+        self.assertTrue(index.matches("b1.example.com"))
+        self.assertEqual(len(index), 2)
+        self.assertTrue(index.contains("b*.example.com"))
+
+    def test_discard_recompiles_group(self):
+        index = patterns.PatternIndex([ "a*.example.com", "b*.example.com" ])
+        index.discard("a*.example.com")
+        self.assertFalse(index.matches("a1.example.com"))
+        self.assertTrue(index.matches("b1.example.com"))
+        self.assertFalse(index.contains("a*.example.com"))
+
+    def test_discard_last_pattern(self):
+        index = patterns.PatternIndex([ "a*.example.com" ])
+        index.discard_all([ "a*.example.com", "missing*.example.com" ])
+        self.assertFalse(index.matches("a1.example.com"))
+        self.assertEqual(index.groups, {})
+        self.assertEqual(index.compiled, {})
+
+    def test_matching_does_not_change_the_index(self):
+        index = patterns.PatternIndex([ "a*.example.com" ])
+        compiled = dict(index.compiled)
+        index.matches("a1.example.com")
+        self.assertEqual(index.compiled, compiled)
+
+    def test_copy(self):
+        index = patterns.PatternIndex([ "a*.example.com", "b*.example.com" ])
+        copy = index.copy()
+        copy.discard("a*.example.com")
+        copy.add("c*.example.org")
+
+        self.assertTrue(index.matches("a1.example.com"))
+        self.assertFalse(index.matches("c1.example.org"))
+        self.assertFalse(copy.matches("a1.example.com"))
+        self.assertTrue(copy.matches("b1.example.com"))
+        self.assertTrue(copy.matches("c1.example.org"))
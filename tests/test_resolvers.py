@@ -0,0 +1,285 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.internet import defer, task
+from twisted.names import dns, error
+from twisted.trial import unittest
+import resolvers
+
+"""
+Tests of the caching and coalescing resolvers.
+"""
+
+class _ServerFailure(Exception):
+    pass
+
+class _StubResolver(object):
+    """
+    A resolver whose queries are answered by the test, through the Deferred
+    of each query in pending.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def query(self, query, timeout=None):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+def _answer(name, ttl, addr="10.0.0.1"):
+    return ([ dns.RRHeader(name, dns.A, dns.IN, ttl,
+        dns.Record_A(addr, ttl)) ], [], [])
+
+def _result(d):
+    """
+    Get the result of d, or None if it hasn't fired.
+    """
+    results = []
+
+    def got(result):
+        results.append(result)
+        return result
+
+    d.addBoth(got)
+    return results[0] if results else None
+
+class CachingResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sub_resolver = _StubResolver()
+        self.query = dns.Query("example.com", dns.A, dns.IN)
+
+    def _resolver(self, **kwargs):
+        return resolvers.CachingResolver(self.sub_resolver,
+            clock=self.clock, **kwargs)
+
+    def _fill(self, resolver, ttl=100):
+        d = resolver.query(self.query)
+        self.sub_resolver.pending.pop().callback(_answer("example.com", ttl))
+        return _result(d)
+
+    def test_caches_answers(self):
+        resolver = self._resolver()
+        self._fill(resolver)
+
+        self.clock.advance(30)
+        result = _result(resolver.query(self.query))
+        self.assertEqual(result[0][0].ttl, 70)
+        self.assertEqual(self.sub_resolver.pending, [])
+        self.assertEqual((resolver.hits, resolver.misses), (1, 1))
+
+    def test_expires_after_ttl(self):
+        resolver = self._resolver()
+        self._fill(resolver)
+
+        self.clock.advance(100)
+        d = resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+        self.assertIsNone(_result(d))
+
+    def test_caps_ttl(self):
+        resolver = self._resolver(max_ttl=10)
+        self._fill(resolver)
+
+        self.clock.advance(10)
+        resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+
+    def test_caches_negative_answers(self):
+        resolver = self._resolver(negative_ttl=60)
+        d = resolver.query(self.query)
+        self.sub_resolver.pending.pop().errback(error.DNSNameError())
+        self.assertFailure(d, error.DNSNameError)
+
+        self.clock.advance(30)
+        d = resolver.query(self.query)
+        self.assertEqual(self.sub_resolver.pending, [])
+        self.assertFailure(d, error.DNSNameError)
+
+        self.clock.advance(30)
+        resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+
+    def test_does_not_cache_failures(self):
+        resolver = self._resolver()
+        d = resolver.query(self.query)
+        self.sub_resolver.pending.pop().errback(_ServerFailure())
+        self.assertFailure(d, _ServerFailure)
+
+        resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+
+    def test_prefetch_in_last_tenth_of_ttl(self):
+        resolver = self._resolver()
+        self._fill(resolver)
+
+        self.clock.advance(89)
+        resolver.query(self.query)
+        self.assertEqual(self.sub_resolver.pending, [])
+
+        # The cached answer is served while it is refreshed, once
+        self.clock.advance(2)
+        self.assertEqual(_result(resolver.query(self.query))[0][0].ttl, 9)
+        resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+        self.assertEqual(resolver.prefetches, 1)
+
+        self.sub_resolver.pending.pop().callback(_answer("example.com", 100,
+            "10.0.0.2"))
+        result = _result(resolver.query(self.query))
+        self.assertEqual(result[0][0].ttl, 100)
+        self.assertEqual(result[0][0].payload.dottedQuad(), "10.0.0.2")
+
+    def test_no_prefetch(self):
+        resolver = self._resolver(prefetch=False)
+        self._fill(resolver)
+
+        self.clock.advance(95)
+        resolver.query(self.query)
+        self.assertEqual(self.sub_resolver.pending, [])
+
+    def test_serves_stale_after_timeout(self):
+        resolver = self._resolver(max_stale=300, stale_timeout=1.8,
+            stale_ttl=30)
+        self._fill(resolver)
+
+        self.clock.advance(150)
+        d = resolver.query(self.query)
+        self.clock.advance(1.5)
+        self.assertIsNone(_result(d))
+
+        self.clock.advance(0.5)
+        self.assertEqual(_result(d)[0][0].ttl, 30)
+        self.assertEqual(resolver.stale, 1)
+
+        # The late answer still refreshes the cache
+        self.sub_resolver.pending.pop().callback(_answer("example.com", 100,
+            "10.0.0.2"))
+        result = _result(resolver.query(self.query))
+        self.assertEqual(result[0][0].payload.dottedQuad(), "10.0.0.2")
+
+    def test_serves_stale_on_failure(self):
+        resolver = self._resolver(max_stale=300, stale_ttl=30)
+        self._fill(resolver)
+
+        self.clock.advance(150)
+        d = resolver.query(self.query)
+        self.sub_resolver.pending.pop().errback(_ServerFailure())
+
+        self.assertEqual(_result(d)[0][0].ttl, 30)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_answer_cancels_stale_timer(self):
+        resolver = self._resolver(max_stale=300)
+        self._fill(resolver)
+
+        self.clock.advance(150)
+        d = resolver.query(self.query)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.sub_resolver.pending.pop().callback(_answer("example.com", 100,
+            "10.0.0.2"))
+        self.assertEqual(_result(d)[0][0].payload.dottedQuad(), "10.0.0.2")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(resolver.stale, 0)
+
+    def test_nxdomain_replaces_stale_answer(self):
+        resolver = self._resolver(max_stale=300)
+        self._fill(resolver)
+
+        self.clock.advance(150)
+        d = resolver.query(self.query)
+        self.sub_resolver.pending.pop().errback(error.DNSNameError())
+        return self.assertFailure(d, error.DNSNameError)
+
+    def test_drops_answers_too_stale_to_serve(self):
+        resolver = self._resolver(max_stale=300)
+        self._fill(resolver)
+
+        self.clock.advance(401)
+        d = resolver.query(self.query)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertIsNone(_result(d))
+
+class CoalescingResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sub_resolver = _StubResolver()
+        self.resolver = resolvers.CoalescingResolver(self.sub_resolver)
+        self.query = dns.Query("example.com", dns.A, dns.IN)
+
+    def test_shares_one_upstream_query(self):
+        first = self.resolver.query(self.query)
+        second = self.resolver.query(dns.Query("Example.COM", dns.A,
+            dns.IN))
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+        self.assertEqual((self.resolver.sent, self.resolver.coalesced),
+            (1, 1))
+
+        answer = _answer("example.com", 100)
+        self.sub_resolver.pending.pop().callback(answer)
+        self.assertEqual(_result(first), answer)
+        self.assertEqual(_result(second), answer)
+        self.assertEqual(self.resolver.in_flight, {})
+
+    def test_copies_results_per_caller(self):
+        first = self.resolver.query(self.query)
+        second = self.resolver.query(self.query)
+        self.sub_resolver.pending.pop().callback(_answer("example.com", 100))
+
+        first_result = _result(first)
+        second_result = _result(second)
+        for (a, b) in zip(first_result, second_result):
+            self.assertIsNot(a, b)
+
+        # A caller changing its answer doesn't change the other's
+        second_result[0].append(second_result[0][0])
+        self.assertEqual(len(first_result[0]), 1)
+
+    def test_does_not_share_other_queries(self):
+        self.resolver.query(self.query)
+        self.resolver.query(dns.Query("example.com", dns.AAAA, dns.IN))
+        self.resolver.query(dns.Query("example.net", dns.A, dns.IN))
+        self.assertEqual(len(self.sub_resolver.pending), 3)
+
+    def test_errors_reach_every_caller(self):
+        first = self.resolver.query(self.query)
+        second = self.resolver.query(self.query)
+        self.sub_resolver.pending.pop().errback(_ServerFailure())
+
+        self.assertEqual(self.resolver.in_flight, {})
+        return defer.gatherResults([
+            self.assertFailure(first, _ServerFailure),
+            self.assertFailure(second, _ServerFailure) ])
+
+    def test_failure_is_not_pinned(self):
+        d = self.resolver.query(self.query)
+        self.sub_resolver.pending.pop().errback(_ServerFailure())
+        self.assertFailure(d, _ServerFailure)
+
+        d = self.resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+        self.sub_resolver.pending.pop().callback(_answer("example.com", 100))
+        self.assertEqual(_result(d)[0][0].ttl, 100)
+
+    def test_sends_again_after_answer(self):
+        self.resolver.query(self.query)
+        self.sub_resolver.pending.pop().callback(_answer("example.com", 100))
+
+        self.resolver.query(self.query)
+        self.assertEqual(len(self.sub_resolver.pending), 1)
+        self.assertEqual(self.resolver.coalesced, 0)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import time
+from twisted.names import dns
+from twisted.trial import unittest
+import resolvers
+import server
+
+"""
+Tests of the responses the server sends for blocked queries.
+"""
+
+class _FakeProtocol(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def writeMessage(self, message, address=None):
+        self.messages.append(message)
+
+class _ResponseFactory(server.ServerFactory):
+    """
+    The server factory without its resolvers and filters, for testing how it
+    builds responses.
+    """
+
+    def __init__(self):
+        server.server.DNSServerFactory.__init__(self)
+
+class BlockResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = _ResponseFactory()
+        self.protocol = _FakeProtocol()
+
+    def _respond(self, mode, type=dns.A):
+        """
+        Get the response message the server sends for a blocked query.
+        """
+        responder = resolvers.BlockResponder(mode, ttl=120,
+            sinkhole_addr="10.9.9.9", sinkhole_addr6="fd00::9")
+        message = dns.Message(id=1)
+        message.addQuery("ads.example.com", type)
+        message.timeReceived = time.time()
+        address = ("10.0.0.1", 53000)
+
+        d = responder.respond(message.queries[0])
+        d.addCallbacks(self.factory.gotResolverResponse,
+            self.factory.gotResolverError,
+            callbackArgs=(self.protocol, message, address),
+            errbackArgs=(self.protocol, message, address))
+
+        self.assertEqual(len(self.protocol.messages), 1)
+        response = self.protocol.messages[0]
+        self.assertEqual(response.id, 1)
+        self.assertTrue(response.answer)
+        return response
+
+    def _assertSOA(self, response):
+        self.assertEqual(len(response.authority), 1)
+        soa = response.authority[0]
+        self.assertEqual(soa.name.name, "ads.example.com")
+        self.assertEqual(soa.type, dns.SOA)
+        self.assertEqual(soa.ttl, 120)
+        self.assertEqual(soa.payload.minimum, 120)
+
+    def test_error(self):
+        response = self._respond(resolvers.BlockResponder.ERROR)
+        self.assertEqual(response.rCode, dns.ENAME)
+        self.assertEqual(response.answers, [])
+        self.assertEqual(response.authority, [])
+
+    def test_nxdomain(self):
+        response = self._respond(resolvers.BlockResponder.NXDOMAIN)
+        self.assertEqual(response.rCode, dns.ENAME)
+        self.assertEqual(response.answers, [])
+        self._assertSOA(response)
+
+    def test_nodata(self):
+        response = self._respond(resolvers.BlockResponder.NODATA)
+        self.assertEqual(response.rCode, dns.OK)
+        self.assertEqual(response.answers, [])
+        self._assertSOA(response)
+
+    def test_sinkhole(self):
+        response = self._respond(resolvers.BlockResponder.SINKHOLE)
+        self.assertEqual(response.rCode, dns.OK)
+        self.assertEqual(len(response.answers), 1)
+        answer = response.answers[0]
+        self.assertEqual(answer.type, dns.A)
+        self.assertEqual(answer.ttl, 120)
+        self.assertEqual(answer.payload.dottedQuad(), "10.9.9.9")
+        self.assertEqual(response.authority, [])
+
+    def test_sinkhole_ipv6(self):
+        response = self._respond(resolvers.BlockResponder.SINKHOLE,
+            dns.AAAA)
+        self.assertEqual(response.rCode, dns.OK)
+        self.assertEqual(len(response.answers), 1)
+        self.assertEqual(response.answers[0].type, dns.AAAA)
+        self.assertEqual(response.answers[0].payload._address, "fd00::9")
+
+    def test_sinkhole_other_types(self):
+        response = self._respond(resolvers.BlockResponder.SINKHOLE, dns.MX)
+        self.assertEqual(response.rCode, dns.OK)
+        self.assertEqual(response.answers, [])
+        self._assertSOA(response)
+
+    def test_invalid_mode(self):
+        self.assertRaises(Exception, resolvers.BlockResponder, "refuse")
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import datetime
+from twisted.trial import unittest
+import storage
+
+"""
+Tests of the memory and SQLite stores.
+"""
+
+class _StoreTests(object):
+    """
+    Tests run against each store implementation.
+    """
+
+    def get_store(self, name="test"):
+        raise NotImplementedError()
+
+    def test_create_read(self):
+        store = self.get_store()
+        store.create("a", { "value": 1 })
+
+        obj = store.read("a")
+        self.assertEqual(obj.name, "a")
+        self.assertEqual(obj["value"], 1)
+        self.assertIsNone(obj.get("missing"))
+        self.assertIsNone(store.read("b"))
+
+    def test_update(self):
+        store = self.get_store()
+        store.create("a", { "value": 1, "other": "x" })
+        store.update("a", { "value": 2 })
+
+        obj = store.read("a")
+        self.assertEqual(obj["value"], 2)
+        self.assertEqual(obj["other"], "x")
+
+    def test_delete(self):
+        store = self.get_store()
+        store.create_all([ ("a", {}), ("b", {}) ])
+        store.delete("a")
+
+        self.assertIsNone(store.read("a"))
+        self.assertIsNotNone(store.read("b"))
+
+    def test_read_all(self):
+        store = self.get_store()
+        store.create_all([ ("a", { "value": 1 }), ("b", { "value": 2 }) ])
+
+        objects = store.read_all([ "a", "b", "c" ])
+        self.assertEqual(sorted(objects), [ "a", "b" ])
+        self.assertEqual(objects["b"]["value"], 2)
+        self.assertEqual(store.read_all([]), {})
+
+    def test_read_all_many(self):
+        store = self.get_store()
+        names = [ str(i) for i in range(1200) ]
+        store.create_all([ (name, {}) for name in names ])
+
+        self.assertEqual(sorted(store.read_all(names)), sorted(names))
+
+    def test_delete_all(self):
+        store = self.get_store()
+        store.create_all([ ("a", {}), ("b", {}), ("c", {}) ])
+        store.delete_all([ "a", "c", "d" ])
+
+        self.assertEqual(sorted(store.read_all([ "a", "b", "c" ])), [ "b" ])
+
+    def test_upsert_all(self):
+        store = self.get_store()
+        store.create("a", { "value": 1, "other": "x" })
+        store.upsert_all([ ("a", { "value": 2 }), ("b", { "value": 3 }) ])
+
+        objects = store.read_all([ "a", "b" ])
+        self.assertEqual(objects["a"]["value"], 2)
+        self.assertEqual(objects["a"]["other"], "x")
+        self.assertEqual(objects["b"]["value"], 3)
+        self.assertEqual(len(list(store.find({ "name": "a" }))), 1)
+
+    def test_find_equality(self):
+        store = self.get_store()
+        store.create_all([ ("a", { "device": "d1" }),
+            ("b", { "device": "d2" }), ("c", { "device": "d1" }) ])
+
+        self.assertEqual(sorted(obj.name for obj in
+            store.find({ "device": "d1" })), [ "a", "c" ])
+        self.assertEqual(list(store.find({ "device": "d3" })), [])
+
+    def test_find_time_range(self):
+        store = self.get_store()
+        start = datetime.datetime(2016, 5, 1)
+        store.create_all([ (str(i), { "time": start +
+            datetime.timedelta(minutes=i) }) for i in range(5) ])
+
+        found = store.find({ "time": {
+            "$gte": start + datetime.timedelta(minutes=1),
+            "$lt": start + datetime.timedelta(minutes=3) } })
+        self.assertEqual(sorted(obj.name for obj in found), [ "1", "2" ])
+
+    def test_find_paging(self):
+        store = self.get_store()
+        store.create_all([ (str(i), { "n": i }) for i in range(5) ])
+
+        page = list(store.find(limit=2))
+        self.assertEqual([ obj.name for obj in page ], [ "0", "1" ])
+
+        page = list(store.find(limit=2, after=store.get_token(page[-1])))
+        self.assertEqual([ obj.name for obj in page ], [ "2", "3" ])
+
+        page = list(store.find(skip=4))
+        self.assertEqual([ obj.name for obj in page ], [ "4" ])
+
+    def test_find_projection(self):
+        store = self.get_store()
+        store.create("a", { "device": "d1", "domain": "example.com" })
+
+        obj = list(store.find(projection=[ "domain" ]))[0]
+        self.assertEqual(obj.name, "a")
+        self.assertEqual(obj["domain"], "example.com")
+        self.assertIsNone(obj.get("device"))
+
+    def _create_lookups(self, store):
+        lookups = [ ("d1", "a.com", 3), ("d1", "b.com", 2), ("d1", "c.com", 1),
+            ("d2", "b.com", 1), ("d2", "c.com", 4) ]
+        store.create_all([ ("%s-%s-%d" % (device, domain, i),
+            { "device": device, "domain": domain })
+            for (device, domain, count) in lookups for i in range(count) ])
+
+    def test_group_count(self):
+        store = self.get_store()
+        self._create_lookups(store)
+
+        self.assertEqual(store.group_count([ "domain" ]), [
+            { "domain": "c.com", "count": 5 },
+            { "domain": "a.com", "count": 3 },
+            { "domain": "b.com", "count": 3 } ])
+        self.assertEqual(store.group_count([ "domain" ], { "device": "d1" },
+            limit=1), [ { "domain": "a.com", "count": 3 } ])
+
+    def test_group_count_group_limit(self):
+        store = self.get_store()
+        self._create_lookups(store)
+
+        self.assertEqual(store.group_count([ "device", "domain" ],
+            group_limit=2), [
+                { "device": "d2", "domain": "c.com", "count": 4 },
+                { "device": "d1", "domain": "a.com", "count": 3 },
+                { "device": "d1", "domain": "b.com", "count": 2 },
+                { "device": "d2", "domain": "b.com", "count": 1 } ])
+        self.assertEqual(store.group_count([ "device", "domain" ],
+            limit=2, group_limit=1), [
+                { "device": "d2", "domain": "c.com", "count": 4 },
+                { "device": "d1", "domain": "a.com", "count": 3 } ])
+        self.assertRaises(ValueError, store.group_count, [],
+            group_limit=1)
+
+    def test_version(self):
+        store = self.get_store(storage.TRUSTED_SITES_STORE)
+        version = store.get_version()
+        store.create("a", {})
+        self.assertNotEqual(store.get_version(), version)
+
+        version = store.get_version()
+        store.delete("a")
+        self.assertNotEqual(store.get_version(), version)
+
+    def test_unversioned(self):
+        self.assertIsNone(self.get_store().get_version())
+
+class MemoryStoreTest(_StoreTests, unittest.TestCase):
+
+    def get_store(self, name="test"):
+        return storage.create_store("memory:"+self.id(), name)
+
+class SQLiteStoreTest(_StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def get_store(self, name="test"):
+        return storage.create_store("sqlite:"+self.path, name)
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.internet import defer, reactor, task
+from twisted.names import common, dns, error, server
+from twisted.trial import unittest
+import upstreams
+
+"""
+Tests of the upstream pool against stub DNS servers on loopback.
+"""
+
+class _ServerFailure(Exception):
+    pass
+
+class StubUpstream(common.ResolverBase):
+    """
+    A stub upstream that answers A queries with its own address, or fails
+    them as its mode says: "answer", "drop" (never answer), "servfail" or
+    "nxdomain".
+    """
+
+    def __init__(self, addr, mode="answer", delay=0):
+        common.ResolverBase.__init__(self)
+        self.addr = addr
+        self.mode = mode
+        self.delay = delay
+        self.queries = 0
+
+    def _answer(self, name):
+        return ([ dns.RRHeader(name, dns.A, dns.IN, 60,
+            dns.Record_A(self.addr, 60)) ], [], [])
+
+    def _lookup(self, name, cls, type, timeout):
+        self.queries += 1
+        if self.mode == "drop":
+            return defer.Deferred()
+        if self.mode == "servfail":
+            return defer.fail(_ServerFailure())
+        if self.mode == "nxdomain":
+            return defer.fail(error.DomainError(name))
+        if self.delay:
+            return task.deferLater(reactor, self.delay, self._answer, name)
+        return defer.succeed(self._answer(name))
+
+class _StubServerFactory(server.DNSServerFactory):
+    """
+    Sends SERVFAIL for the stub's failures without logging them.
+    """
+
+    def gotResolverError(self, failure, protocol, message, address):
+        if failure.check(_ServerFailure):
+            response = self._responseFromMessage(message=message,
+                rCode=dns.ESERVER)
+            self.sendReply(protocol, response, address)
+        else:
+            server.DNSServerFactory.gotResolverError(self, failure, protocol,
+                message, address)
+
+class UpstreamPoolTest(unittest.TestCase):
+
+    def _listen(self, stub):
+        protocol = dns.DNSDatagramProtocol(
+            controller=_StubServerFactory(clients=[ stub ]))
+        port = reactor.listenUDP(0, protocol, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        return ("127.0.0.1", port.getHost().port)
+
+    def _pool(self, *stubs, **kwargs):
+        kwargs.setdefault("timeout", 0.2)
+        kwargs.setdefault("probe_interval", 0)
+        return upstreams.UpstreamPool([ self._listen(stub) for stub in stubs ],
+            **kwargs)
+
+    def _answered_by(self, result):
+        (answers, authority, additional) = result
+        return answers[0].payload.dottedQuad()
+
+    @defer.inlineCallbacks
+    def test_orders_by_srtt(self):
+        slow = StubUpstream("10.0.0.1", delay=0.05)
+        fast = StubUpstream("10.0.0.2")
+        pool = self._pool(slow, fast)
+
+        yield pool.probe()
+        yield pool.probe()
+        self.assertEqual([ u.addr[1] for u in pool.get_upstreams() ],
+            [ pool.upstreams[1].addr[1], pool.upstreams[0].addr[1] ])
+        self.assertTrue(pool.upstreams[1].srtt < pool.upstreams[0].srtt)
+
+        result = yield pool.lookupAddress("example.com")
+        self.assertEqual(self._answered_by(result), "10.0.0.2")
+
+    @defer.inlineCallbacks
+    def test_fails_over_on_timeout(self):
+        down = StubUpstream("10.0.0.1", mode="drop")
+        up = StubUpstream("10.0.0.2")
+        pool = self._pool(down, up)
+
+        result = yield pool.lookupAddress("example.com")
+        self.assertEqual(self._answered_by(result), "10.0.0.2")
+        self.assertEqual(down.queries, 1)
+        self.assertEqual(pool.upstreams[0].failures, 1)
+
+    @defer.inlineCallbacks
+    def test_fails_over_on_servfail(self):
+        failing = StubUpstream("10.0.0.1", mode="servfail")
+        up = StubUpstream("10.0.0.2")
+        pool = self._pool(failing, up)
+
+        result = yield pool.lookupAddress("example.com")
+        self.assertEqual(self._answered_by(result), "10.0.0.2")
+        self.assertEqual(failing.queries, 1)
+        self.assertEqual(pool.upstreams[0].failures, 1)
+
+    @defer.inlineCallbacks
+    def test_nxdomain_is_an_answer(self):
+        nxdomain = StubUpstream("10.0.0.1", mode="nxdomain")
+        up = StubUpstream("10.0.0.2")
+        pool = self._pool(nxdomain, up)
+
+        yield self.assertFailure(pool.lookupAddress("example.com"),
+            error.DNSNameError)
+        self.assertEqual(up.queries, 0)
+        self.assertEqual(pool.upstreams[0].failures, 0)
+
+    @defer.inlineCallbacks
+    def test_all_upstreams_failing(self):
+        pool = self._pool(StubUpstream("10.0.0.1", mode="servfail"),
+            StubUpstream("10.0.0.2", mode="servfail"))
+
+        yield self.assertFailure(pool.lookupAddress("example.com"),
+            error.DNSServerError)
+
+    @defer.inlineCallbacks
+    def test_race_uses_first_answer(self):
+        slow = StubUpstream("10.0.0.1", delay=0.1)
+        fast = StubUpstream("10.0.0.2")
+        pool = self._pool(slow, fast, race=True)
+
+        result = yield pool.lookupAddress("example.com")
+        self.assertEqual(self._answered_by(result), "10.0.0.2")
+        self.assertEqual((slow.queries, fast.queries), (1, 1))
+
+        # Let the slow upstream answer too, so the srtt of both is known
+        yield task.deferLater(reactor, 0.15, lambda: None)
+        self.assertTrue(pool.upstreams[1].srtt < pool.upstreams[0].srtt)
+
+    @defer.inlineCallbacks
+    def test_race_waits_for_an_answer_after_a_failure(self):
+        failing = StubUpstream("10.0.0.1", mode="servfail")
+        slow = StubUpstream("10.0.0.2", delay=0.05)
+        pool = self._pool(failing, slow, race=True)
+
+        result = yield pool.lookupAddress("example.com")
+        self.assertEqual(self._answered_by(result), "10.0.0.2")
+
+    @defer.inlineCallbacks
+    def test_race_fails_when_both_fail(self):
+        pool = self._pool(StubUpstream("10.0.0.1", mode="servfail"),
+            StubUpstream("10.0.0.2", mode="drop"), race=True)
+
+        yield self.assertFailure(pool.lookupAddress("example.com"),
+            error.DNSServerError, defer.TimeoutError)
+
+    @defer.inlineCallbacks
+    def test_probe_brings_upstream_back(self):
+        flaky = StubUpstream("10.0.0.1", mode="drop")
+        up = StubUpstream("10.0.0.2")
+        pool = self._pool(flaky, up, max_failures=2)
+
+        yield pool.probe()
+        yield pool.probe()
+        self.assertFalse(pool.upstreams[0].healthy)
+        self.assertEqual(pool.get_upstreams(), [ pool.upstreams[1] ])
+
+        flaky.mode = "answer"
+        yield pool.probe()
+        self.assertTrue(pool.upstreams[0].healthy)
+        self.assertIn(pool.upstreams[0], pool.get_upstreams())
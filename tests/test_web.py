@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import argparse
+from twisted.web import resource
+from twisted.web.test import requesthelper
+from twisted.trial import unittest
+import web
+
+"""
+Tests of the web interface resources.
+"""
+
+class GzipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = web.RootWebResource(argparse.Namespace(
+            url="memory:"+self.id()))
+
+    def _get_resource(self, path):
+        request = requesthelper.DummyRequest(path.strip("/").split("/"))
+        request.requestHeaders.setRawHeaders("accept-encoding", [ "gzip" ])
+        return resource.getChildForRequest(self.root, request)
+
+    def test_webservices_are_compressed(self):
+        for path in [ "/sites", "/devices", "/logs", "/rollups" ]:
+            self.assertIsInstance(self._get_resource(path),
+                resource.EncodingResourceWrapper)
+
+    def test_webservice_children_are_compressed(self):
+        for path in [ "/sites/example.com", "/devices/10.0.0.1",
+                "/sites/a/b" ]:
+            child = self._get_resource(path)
+            self.assertIsInstance(child, resource.EncodingResourceWrapper)
+            self.assertIsInstance(child.original, web.WebResource)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+from twisted.trial import unittest
+import whitelists
+
+"""
+Tests of the in-memory whitelists read from files.
+"""
+
+class DirWhitelistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.makedirs(self.path)
+        self.mtime = 1000000000
+
+    def _write(self, name, *entries):
+        path = os.path.join(self.path, name)
+        with open(path, "w") as f:
+            f.write("".join(entry+"\n" for entry in entries))
+
+        # Change the mtime, as a rewrite in the same second may not
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+
+    def test_reads_every_file(self):
+        self._write("a.conf", "a.com", "Shared.com.  # comment")
+        self._write("b.conf", "shared.com", "*.cdn-*.example.net")
+        whitelist = whitelists.DirWhitelist(self.path)
+
+        self.assertEqual(sorted(whitelist.get_all()), [ "*.cdn-*.example.net",
+            "a.com", "shared.com" ])
+        self.assertTrue(whitelist.matches("www.a.com"))
+        self.assertTrue(whitelist.matches("a.cdn-1.example.net"))
+
+    def test_refresh_applies_changes(self):
+        self._write("a.conf", "a.com", "shared.com", "x*.example.com")
+        self._write("b.conf", "shared.com")
+        whitelist = whitelists.DirWhitelist(self.path)
+        version = whitelist.get_version()
+
+        self._write("a.conf", "b.com", "y*.example.com")
+        self.assertTrue(whitelist.refresh())
+        self.assertNotEqual(whitelist.get_version(), version)
+
+        self.assertEqual(sorted(whitelist.get_all()), [ "b.com", "shared.com",
+            "y*.example.com" ])
+        self.assertFalse(whitelist.matches("x1.example.com"))
+        self.assertTrue(whitelist.matches("y1.example.com"))
+
+        self.assertFalse(whitelist.refresh())
+
+    def test_refresh_moves_entry_between_files(self):
+        self._write("a.conf", "a.com")
+        self._write("b.conf")
+        whitelist = whitelists.DirWhitelist(self.path)
+
+        self._write("a.conf")
+        self._write("b.conf", "a.com")
+        self.assertTrue(whitelist.refresh())
+        self.assertTrue(whitelist.matches("a.com"))
+
+    def test_refresh_removed_file(self):
+        self._write("a.conf", "a.com")
+        self._write("b.conf", "b.com")
+        whitelist = whitelists.DirWhitelist(self.path)
+
+        os.remove(os.path.join(self.path, "b.conf"))
+        self.assertTrue(whitelist.refresh())
+        self.assertEqual(whitelist.get_all(), [ "a.com" ])
+
+    def test_refresh_swaps_the_index(self):
+        self._write("a.conf", "a.com", "x*.example.com")
+        whitelist = whitelists.DirWhitelist(self.path)
+        index = whitelist.index
+
+        self._write("a.conf", "b.com", "y*.example.com")
+        whitelist.refresh()
+
+        # The index lookups were using is never changed by a refresh
+        self.assertIsNot(whitelist.index, index)
+        self.assertEqual(sorted(index.get_all()), [ "a.com",
+            "x*.example.com" ])
+        self.assertTrue(index.matches("x1.example.com"))
+
+class FileWhitelistTest(unittest.TestCase):
+
+    def test_add_and_delete(self):
+        path = self.mktemp()
+        whitelist = whitelists.FileWhitelist(path)
+
+        whitelist.add_all([ "a.com", "b.com", "A.com" ])
+        self.assertEqual(sorted(whitelist.get_all()), [ "a.com", "b.com" ])
+
+        whitelist.delete("a.com")
+        self.assertEqual(whitelist.get_all(), [ "b.com" ])
+        with open(path) as f:
+            self.assertEqual(f.read(), "b.com\n")
+
+class _FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000000000.0
+
+    def time(self):
+        return self.now
+
+class _UntrackedWhitelist(whitelists.Whitelist):
+    """
+    A whitelist whose version doesn't change when its entries do, like a
+    MongoDB collection edited without dnsfilter.
+    """
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+
+    def get_all(self):
+        return list(self.entries)
+
+    def get_version(self):
+        return 1
+
+class IndexedWhitelistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = _FakeTime()
+        self.patch(whitelists, "time", self.time)
+        self.source = _UntrackedWhitelist([ "a.com" ])
+        self.whitelist = whitelists.IndexedWhitelist(self.source,
+            full_refresh_interval=3600)
+
+    def test_skips_refresh_when_version_unchanged(self):
+        self.source.entries.append("b.com")
+        self.time.now += 30
+        self.assertFalse(self.whitelist.refresh())
+        self.assertFalse(self.whitelist.matches("b.com"))
+
+    def test_full_refresh_picks_up_untracked_changes(self):
+        self.source.entries.append("b.com")
+        self.time.now += 3600
+        self.assertTrue(self.whitelist.refresh())
+        self.assertTrue(self.whitelist.matches("b.com"))
+
+    def test_full_refresh_without_changes(self):
+        index = self.whitelist.index
+        self.time.now += 3600
+        self.assertFalse(self.whitelist.refresh())
+        self.assertIs(self.whitelist.index, index)
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Copyright 2016 Deany Dean
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.trial import unittest
+import workers
+
+"""
+Tests of the worker supervisor, with fake worker processes.
+"""
+
+class _FakeTransport(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.signals = []
+
+    def signalProcess(self, sig):
+        self.signals.append(sig)
+
+class _FakeReactor(task.Clock):
+    """
+    A clock that records the processes spawned instead of running them.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.processes = []
+        self.stopped = False
+        self.triggers = []
+
+    def spawnProcess(self, protocol, executable, args, env=None,
+            childFDs=None):
+        protocol.transport = _FakeTransport(len(self.processes) + 1)
+        self.processes.append(protocol)
+
+    def addSystemEventTrigger(self, phase, event, fn):
+        self.triggers.append((phase, event, fn))
+
+    def stop(self):
+        self.stopped = True
+
+def _ready(worker):
+    worker.childDataReceived(workers.READY_FD, "ready\n")
+
+def _exit(worker):
+    worker.processEnded(failure.Failure(error.ProcessTerminated(1)))
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = _FakeReactor()
+        self.supervisor = workers.WorkerSupervisor(2, [ "server.py" ],
+            restart_delay=1, max_restart_delay=4, reactor=self.reactor)
+        self.supervisor.start()
+
+    def _start_all(self):
+        for worker in self.reactor.processes:
+            _ready(worker)
+        self.assertTrue(self.supervisor.started)
+
+    def _worker(self, worker_id):
+        return self.supervisor.workers[worker_id]
+
+    def test_spawns_workers(self):
+        self.assertEqual([ w.worker_id for w in self.reactor.processes ],
+            [ 0, 1 ])
+        self.assertFalse(self.supervisor.started)
+
+    def test_exit_during_startup_stops_the_server(self):
+        _ready(self._worker(0))
+        _exit(self._worker(1))
+
+        self.assertTrue(self.reactor.stopped)
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 0)
+
+    def test_restarts_worker_that_exits(self):
+        self._start_all()
+        _exit(self._worker(0))
+        self.assertNotIn(0, self.supervisor.workers)
+
+        self.reactor.advance(1)
+        self.assertFalse(self.reactor.stopped)
+        self.assertEqual(len(self.reactor.processes), 3)
+        self.assertEqual(self._worker(0), self.reactor.processes[-1])
+
+    def test_failed_restart_backs_off(self):
+        self._start_all()
+        _exit(self._worker(0))
+        self.reactor.advance(1)
+
+        # The restarted worker keeps failing before it is ready
+        delays = []
+        for i in range(4):
+            _exit(self._worker(0))
+            delays.append(self.reactor.getDelayedCalls()[0].getTime() -
+                self.reactor.seconds())
+            self.reactor.advance(delays[-1])
+
+        self.assertFalse(self.reactor.stopped)
+        self.assertEqual(delays, [ 1, 2, 4, 4 ])
+        self.assertEqual(len(self.reactor.processes), 7)
+
+        # A ready worker resets the delay
+        _ready(self._worker(0))
+        _exit(self._worker(0))
+        self.assertEqual(self.reactor.getDelayedCalls()[0].getTime() -
+            self.reactor.seconds(), 1)
+
+    def test_stop(self):
+        self._start_all()
+        stopped = self.supervisor.stop()
+        for worker in self.reactor.processes:
+            self.assertEqual(worker.transport.signals,
+                [ workers.signal.SIGTERM ])
+
+        _exit(self._worker(0))
+        self.assertFalse(stopped.called)
+        _exit(self._worker(1))
+        self.assertTrue(stopped.called)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def test_does_not_restart_after_stop(self):
+        self._start_all()
+        _exit(self._worker(0))
+        self.supervisor.stop()
+        self.reactor.advance(1)
+        self.assertEqual(len(self.reactor.processes), 2)